@@ -1,6 +1,6 @@
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib import admin
-from .models import User, Story, Chapter
+from .models import User, Story, Chapter, JudgeVerdict, RescoreRun
 from .forms import UserCreationForm, StoryCreationForm, ChapterCreationForm
 
 # Override admin site attributes:
@@ -45,11 +45,26 @@ class ChapterAdmin(admin.ModelAdmin):
     add_form = ChapterCreationForm
     model = Chapter
     list_display = ("title", "timestamp", "author", "story", "ordinal", "draft", "previous_chapter")
-    list_filter = ("title", "timestamp", "author", "story", "ordinal", "draft", "previous_chapter")
+    list_filter = ("title", "timestamp", "author", "story", "ordinal", "draft", "review_tier", "previous_chapter")
     ordering = ("-timestamp",)
     search_fields = ("title", "author", "story")
 
+class JudgeVerdictAdmin(admin.ModelAdmin):
+    model = JudgeVerdict
+    list_display = ("key", "model_id", "score", "created_at", "last_used_at", "hit_count")
+    list_filter = ("model_id", "score")
+    ordering = ("-last_used_at",)
+    search_fields = ("key",)
+
+class RescoreRunAdmin(admin.ModelAdmin):
+    model = RescoreRun
+    list_display = ("name", "model_id", "small_model_id", "scored", "failed", "last_chapter_id", "started_at", "finished_at")
+    ordering = ("-started_at",)
+    search_fields = ("name", "model_id")
+
 # Register all models here.
 admin.site.register(User, UserAdmin)
 admin.site.register(Story, StoryAdmin)
 admin.site.register(Chapter, ChapterAdmin)
+admin.site.register(JudgeVerdict, JudgeVerdictAdmin)
+admin.site.register(RescoreRun, RescoreRunAdmin)
@@ -0,0 +1,121 @@
+# Cache layer for the read-heavy pages (story_view, chapter_view, stories).
+#
+# Entries are keyed by a version number: one per story, plus one for the stories listing. The signal
+# receivers in signals.py bump the story's version whenever one of its chapters (or the story itself) is
+# saved or deleted, and the listing version whenever any story changes. Old entries are never deleted;
+# they simply stop being read and expire after FEATHERTREE_CACHE_TIMEOUT.
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .metrics import FRAGMENT_CACHE_REQUESTS
+from .models import JudgeVerdict
+
+STORY_VERSION_KEY = "story:{}:version"
+STORY_LIST_VERSION_KEY = "stories:version"
+JUDGE_VERDICT_KEY = "verdict:{}"
+JUDGE_VERDICT_TOUCHED_KEY = "verdict:{}:touched"
+
+
+# Versions start from the current time in milliseconds rather than 1, so a version key that was evicted
+# and re-created can't come back with a number that still has stale entries cached under it.
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+def _bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:  # key missing or evicted
+        cache.add(key, int(time.time() * 1000), timeout=None)
+
+def get_story_version(story_id):
+    return _get_version(STORY_VERSION_KEY.format(story_id))
+
+def bump_story_version(story_id):
+    _bump_version(STORY_VERSION_KEY.format(story_id))
+
+def get_story_list_version():
+    return _get_version(STORY_LIST_VERSION_KEY)
+
+def bump_story_list_version():
+    _bump_version(STORY_LIST_VERSION_KEY)
+
+
+# Return the cached value for `name` under the story's current version, computing and storing it on a miss.
+def cached_for_story(story_id, name, compute):
+    key = f"story:{story_id}:v{get_story_version(story_id)}:{name}"
+    return cache.get_or_set(key, compute, settings.FEATHERTREE_CACHE_TIMEOUT)
+
+# Same as cached_for_story, for data derived from the stories listing as a whole.
+def cached_for_story_list(name, compute):
+    key = f"stories:v{get_story_list_version()}:{name}"
+    return cache.get_or_set(key, compute, settings.FEATHERTREE_CACHE_TIMEOUT)
+
+
+# Which variant of a page a user gets. Authors and moderators can see things anonymous readers can't,
+# so anything rendered per viewer is cached per class rather than per user.
+def viewer_class(user):
+    if not user.is_authenticated:
+        return "anonymous"
+    return "staff" if user.is_staff else "member"
+
+# Cache a rendered HTML fragment per (story, story version, viewer class). `render` is only called on a
+# miss; lookups are counted in FRAGMENT_CACHE_REQUESTS so the hit rate can be tracked.
+def cached_fragment(story_id, name, viewer, render):
+    key = f"story:{story_id}:v{get_story_version(story_id)}:fragment:{name}:{viewer}"
+    html = cache.get(key)
+    if html is not None:
+        FRAGMENT_CACHE_REQUESTS.labels(fragment=name, result="hit").inc()
+        return html
+    FRAGMENT_CACHE_REQUESTS.labels(fragment=name, result="miss").inc()
+    html = render()
+    cache.set(key, html, settings.FEATHERTREE_CACHE_TIMEOUT)
+    return html
+
+
+# Conditional GET helpers. ETags are built from values that are cheap to read (timestamps and cache
+# versions) plus who is asking: pages include the viewer's own header links, so each signed-in user gets
+# their own validator, and STATIC_VERSION so a cache-busting release invalidates old pages too.
+def viewer_etag_key(user):
+    return f"{viewer_class(user)}:{user.pk or ''}"
+
+def make_etag(*parts):
+    raw = "|".join(str(part) for part in (settings.STATIC_VERSION, *parts))
+    return hashlib.md5(raw.encode(), usedforsecurity=False).hexdigest()
+
+
+# Judge verdicts: Redis in front of the JudgeVerdict table. Returns (score, feedback) or None.
+# Redis hits still reach the table, at most once per FEATHERJUDGE_VERDICT_TOUCH_INTERVAL per verdict, so
+# the most used verdicts don't look idle to JudgeVerdictManager.evict().
+def get_judge_verdict(key):
+    if not settings.FEATHERJUDGE_VERDICT_TTL:
+        return None
+    verdict = cache.get(JUDGE_VERDICT_KEY.format(key))
+    if verdict is not None:
+        if cache.add(JUDGE_VERDICT_TOUCHED_KEY.format(key), True, timeout=settings.FEATHERJUDGE_VERDICT_TOUCH_INTERVAL):
+            JudgeVerdict.objects.record_hit(key)
+    else:
+        row = JudgeVerdict.objects.lookup(key)
+        if row is None:
+            return None
+        verdict = (row.score, row.feedback)
+        cache.set(JUDGE_VERDICT_KEY.format(key), verdict, _verdict_timeout(row.created_at))
+    return verdict
+
+def store_judge_verdict(key, model_id, score, feedback):
+    if not settings.FEATHERJUDGE_VERDICT_TTL:
+        return
+    row = JudgeVerdict.objects.store(key, model_id, score, feedback)
+    cache.set(JUDGE_VERDICT_KEY.format(key), (score, feedback), _verdict_timeout(row.created_at))
+
+# Redis copies never outlive the database row's TTL
+def _verdict_timeout(created_at):
+    remaining = settings.FEATHERJUDGE_VERDICT_TTL - (timezone.now() - created_at).total_seconds()
+    return max(1, min(int(remaining), settings.FEATHERTREE_CACHE_TIMEOUT))
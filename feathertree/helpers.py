@@ -2,10 +2,22 @@ from django.shortcuts import render
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from .tokens import account_activation_token
+from .judge_client import judge_model_id, judge_url, post_judge, post_judge_batch, reserve_connections
+from .caching import get_judge_verdict, store_judge_verdict
+from .judge_context import JudgePromptTooLong, estimate_tokens
+from .judge_breaker import JudgeUnavailable, get_breaker, get_limiter
+from .metrics import (
+    JUDGE_PARSE_FAILURES, JUDGE_PROMPT_CHARS, JUDGE_PROMPT_TOKENS, JUDGE_REQUEST_SECONDS, JUDGE_TIER_DECISIONS,
+)
 from django.conf import settings
-import requests
 from requests.exceptions import RequestException, Timeout
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import re
+import threading
+import time
 import logging
 
 logger = logging.getLogger(__name__)
@@ -48,6 +60,57 @@ def chunk_list(lst, chunk_size):
         chunks.append(chunk)
     return chunks
 
+# Chapter tree helpers. Both take a story's published chapters in pre-order (see Chapter.preorder) and
+# drop any chapter whose parent isn't in the list, e.g. a published chapter hanging off a draft.
+def _visible_in_preorder(chapters):
+    seen = set()
+    for chapter in chapters:
+        if chapter.previous_chapter_id is None or chapter.previous_chapter_id in seen:
+            seen.add(chapter.id)
+            yield chapter
+
+# Nested {"chapter", "children"} nodes for the recursive _chapter_tree.html template.
+def build_chapter_tree(chapters):
+    nodes_by_id = {}
+    roots = []
+    for chapter in _visible_in_preorder(chapters):
+        node = {"chapter": chapter, "children": []}
+        if chapter.previous_chapter_id is None:
+            roots.append(node)
+        else:
+            nodes_by_id[chapter.previous_chapter_id]["children"].append(node)
+        nodes_by_id[chapter.id] = node
+    return roots
+
+# Flat rows for _chapter_tree_flat.html, which renders the whole tree in one loop with no recursion.
+# Each row says whether it opens a children list (has_children) and, for a leaf, how many enclosing
+# lists to close after it (closes, a range so the template can loop over it).
+# When only the top levels were fetched, chapters annotated with has_published_children whose children
+# weren't included come back as is_lazy rows: rendered like leaves, but with a toggle that loads
+# their children from the chapter_children endpoint.
+def flatten_chapter_tree(chapters):
+    visible = list(_visible_in_preorder(chapters))
+    rows = []
+    for i, chapter in enumerate(visible):
+        next_chapter = visible[i + 1] if i + 1 < len(visible) else None
+        # In pre-order a chapter's first child, if any, comes straight after it
+        has_children = next_chapter is not None and next_chapter.previous_chapter_id == chapter.id
+        is_lazy = not has_children and getattr(chapter, "has_published_children", False)
+        next_depth = next_chapter.depth if next_chapter is not None else 0
+        rows.append({
+            "chapter": chapter,
+            "level": chapter.depth,
+            "has_children": has_children,
+            "is_lazy": is_lazy,
+            # Only the first root starts out expanded, like the recursive template
+            "is_expanded": i == 0 and has_children,
+            "closes": range(0 if has_children else chapter.depth - next_depth),
+        })
+    return rows
+
+# Everything that is the same for every review comes first, then the story so far, then the chapter under
+# review, then the (fixed) answer format. The inference server can then reuse its cached prefix (KV cache)
+# across all reviews up to the story text, and across sibling continuations up to the current text.
 def build_continuity_prompt(previous_text: str,
                             current_text: str,
                             criteria: str,
@@ -57,23 +120,13 @@ def build_continuity_prompt(previous_text: str,
 Your job is to evaluate how well a story continues from one passage to the next.
 
 You will be provided with:
-1. A previous section of story text ("previous text")
-2. A new continuation written after it ("current text")
-3. Continuity evaluation criteria
-4. A scoring rubric (1–5)
+1. Continuity evaluation criteria
+2. A scoring rubric (1–5)
+3. A previous section of story text ("previous text")
+4. A new continuation written after it ("current text")
 
 Your task is to evaluate the continuity between previous text and current text.
 
-# PREVIOUS TEXT
-<previous_text>
-{previous_text}
-</previous_text>
-
-# CURRENT TEXT
-<current_text>
-{current_text}
-</current_text>
-
 # CONTINUITY EVALUATION CRITERIA
 <evaluation_criteria>
 {criteria}
@@ -92,7 +145,17 @@ Your task is to evaluate the continuity between previous text and current text.
 5. Use the scoring rubric to determine the appropriate score.
 6. Justify your evaluation with specific references to both passages.
 
-## FORMAT FOR THE EVALUATION
+# PREVIOUS TEXT
+<previous_text>
+{previous_text}
+</previous_text>
+
+# CURRENT TEXT
+<current_text>
+{current_text}
+</current_text>
+
+# FORMAT FOR THE EVALUATION
 - Write verbal feedback inside <feedback> tags without any surrounding text.
 - Write the numeric score inside <score> tags, without any surrounding text and always after the feedback.
 
@@ -112,6 +175,7 @@ def parse_featherjudge_response(text: str) -> tuple[int, str]:
     """
     # Guard against accidentally passing a tuple or other type
     if not isinstance(text, str):
+        JUDGE_PARSE_FAILURES.labels(reason="not_text").inc()
         logger.error(
             "parse_featherjudge_response expected a string, got %r: %r",
             type(text),
@@ -130,6 +194,7 @@ def parse_featherjudge_response(text: str) -> tuple[int, str]:
     )
 
     if not feedback_match:
+        JUDGE_PARSE_FAILURES.labels(reason="missing_feedback").inc()
         # Log a snippet so you can see what the model actually returned
         logger.error(
             "No <feedback>...</feedback> block found in FeatherJudge response. "
@@ -139,6 +204,7 @@ def parse_featherjudge_response(text: str) -> tuple[int, str]:
         raise ValueError("No <feedback>...</feedback> block found.")
 
     if not score_match:
+        JUDGE_PARSE_FAILURES.labels(reason="missing_score").inc()
         logger.error(
             "No <score>...</score> block found in FeatherJudge response. "
             "First 500 chars: %r",
@@ -152,6 +218,7 @@ def parse_featherjudge_response(text: str) -> tuple[int, str]:
     try:
         score = int(score_str)
     except ValueError as e:
+        JUDGE_PARSE_FAILURES.labels(reason="bad_score").inc()
         # This gives you full traceback + context in DO logs
         logger.exception(
             "Score is not a valid integer. Got %r from response. "
@@ -163,20 +230,28 @@ def parse_featherjudge_response(text: str) -> tuple[int, str]:
 
     return score, feedback
 
-# Creates Baseten API call to the LLM
-def call_featherjudge(payload):
-    url = (
-        f"https://model-{settings.FEATHERJUDGE_MODEL_ID}.api.baseten.co/"
-        f"{settings.BASETEN_DEPLOYMENT_TYPE}/predict"
-    )
-
+# Creates Baseten API call to the LLM over the pooled judge client connection. Calls go through the
+# process's adaptive concurrency limit and circuit breaker (judge_breaker.py); while the breaker is open this
+# raises JudgeUnavailable without touching the network. `urls` overrides endpoints as in judge_client.judge_url.
+def call_featherjudge(payload, tier="large", urls=None):
+    url = judge_url(tier, urls)
+    breaker = get_breaker(tier)
+    limiter = get_limiter(tier)
+    limiter.acquire()
     try:
-        resp = requests.post(
-            url,
-            headers={"Authorization": f"Api-Key {settings.BASETEN_API_KEY}"},
-            json=payload,
-            timeout=120,
-        )
+        breaker.before_call()
+    except JudgeUnavailable:
+        limiter.abandon()
+        raise
+
+    # Timeouts, connection errors, 429s and 5xxs count against the endpoint's health
+    healthy = False
+    status = "error"
+    start = time.monotonic()
+    try:
+        resp = post_judge(payload, tier, urls)
+        status = str(resp.status_code)
+        healthy = resp.status_code < 500 and resp.status_code != 429
 
         resp.raise_for_status()
         data = resp.json()
@@ -191,6 +266,7 @@ def call_featherjudge(payload):
         return text
 
     except Timeout:
+        status = "timeout"
         logger.warning("FeatherJudge request timed out for URL %s", url, exc_info=True)
         return None, "The FeatherJudge model timed out while generating a response."
 
@@ -206,18 +282,137 @@ def call_featherjudge(payload):
         logger.exception("Unexpected error while calling FeatherJudge at %s", url)
         return None, f"Unexpected error while calling FeatherJudge: {e}"
 
+    finally:
+        elapsed = time.monotonic() - start
+        JUDGE_REQUEST_SECONDS.labels(tier=tier, status=status).observe(elapsed)
+        limiter.release(elapsed, healthy)
+        if healthy:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+
+# Send several payloads at once: as one request to FEATHERJUDGE_BATCH_URL when the deployment has a batch
+# endpoint, otherwise as concurrent calls (at most `max_workers`, default FEATHERJUDGE_FANOUT, at a time) over
+# the pooled session. A larger `max_workers` widens this process's concurrency limit and connection pool to match.
+# Returns one response text per payload, or the same (None, message) error tuples as call_featherjudge, or
+# JudgeUnavailable while the circuit breaker is open. The batch endpoint serves the large model only.
+# `groups` optionally gives each payload a group key (e.g. the parent chapter): payloads sharing a key share a
+# prompt prefix, and are scheduled in `order` (default FEATHERJUDGE_DISPATCH_ORDER). `urls` overrides
+# endpoints as in judge_client.judge_url; the configured batch endpoint belongs to the configured large
+# model, so it isn't used when `urls` replaces that, unless given again as `batch_url` ("" turns it off).
+def call_featherjudge_batch(payloads, tier="large", groups=None, max_workers=None, urls=None, batch_url=None,
+                            order=None):
+    if not payloads:
+        return []
+    if batch_url is None and not (urls and tier in urls):
+        batch_url = settings.FEATHERJUDGE_BATCH_URL
+    if batch_url and tier == "large":
+        breaker = get_breaker(tier)
+        try:
+            breaker.before_call()
+        except JudgeUnavailable as e:
+            return [e] * len(payloads)
+        # As in call_featherjudge, the status decides the endpoint's health, and it is recorded whatever
+        # goes wrong afterwards: a half-open breaker must always hear how its probe went
+        healthy = False
+        status = "error"
+        start = time.monotonic()
+        try:
+            resp = post_judge_batch(payloads, batch_url)
+            status = str(resp.status_code)
+            healthy = resp.status_code < 500 and resp.status_code != 429
+            resp.raise_for_status()
+            texts = resp.json()["texts"]
+            if len(texts) != len(payloads):
+                raise ValueError(f"Expected {len(payloads)} texts, got {len(texts)}")
+            return texts
+        except Exception as e:
+            if isinstance(e, Timeout):
+                status = "timeout"
+            logger.exception("Batched FeatherJudge call to %s failed", batch_url)
+            return [(None, f"Batched FeatherJudge call failed: {e}")] * len(payloads)
+        finally:
+            JUDGE_REQUEST_SECONDS.labels(tier=tier, status=status).observe(time.monotonic() - start)
+            if healthy:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    if max_workers is not None and max_workers > settings.FEATHERJUDGE_FANOUT:
+        get_limiter(tier).widen(max_workers)
+        reserve_connections(max_workers)
+    workers = min(len(payloads), max_workers or settings.FEATHERJUDGE_FANOUT)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if groups is None or (order or settings.FEATHERJUDGE_DISPATCH_ORDER) != "siblings":
+            return list(executor.map(
+                _call_featherjudge_or_unavailable, payloads, [tier] * len(payloads), [urls] * len(payloads)
+            ))
+        return _fan_out_by_group(executor, workers, payloads, tier, groups, urls)
+
+# Sibling-ordered fan-out. The first payload of a group goes out alone; once it has been answered (and the
+# server has the group's prompt prefix cached) the rest of the group is released, ahead of any group not
+# started yet, so siblings reach the server back-to-back instead of after the prefix has been evicted.
+# A None group key is a group of its own.
+def _fan_out_by_group(executor, workers, payloads, tier, groups, urls=None):
+    members = {}
+    for index, group in enumerate(groups):
+        members.setdefault(index if group is None else ("group", group), []).append(index)
+    leaders = deque(indices[0] for indices in members.values())
+    followers = {indices[0]: indices[1:] for indices in members.values()}
+    released = deque()
+    results = [None] * len(payloads)
+    unassigned = [len(payloads)]
+    ready = threading.Condition()
+
+    def work():
+        while True:
+            with ready:
+                ready.wait_for(lambda: released or leaders or not unassigned[0])
+                if not unassigned[0]:
+                    return
+                index = released.popleft() if released else leaders.popleft()
+                unassigned[0] -= 1
+            results[index] = _call_featherjudge_or_unavailable(payloads[index], tier, urls)
+            with ready:
+                released.extend(followers.pop(index, ()))
+                ready.notify_all()
+
+    for future in [executor.submit(work) for _ in range(workers)]:
+        future.result()
+    return results
+
+def _call_featherjudge_or_unavailable(payload, tier, urls=None):
+    try:
+        return call_featherjudge(payload, tier, urls)
+    except JudgeUnavailable as e:
+        return e
 
-# This tries to query the Baseten API setup running a modified version of Flow-Judge
-# https://github.com/flowaicom/flow-judge
-# Baseten implementation:
-# https://app.baseten.co/models/rwny1n13
-def query_judge(previous_text, current_text):
-    criteria = (
-        "Evaluate how well the current text continues the story from the previous text. "
-        "Focus on tone, theme, narrative flow, and logical coherence. "
+
+# Verdict cache key: a hash of everything that determines the judge's answer (endpoint, model, prompt and
+# sampling parameters). The model ID is hashed as well as the URL, which doesn't contain it when overridden.
+def judge_verdict_key(payload, tier="large", urls=None):
+    raw = json.dumps(
+        {"judge": judge_url(tier, urls), "model": judge_model_id(tier), "payload": payload}, sort_keys=True
     )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+# Tiers of the review cascade, in the order they score a chapter
+def judge_tiers():
+    return ["small", "large"] if settings.FEATHERJUDGE_SMALL_MODEL_ID else ["large"]
+
+# Whether a score from `tier` is too uncertain to act on, so the next tier has to score the chapter too
+def should_escalate(tier, score):
+    return tier != "large" and settings.FEATHERJUDGE_ESCALATE_MIN <= score <= settings.FEATHERJUDGE_ESCALATE_MAX
 
-    rubric = """
+
+CONTINUITY_CRITERIA = (
+    "Evaluate how well the current text continues the story from the previous text. "
+    "Focus on tone, theme, narrative flow, and logical coherence. "
+)
+
+CONTINUITY_RUBRIC = """
     - Score 1: No continuity. Very different in theme, tone, and content. New elements do not make sense in the context of the story.
     - Score 2: Poor continuity. Somewhat different in theme, tone, and content. New elements do not make sense in the context of the story.
     - Score 3: Some continuity. Somewhat aligned and somewhat different in theme, tone, and content. New elements make sense in the context of the story.
@@ -225,23 +420,161 @@ def query_judge(previous_text, current_text):
     - Score 5: Excellent continuity. Very aligned in theme, tone, and content. New elements make sense in the context of the story.
     """
 
+JUDGE_MAX_TOKENS = 512 # room reserved in the context window for the judge's answer
+
+# Tokens available for previous text once the rest of the prompt and the answer are accounted for.
+# Continuations of the same chapter should get byte-identical previous text (a shared prompt prefix), so
+# the current text is charged at least FEATHERJUDGE_CURRENT_TEXT_TOKENS whatever its length: only a
+# chapter longer than that gets a shorter budget than its siblings.
+def previous_text_budget(current_text):
+    prompt = build_continuity_prompt("", "", CONTINUITY_CRITERIA, CONTINUITY_RUBRIC)
+    current_tokens = max(estimate_tokens(current_text), settings.FEATHERJUDGE_CURRENT_TEXT_TOKENS)
+    return settings.FEATHERJUDGE_CONTEXT_TOKENS - JUDGE_MAX_TOKENS - estimate_tokens(prompt) - current_tokens
+
+
+# This tries to query the Baseten API setup running a modified version of Flow-Judge
+# https://github.com/flowaicom/flow-judge
+# Baseten implementation:
+# https://app.baseten.co/models/rwny1n13
+# With use_cache=False the verdict cache is neither read nor written. `urls` overrides judge endpoints (see
+# judge_client.judge_url).
+def query_judge(previous_text, current_text, use_cache=True, tier="large", urls=None):
+    payload = build_judge_payload(previous_text, current_text)
+    return _query_tier(payload, tier, use_cache, urls)
+
+def _query_tier(payload, tier, use_cache, urls=None):
+    # Identical calls (e.g. a chapter resubmitted unchanged) reuse the earlier verdict
+    key = judge_verdict_key(payload, tier, urls)
+    if use_cache:
+        verdict = get_judge_verdict(key)
+        if verdict is not None:
+            return verdict
+
+    response = call_featherjudge(payload, tier, urls)
+
+    score, feedback = parse_featherjudge_response(response)
+    if use_cache:
+        store_judge_verdict(key, judge_model_id(tier), score, feedback)
+
+    return score, feedback
+
+
+# Score a chapter through the review cascade: each tier in judge_tiers() in turn, until one gives a score
+# outside the ambiguous band. Returns (score, feedback, tier that decided). A first-pass answer that can't
+# be used, or a first-pass model that is unavailable, escalates as well; JudgeUnavailable and errors from
+# the last tier are raised. `use_cache` and `urls` are as for query_judge.
+def query_judge_cascade(previous_text, current_text, use_cache=True, urls=None):
+    payload = build_judge_payload(previous_text, current_text)
+    tiers = judge_tiers()
+    for tier in tiers:
+        try:
+            score, feedback = _query_tier(payload, tier, use_cache, urls)
+        except JudgeUnavailable as e:
+            if tier == tiers[-1]:
+                raise
+            logger.warning("Escalating review: the %s judge model is unavailable (%s)", tier, e)
+            continue
+        except Exception:
+            if tier == tiers[-1]:
+                raise
+            logger.warning("Escalating review: unusable answer from the %s judge model", tier, exc_info=True)
+            continue
+        if not should_escalate(tier, score):
+            break
+    JUDGE_TIER_DECISIONS.labels(tier=tier).inc()
+    return score, feedback, tier
+
+
+def build_judge_payload(previous_text, current_text):
     flow_judge_prompt = build_continuity_prompt(
         previous_text,
         current_text,
-        criteria,
-        rubric
+        CONTINUITY_CRITERIA,
+        CONTINUITY_RUBRIC
     )
 
-    payload = {
+    # Don't send a prompt the model can't take; the caller should have fitted previous_text to
+    # previous_text_budget(current_text)
+    prompt_tokens = estimate_tokens(flow_judge_prompt)
+    JUDGE_PROMPT_CHARS.observe(len(flow_judge_prompt))
+    JUDGE_PROMPT_TOKENS.observe(prompt_tokens)
+    if prompt_tokens + JUDGE_MAX_TOKENS > settings.FEATHERJUDGE_CONTEXT_TOKENS:
+        raise JudgePromptTooLong(
+            f"Prompt is about {prompt_tokens} tokens; FEATHERJUDGE_CONTEXT_TOKENS is {settings.FEATHERJUDGE_CONTEXT_TOKENS}"
+        )
+
+    return {
         "prompt": flow_judge_prompt,
-        "max_tokens": 512,
+        "max_tokens": JUDGE_MAX_TOKENS,
         "temperature": 0.1,
         "top_p": 0.95,
         "top_k": 40
     }
-    
-    response = call_featherjudge(payload)
 
-    score, feedback = parse_featherjudge_response(response)
 
-    return score, feedback
\ No newline at end of file
+# Judge several (previous_text, current_text) pairs at once. Returns one result per pair, in order: a
+# (score, feedback, tier) tuple as from query_judge_cascade, or the exception that pair raised, so one bad
+# chapter doesn't fail the batch. Each cascade tier makes a single call_featherjudge_batch for the pairs
+# still undecided; cached verdicts are reused. `groups` (one key per pair, e.g. the parent chapter id) marks
+# pairs with a shared prompt prefix; with FEATHERJUDGE_DISPATCH_ORDER (or `order`) = "siblings" they are sent
+# together. `use_cache` and `urls` are as for query_judge; `tiers` replaces judge_tiers(), and `max_workers`
+# and `batch_url` go to call_featherjudge_batch.
+def query_judge_batch(pairs, use_cache=True, groups=None, max_workers=None, urls=None, batch_url=None,
+                      order=None, tiers=None):
+    results = [None] * len(pairs)
+    payloads = {}
+    for index, (previous_text, current_text) in enumerate(pairs):
+        try:
+            payloads[index] = build_judge_payload(previous_text, current_text)
+        except JudgePromptTooLong as e:
+            results[index] = e
+
+    tiers = tiers or judge_tiers()
+    for tier in tiers:
+        last = tier == tiers[-1]
+        verdicts = {}
+        pending = []
+        for index, payload in payloads.items():
+            key = judge_verdict_key(payload, tier, urls)
+            verdict = get_judge_verdict(key) if use_cache else None
+            if verdict is not None:
+                verdicts[index] = verdict
+            else:
+                pending.append((index, key, payload))
+
+        pending_groups = None
+        if groups is not None:
+            if (order or settings.FEATHERJUDGE_DISPATCH_ORDER) == "siblings":
+                # Adjacent in the batch, in order of each group's first pair
+                first = {}
+                for index, _, _ in pending:
+                    first.setdefault(groups[index], index)
+                pending.sort(key=lambda item: item[0] if groups[item[0]] is None else first[groups[item[0]]])
+            pending_groups = [groups[index] for index, _, _ in pending]
+
+        responses = call_featherjudge_batch(
+            [payload for _, _, payload in pending], tier, pending_groups,
+            max_workers=max_workers, urls=urls, batch_url=batch_url, order=order,
+        )
+        for (index, key, _), response in zip(pending, responses):
+            if isinstance(response, JudgeUnavailable):
+                if last:
+                    results[index] = response
+                continue  # escalated
+            try:
+                score, feedback = parse_featherjudge_response(response)
+            except Exception as e:
+                if last:
+                    results[index] = e
+                continue  # escalated
+            if use_cache:
+                store_judge_verdict(key, judge_model_id(tier), score, feedback)
+            verdicts[index] = (score, feedback)
+
+        for index, (score, feedback) in verdicts.items():
+            if not should_escalate(tier, score):
+                JUDGE_TIER_DECISIONS.labels(tier=tier).inc()
+                results[index] = (score, feedback, tier)
+        # Pairs left without a result go to the next tier
+        payloads = {index: payload for index, payload in payloads.items() if results[index] is None}
+    return results
@@ -0,0 +1,198 @@
+# Protection for the FeatherJudge endpoint when it is cold or overloaded.
+#
+# CircuitBreaker: after FEATHERJUDGE_BREAKER_FAILURES consecutive failed calls (timeouts, connection errors,
+# 429/5xx) the breaker opens and calls fail immediately with JudgeUnavailable instead of waiting out their
+# timeouts. After FEATHERJUDGE_BREAKER_COOLDOWN seconds it lets a single probe call through (half-open): a
+# success closes it again, a failure re-opens it for another cooldown.
+#
+# AdaptiveLimiter: AIMD concurrency limit, starting at the client's maximum. Each fast success raises the limit by 1/limit (about +1 per
+# round of calls); a failure or a call slower than FEATHERJUDGE_LATENCY_TARGET halves it, at most once per
+# second so a burst of failures from one round only counts once.
+#
+# State is per process and per cascade tier (the small and large models are separate endpoints, and one
+# failing must not shut out the other), like the judge_client session, and is reset after a fork.
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import (
+    JUDGE_BREAKER_STATE, JUDGE_BREAKER_TRANSITIONS, JUDGE_CONCURRENCY_LIMIT, JUDGE_IN_FLIGHT,
+)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class JudgeUnavailable(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"FeatherJudge circuit breaker is open; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, cooldown, tier="large"):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.tier = tier
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+        JUDGE_BREAKER_STATE.labels(tier=tier).set(BREAKER_STATE_VALUES[CLOSED])
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            JUDGE_BREAKER_STATE.labels(tier=self.tier).set(BREAKER_STATE_VALUES[state])
+            JUDGE_BREAKER_TRANSITIONS.labels(tier=self.tier, state=state).inc()
+
+    def retry_after(self):
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    # Raise JudgeUnavailable unless a call may go ahead now. In half-open state only one probe is let through.
+    def before_call(self):
+        with self.lock:
+            if self.state == OPEN:
+                if self.retry_after() > 0:
+                    raise JudgeUnavailable(self.retry_after())
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    raise JudgeUnavailable(self.cooldown)
+                self.probing = True
+
+    # Whether calls would be refused right now (doesn't claim the half-open probe)
+    def is_open(self):
+        with self.lock:
+            return self.state == OPEN and self.retry_after() > 0
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class AdaptiveLimiter:
+    def __init__(self, minimum, maximum, latency_target, client, tier="large"):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.client = client
+        self.tier = tier
+        self.condition = threading.Condition()
+        self._report()
+
+    def _report(self):
+        JUDGE_CONCURRENCY_LIMIT.labels(client=self.client, tier=self.tier).set(self.limit)
+        JUDGE_IN_FLIGHT.labels(client=self.client, tier=self.tier).set(self.in_flight)
+
+    def try_acquire(self):
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            self._report()
+            return True
+
+    # Block until a slot is free (or `timeout` seconds pass). Returns whether a slot was taken.
+    def acquire(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                return False
+            self.in_flight += 1
+            self._report()
+            return True
+
+    # Raise the ceiling for a caller that runs more calls at once than the client's maximum (e.g. rescore
+    # --parallel). The limit rises with it, as a new limiter would start at its maximum.
+    def widen(self, maximum):
+        with self.condition:
+            if maximum > self.maximum:
+                self.limit += maximum - self.maximum
+                self.maximum = maximum
+                self._report()
+                self.condition.notify_all()
+
+    # Free a slot without a call to learn from (e.g. the breaker refused it)
+    def abandon(self):
+        with self.condition:
+            self.in_flight -= 1
+            self._report()
+            self.condition.notify_all()
+
+    def release(self, latency, ok):
+        with self.condition:
+            self.in_flight -= 1
+            if ok and latency <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif time.monotonic() - self.last_decrease >= 1:
+                self.limit = max(self.minimum, self.limit / 2)
+                self.last_decrease = time.monotonic()
+            self._report()
+            self.condition.notify_all()
+
+
+_breakers = {}
+_limiters = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def _ensure_state():
+    global _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _breakers.clear()
+                _limiters.clear()
+                _pid = os.getpid()
+
+# The process-wide breaker of a cascade tier's endpoint, shared by the sync client and the async dispatcher
+def get_breaker(tier="large"):
+    _ensure_state()
+    with _lock:
+        if tier not in _breakers:
+            _breakers[tier] = CircuitBreaker(
+                settings.FEATHERJUDGE_BREAKER_FAILURES, settings.FEATHERJUDGE_BREAKER_COOLDOWN, tier
+            )
+        return _breakers[tier]
+
+# Concurrency limiter of a cascade tier for the blocking (requests) client
+def get_limiter(tier="large"):
+    _ensure_state()
+    with _lock:
+        if tier not in _limiters:
+            _limiters[tier] = new_limiter(settings.FEATHERJUDGE_FANOUT, client="sync", tier=tier)
+        return _limiters[tier]
+
+def new_limiter(maximum, client, tier="large"):
+    return AdaptiveLimiter(
+        minimum=settings.FEATHERJUDGE_CONCURRENCY_MIN,
+        maximum=max(maximum, settings.FEATHERJUDGE_CONCURRENCY_MIN),
+        latency_target=settings.FEATHERJUDGE_LATENCY_TARGET,
+        client=client,
+        tier=tier,
+    )
+
+def reset_state():
+    global _pid, _lock
+    _pid = None
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_state)
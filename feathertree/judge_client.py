@@ -0,0 +1,100 @@
+# HTTP client for the FeatherJudge (Baseten) endpoint.
+#
+# Every process keeps one requests.Session, so reviews reuse pooled keep-alive connections instead of paying
+# a TCP + TLS handshake per call. Sessions must not be shared across a fork (the child would inherit the
+# parent's sockets), so the session is dropped in forked children (Celery's prefork pool) and rebuilt on
+# first use.
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+_session = None
+_session_pid = None
+_pool_size = 0  # connections reserved beyond FEATHERJUDGE_POOL_SIZE (see reserve_connections)
+_lock = threading.Lock()
+
+
+# Review cascade tiers (see FEATHERJUDGE_SMALL_MODEL_ID): "small" is the cheap first-pass model, "large"
+# the full FeatherJudge model
+def judge_model_id(tier="large"):
+    return settings.FEATHERJUDGE_SMALL_MODEL_ID if tier == "small" else settings.FEATHERJUDGE_MODEL_ID
+
+
+# `urls` maps tiers to endpoints to use instead of the configured ones (e.g. a stand-in server for a load test)
+def judge_url(tier="large", urls=None):
+    if urls and tier in urls:
+        return urls[tier]
+    override = settings.FEATHERJUDGE_SMALL_URL if tier == "small" else settings.FEATHERJUDGE_URL
+    if override:
+        return override
+    return (
+        f"https://model-{judge_model_id(tier)}.api.baseten.co/"
+        f"{settings.BASETEN_DEPLOYMENT_TYPE}/predict"
+    )
+
+
+def judge_headers():
+    return {"Authorization": f"Api-Key {settings.BASETEN_API_KEY}"}
+
+
+def build_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=2,  # one host per cascade tier
+        pool_maxsize=max(settings.FEATHERJUDGE_POOL_SIZE, _pool_size),
+        max_retries=0,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(judge_headers())
+    return session
+
+
+def get_session():
+    global _session, _session_pid
+    # The pid check also covers forks that bypass os.register_at_fork (e.g. multiprocessing on some platforms)
+    if _session is None or _session_pid != os.getpid():
+        with _lock:
+            if _session is None or _session_pid != os.getpid():
+                _session = build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+# Keep room in this process's pool for `count` concurrent calls, for callers that run more at once than
+# FEATHERJUDGE_POOL_SIZE (e.g. rescore --parallel). A session with a smaller pool is replaced.
+def reserve_connections(count):
+    global _session, _pool_size
+    with _lock:
+        if count > max(settings.FEATHERJUDGE_POOL_SIZE, _pool_size):
+            _pool_size = count
+            _session = None
+
+
+def reset_session():
+    global _session, _session_pid, _lock
+    # Don't close the inherited session: its sockets still belong to the parent process
+    _session = None
+    _session_pid = None
+    _lock = threading.Lock()
+
+
+def judge_timeout():
+    return (settings.FEATHERJUDGE_CONNECT_TIMEOUT, settings.FEATHERJUDGE_READ_TIMEOUT)
+
+
+# POST a payload to FeatherJudge (the given cascade tier) and return the requests.Response
+def post_judge(payload, tier="large", urls=None):
+    return get_session().post(judge_url(tier, urls), json=payload, timeout=judge_timeout())
+
+
+# POST several payloads to a batch endpoint (e.g. FEATHERJUDGE_BATCH_URL), which answers {"texts": [...]}.
+# The read timeout is per call, and a batch takes about as long as its slowest prompt.
+def post_judge_batch(payloads, url):
+    return get_session().post(url, json={"batch": payloads}, timeout=judge_timeout())
+
+
+os.register_at_fork(after_in_child=reset_session)
@@ -0,0 +1,111 @@
+# Fitting story context into the FeatherJudge prompt.
+#
+# review_chapter used to send every ancestor's full text as "previous text", which overflows the model's
+# context on deep stories. build_previous_text keeps the nearest ancestors verbatim and falls back to short
+# excerpts for older ones, within a token budget measured by estimate_tokens, a cheap local stand-in for the
+# model's tokenizer that errs on the high side.
+import re
+
+# Word runs and single punctuation marks. BPE tokenizers split long words into several tokens, so every
+# WORD_CHARS_PER_TOKEN characters of a word count as one more.
+_PIECES = re.compile(r"\w+|[^\w\s]")
+WORD_CHARS_PER_TOKEN = 6
+
+OMITTED_MARKER = "[Earlier chapters omitted]"
+TRUNCATED_MARKER = " [...]"
+SUMMARY_HEADING = "[Summary of earlier chapters]"
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+class JudgePromptTooLong(ValueError):
+    pass
+
+
+def _piece_tokens(piece):
+    return 1 + (len(piece) - 1) // WORD_CHARS_PER_TOKEN
+
+def estimate_tokens(text):
+    return sum(_piece_tokens(piece) for piece in _PIECES.findall(text))
+
+
+# The longest prefix of `text` (or suffix, with from_end=True) estimated at no more than max_tokens
+def truncate_to_tokens(text, max_tokens, from_end=False):
+    pieces = list(_PIECES.finditer(text))
+    if from_end:
+        pieces.reverse()
+    used = 0
+    cut = None
+    for piece in pieces:
+        used += _piece_tokens(piece.group())
+        if used > max_tokens:
+            break
+        cut = piece.start() if from_end else piece.end()
+    else:
+        return text
+    if cut is None:
+        return ""
+    return text[cut:] if from_end else text[:cut]
+
+
+# Join ancestor texts (root first) into the judge's previous text within `budget` tokens. Ancestors are
+# taken nearest first and kept verbatim while they fit. The rest of the branch is then covered by the
+# rolling summary of the nearest ancestor that didn't fit, when `summaries` (parallel to ancestor_texts)
+# has one, or else by excerpts of at most `excerpt_tokens` tokens per chapter, with OMITTED_MARKER standing
+# in for whatever still doesn't fit. If even the parent doesn't fit, its ending (the part the new chapter
+# continues from) is kept.
+def build_previous_text(ancestor_texts, budget, excerpt_tokens=150, summaries=None):
+    marker_cost = estimate_tokens(OMITTED_MARKER) + estimate_tokens(TRUNCATED_MARKER)
+    remaining = budget - marker_cost
+    kept = []
+    verbatim = True
+    summaries = list(reversed(summaries)) if summaries else []
+    for index, text in enumerate(reversed(ancestor_texts)):
+        cost = estimate_tokens(text)
+        if verbatim and cost <= remaining:
+            kept.append(text)
+            remaining -= cost
+            continue
+        if index == 0:
+            kept.append(TRUNCATED_MARKER.strip() + " " + truncate_to_tokens(text, max(remaining, 0), from_end=True))
+            remaining = 0
+            verbatim = False
+            continue
+        if verbatim and index < len(summaries) and summaries[index]:
+            # Keep the most recent part of the summary if it's too long
+            remaining += estimate_tokens(OMITTED_MARKER) - estimate_tokens(SUMMARY_HEADING)
+            summary = truncate_to_tokens(summaries[index], max(remaining, 0), from_end=True)
+            kept.append(f"{SUMMARY_HEADING}\n{summary}" if summary else OMITTED_MARKER)
+            break
+        verbatim = False
+        excerpt = truncate_to_tokens(text, min(excerpt_tokens, remaining))
+        if not excerpt:
+            kept.append(OMITTED_MARKER)
+            break
+        kept.append(excerpt + TRUNCATED_MARKER if excerpt != text else text)
+        remaining -= estimate_tokens(excerpt) + (estimate_tokens(TRUNCATED_MARKER) if excerpt != text else 0)
+    return "".join(text + "\n" for text in reversed(kept))
+
+
+# Rolling summaries. Each chapter contributes one extractive line (its opening sentence and, for longer
+# chapters, its closing one); a chapter's summary is its parent's lines plus its own. When that exceeds
+# `budget` tokens the oldest lines after the story's opening line are dropped, so the summary keeps the
+# setup and the most recent events.
+def summary_line(text, line_tokens):
+    sentences = [sentence for sentence in _SENTENCE_END.split(" ".join(text.split())) if sentence]
+    if not sentences:
+        return ""
+    line = sentences[0] if len(sentences) == 1 else f"{sentences[0]} ... {sentences[-1]}"
+    shortened = truncate_to_tokens(line, line_tokens)
+    return shortened if shortened == line else shortened + TRUNCATED_MARKER
+
+def roll_summary(parent_summary, text, budget, line_tokens):
+    lines = parent_summary.splitlines() if parent_summary else []
+    line = summary_line(text, line_tokens)
+    if line:
+        lines.append(line)
+    costs = [estimate_tokens(line) for line in lines]
+    total = sum(costs)
+    while len(lines) > 2 and total > budget:
+        total -= costs.pop(1)
+        del lines[1]
+    return truncate_to_tokens("\n".join(lines), budget, from_end=True)
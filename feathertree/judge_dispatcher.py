@@ -0,0 +1,217 @@
+# asyncio dispatcher for FeatherJudge calls (FEATHERJUDGE_DISPATCH = "async").
+#
+# A judge call is almost all network wait, so blocking a Celery process on each one caps review throughput
+# at the number of worker processes. In async mode review_chapter only prepares the payload and hands it to
+# this process's dispatcher: an event loop on a background thread with up to FEATHERJUDGE_MAX_IN_FLIGHT
+# calls per cascade tier in flight (fewer while the adaptive limit in judge_breaker.py backs off) over one httpx connection
+# pool, each bounded by FEATHERJUDGE_CALL_DEADLINE seconds from submission. Verdicts are queued to a writer thread that saves them in batches (tasks.apply_review_results).
+#
+# A review that is lost with its process (e.g. a hard kill) leaves the chapter submitted_for_review with a
+# review claim that goes stale; the periodic tasks.requeue_stale_reviews sweep queues it again.
+import asyncio
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import httpx
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.db import close_old_connections
+
+from .helpers import judge_verdict_key, parse_featherjudge_response, should_escalate
+from .judge_breaker import JudgeUnavailable, get_breaker, new_limiter
+from .judge_client import judge_headers, judge_url
+from .metrics import JUDGE_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_dispatcher = None
+_dispatcher_pid = None
+_lock = threading.Lock()
+
+
+class JudgeDispatcher:
+    def __init__(self, write_results, max_in_flight, deadline, write_batch_size, write_interval):
+        self.write_results = write_results
+        self.max_in_flight = max_in_flight
+        self.deadline = deadline
+        self.write_batch_size = write_batch_size
+        self.write_interval = write_interval
+
+        self.results = queue.Queue()
+        # Group key -> event set when the first review of that group in flight has its answer (loop thread only)
+        self.warming = {}
+        self.outstanding = 0  # submitted but not yet written
+        self.idle = threading.Condition()
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="judge-dispatcher", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+        threading.Thread(target=self._write_loop, name="judge-verdict-writer", daemon=True).start()
+
+    async def _setup(self):
+        # Concurrency follows the adaptive limit (at most max_in_flight); waiters are woken as calls finish
+        # One limiter per cascade tier, created on first use (loop thread only)
+        self.limiters = {}
+        self.slots = asyncio.Condition()
+        self.client = httpx.AsyncClient(
+            headers=judge_headers(),
+            limits=httpx.Limits(max_connections=self.max_in_flight, max_keepalive_connections=self.max_in_flight),
+            timeout=httpx.Timeout(settings.FEATHERJUDGE_READ_TIMEOUT, connect=settings.FEATHERJUDGE_CONNECT_TIMEOUT),
+        )
+
+    # Queue the review of `chapter_id` through the given cascade tiers (escalating from one to the next like
+    # helpers.query_judge_cascade). Returns at once; the verdict reaches write_results as (chapter_id, verdict
+    # key of the deciding tier, (score, feedback, tier) or the exception the call raised, review). Reviews
+    # with the same `group` (parent chapter) share a prompt prefix; see FEATHERJUDGE_DISPATCH_ORDER.
+    # `review` holds the caller's review_chapter arguments: its "urls" override judge endpoints (see
+    # judge_client.judge_url), and it is passed through for the caller's retry accounting.
+    def submit(self, chapter_id, payload, tiers, group=None, review=None):
+        review = review or {}
+        with self.idle:
+            self.outstanding += 1
+        asyncio.run_coroutine_threadsafe(self._judge(chapter_id, payload, tiers, group, review), self.loop)
+
+    async def _judge(self, chapter_id, payload, tiers, group, review):
+        # The deadline covers every tier the review goes through
+        deadline = time.monotonic() + self.deadline
+        warming = await self._wait_for_leader(group, deadline)
+        urls = review.get("urls")
+        for tier in tiers:
+            key = judge_verdict_key(payload, tier, urls)
+            try:
+                result = await asyncio.wait_for(self._call(payload, tier, urls), max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                result = TimeoutError(f"FeatherJudge call exceeded its {self.deadline}s deadline")
+            except Exception as e:
+                result = e
+            if warming is not None:
+                # The server has this group's prefix cached now; let the siblings go
+                warming.set()
+                del self.warming[group]
+                warming = None
+            # An unavailable first-pass model escalates; the deadline covers every tier, so a timeout doesn't
+            if tier == tiers[-1] or isinstance(result, TimeoutError):
+                break
+            if not isinstance(result, Exception) and not should_escalate(tier, result[0]):
+                break
+        if not isinstance(result, Exception):
+            result = (*result, tier)
+        self.results.put((chapter_id, key, result, review))
+
+    # With the "siblings" order, the first review of a group returns an event to set once it has its answer;
+    # later ones wait for the first (within their deadline) so they hit the server's cached prompt prefix
+    async def _wait_for_leader(self, group, deadline):
+        if group is None or settings.FEATHERJUDGE_DISPATCH_ORDER != "siblings":
+            return None
+        leader = self.warming.get(group)
+        if leader is None:
+            self.warming[group] = asyncio.Event()
+            return self.warming[group]
+        try:
+            await asyncio.wait_for(leader.wait(), max(0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            pass
+        return None
+
+    async def _call(self, payload, tier, urls=None):
+        limiter = self.limiters.get(tier)
+        if limiter is None:
+            limiter = self.limiters[tier] = new_limiter(self.max_in_flight, client="async", tier=tier)
+        async with self.slots:
+            await self.slots.wait_for(limiter.try_acquire)
+        breaker = get_breaker(tier)
+        try:
+            breaker.before_call()
+        except JudgeUnavailable:
+            limiter.abandon()
+            await self._wake_waiters()
+            raise
+
+        healthy = False
+        status = "error"
+        start = time.monotonic()
+        try:
+            resp = await self.client.post(judge_url(tier, urls), json=payload)
+            status = str(resp.status_code)
+            healthy = resp.status_code < 500 and resp.status_code != 429
+        except (httpx.TimeoutException, asyncio.CancelledError):
+            # Cancelled by wait_for when the call deadline passes
+            status = "timeout"
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            JUDGE_REQUEST_SECONDS.labels(tier=tier, status=status).observe(elapsed)
+            limiter.release(elapsed, healthy)
+            if healthy:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+            await self._wake_waiters()
+
+        resp.raise_for_status()
+        text = resp.json().get("text")
+        if text is None:
+            raise KeyError("Missing 'text' in Baseten response")
+        return parse_featherjudge_response(text)
+
+    async def _wake_waiters(self):
+        async with self.slots:
+            self.slots.notify_all()
+
+    # Collect verdicts for up to write_interval seconds (or write_batch_size of them) and save them together
+    def _write_loop(self):
+        while True:
+            batch = [self.results.get()]
+            flush_at = time.monotonic() + self.write_interval
+            while len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self.results.get(timeout=max(0, flush_at - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write_results(batch)
+            except Exception:
+                logger.exception("Could not save %d judge verdicts", len(batch))
+            finally:
+                close_old_connections()
+                with self.idle:
+                    self.outstanding -= len(batch)
+                    self.idle.notify_all()
+
+    # Wait until every submitted review has been written, or `timeout` seconds pass. Returns True if idle.
+    def drain(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: self.outstanding == 0, timeout)
+
+
+# This process's dispatcher, started on first use. Like the judge_client session it is never shared across
+# a fork: the pid check starts a fresh one (threads don't survive a fork anyway).
+def get_dispatcher():
+    global _dispatcher, _dispatcher_pid
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        with _lock:
+            if _dispatcher is None or _dispatcher_pid != os.getpid():
+                from .tasks import apply_review_results
+                _dispatcher = JudgeDispatcher(
+                    apply_review_results,
+                    max_in_flight=settings.FEATHERJUDGE_MAX_IN_FLIGHT,
+                    deadline=settings.FEATHERJUDGE_CALL_DEADLINE,
+                    write_batch_size=settings.FEATHERJUDGE_WRITE_BATCH_SIZE,
+                    write_interval=settings.FEATHERJUDGE_WRITE_INTERVAL,
+                )
+                _dispatcher_pid = os.getpid()
+    return _dispatcher
+
+
+# Let in-flight reviews finish (up to one call deadline) before a worker process exits
+def drain_dispatcher(**kwargs):
+    if _dispatcher is not None and _dispatcher_pid == os.getpid():
+        if not _dispatcher.drain(timeout=settings.FEATHERJUDGE_CALL_DEADLINE):
+            logger.warning("Exiting with %d judge calls unfinished", _dispatcher.outstanding)
+
+atexit.register(drain_dispatcher)
+worker_process_shutdown.connect(drain_dispatcher)
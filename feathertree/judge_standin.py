@@ -0,0 +1,186 @@
+# A local stand-in for the FeatherJudge endpoint, for tests, benchmarks and load/soak testing without
+# spending Baseten credit. It implements the /predict contract used by call_featherjudge (POST a payload,
+# get {"text": "<feedback>...</feedback>\n<score>N</score>"}), plus {"batch": [...]} -> {"texts": [...]}
+# for batch deployments, and speaks HTTP/1.1 so clients can keep connections alive between calls.
+#
+# Behaviour is configurable:
+#   latency      seconds per response, or a distribution spec (see parse_latency)
+#   error_rate   fraction of requests answered with error_status (default 500)
+#   timeout_rate fraction of requests that stall for `hang` seconds, so the client times out
+#   capacity     how many requests are "on the GPU" at once; the rest queue (a throughput cap)
+#   scores       scores to pick verdicts from
+#   prefill      seconds per thousand prompt tokens the server has to compute before answering
+#   prefix_cache how many prompt blocks to keep cached (LRU); a prompt only pays prefill for the part after its
+#                longest cached prefix, like automatic prefix caching in vLLM
+# Run one on its own with `manage.py judge_standin`, or in-process with start_standin().
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STANDIN_FEEDBACK = {
+    1: "The continuation has nothing to do with the story so far.",
+    2: "The continuation drifts away from the story's tone and events.",
+    3: "The continuation mostly fits, with a few jarring elements.",
+    4: "The continuation follows on naturally.",
+    5: "The continuation is seamless in tone, theme and plot.",
+}
+
+
+def standin_verdict(score):
+    return f"<feedback>{STANDIN_FEEDBACK[score]}</feedback>\n<score>{score}</score>"
+
+STANDIN_VERDICT = standin_verdict(4)
+
+PREFIX_BLOCK_CHARS = 64  # prefix cache granularity
+CHARS_PER_TOKEN = 4
+
+
+# A latency sampler from a spec: a number of seconds, or "uniform:LOW,HIGH", "normal:MEAN,SD",
+# "lognormal:MEDIAN,SIGMA" or "exponential:MEAN". Samples are never negative.
+def parse_latency(spec, rng):
+    if isinstance(spec, (int, float)):
+        return lambda: float(spec)
+    kind, _, args = str(spec).partition(":")
+    if not args:
+        value = float(kind)
+        return lambda: value
+    params = [float(arg) for arg in args.split(",")]
+    samplers = {
+        "uniform": lambda low, high: rng.uniform(low, high),
+        "normal": lambda mean, sd: rng.gauss(mean, sd),
+        "lognormal": lambda median, sigma: median * rng.lognormvariate(0, sigma),
+        "exponential": lambda mean: rng.expovariate(1 / mean),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown latency distribution {kind!r}; use one of {', '.join(samplers)}")
+    sample = samplers[kind]
+    return lambda: max(0.0, sample(*params))
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; with Nagle on, keep-alive clients stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        with server.lock:
+            server.requests_served += 1
+        roll = server.rng.random()
+
+        if roll < server.timeout_rate:
+            with server.lock:
+                server.timeouts_injected += 1
+            time.sleep(server.hang)
+            self.close_connection = True
+            return
+
+        # A batch is answered in one go, like batched inference on a GPU
+        with server.capacity:
+            for payload in request.get("batch", [request]):
+                server.prefill(payload.get("prompt", ""))
+            time.sleep(server.sample_latency())
+
+        if roll < server.timeout_rate + server.error_rate:
+            with server.lock:
+                server.errors_injected += 1
+            self.respond(server.error_status, {"error": "injected failure"})
+        elif "batch" in request:
+            self.respond(200, {"texts": [server.verdict() for _ in request["batch"]]})
+        else:
+            self.respond(200, {"text": server.verdict()})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, error_rate=0.0, timeout_rate=0.0, hang=600.0,
+                 capacity=None, scores=(4,), error_status=500, seed=None, prefill=0.0, prefix_cache=0):
+        # Parse the latency spec before binding, so a bad spec doesn't leave a socket open
+        self.rng = random.Random(seed)
+        self.sample_latency = parse_latency(latency, self.rng)
+        super().__init__(address, StandinHandler)
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.error_status = error_status
+        self.capacity = threading.BoundedSemaphore(capacity) if capacity else _Unlimited()
+        self.scores = list(scores)
+        self.requests_served = 0
+        self.errors_injected = 0
+        self.timeouts_injected = 0
+        self.prefill_per_1k = prefill
+        self.prefix_cache_size = prefix_cache
+        self.prefix_cache = OrderedDict()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.lock = threading.Lock()
+
+    # Spend the prefill time for `prompt`'s uncached blocks, then cache all of its blocks. Blocks are keyed by
+    # the whole prefix up to them, so a block only matches after an identical prefix.
+    def prefill(self, prompt):
+        keys = []
+        key = None
+        for start in range(0, len(prompt) - PREFIX_BLOCK_CHARS + 1, PREFIX_BLOCK_CHARS):
+            key = hash((key, prompt[start:start + PREFIX_BLOCK_CHARS]))
+            keys.append(key)
+        with self.lock:
+            cached = 0
+            if self.prefix_cache_size:
+                while cached < len(keys) and keys[cached] in self.prefix_cache:
+                    self.prefix_cache.move_to_end(keys[cached])
+                    cached += 1
+            cached_chars = cached * PREFIX_BLOCK_CHARS
+            self.prompt_tokens += len(prompt) // CHARS_PER_TOKEN
+            self.cached_tokens += cached_chars // CHARS_PER_TOKEN
+        time.sleep((len(prompt) - cached_chars) / CHARS_PER_TOKEN / 1000 * self.prefill_per_1k)
+        if self.prefix_cache_size:
+            with self.lock:
+                for key in keys:
+                    self.prefix_cache[key] = True
+                    self.prefix_cache.move_to_end(key)
+                while len(self.prefix_cache) > self.prefix_cache_size:
+                    self.prefix_cache.popitem(last=False)
+
+    def verdict(self):
+        return standin_verdict(self.rng.choice(self.scores))
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/predict"
+
+    @property
+    def batch_url(self):
+        return self.url.replace("/predict", "/predict_batch")
+
+
+class _Unlimited:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+# Start a stand-in on a free local port in a background thread. Call .shutdown() when done.
+def start_standin(**options):
+    server = StandinServer(**options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from feathertree.helpers import query_judge, query_judge_batch
+from feathertree.judge_standin import start_standin
+
+
+# Compares judging reviews one at a time (one review_chapter task per chapter on a single worker) with
+# batched flushes: a concurrent fan-out over the pooled session, and a single request to a batch endpoint.
+# Runs against the local stand-in, whose --latency plays the part of model inference time.
+class Command(BaseCommand):
+    help = "Benchmark per-chapter vs. batched judge calls against a local stand-in server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reviews", type=int, default=64, help="Number of reviews to judge.")
+        parser.add_argument("--batch-size", type=int, default=16, help="Reviews per batch.")
+        parser.add_argument("--fanout", type=int, default=8, help="Concurrent calls in fan-out mode.")
+        parser.add_argument("--latency", type=float, default=0.2, help="Stand-in response time in seconds.")
+
+    def handle(self, *args, **options):
+        server = start_standin(latency=options["latency"])
+        pairs = [(f"Chapter {n} so far. " * 50, f"Continuation {n}. " * 30) for n in range(options["reviews"])]
+        size = options["batch_size"]
+        batches = [pairs[i:i + size] for i in range(0, len(pairs), size)]
+        # The large model only, on the stand-in, without the verdict cache
+        common = {"use_cache": False, "urls": {"large": server.url}}
+        fanout_options = {"max_workers": max(options["fanout"], 1), "tiers": ["large"], **common}
+        try:
+            single = self.timed(lambda: [query_judge(*pair, **common) for pair in pairs])
+            fanout = self.timed(lambda: [query_judge_batch(batch, **fanout_options) for batch in batches])
+            batched = self.timed(
+                lambda: [query_judge_batch(batch, batch_url=server.batch_url, **fanout_options) for batch in batches]
+            )
+        finally:
+            server.shutdown()
+
+        reviews = len(pairs)
+        self.stdout.write(f"{reviews} reviews, batches of {size}, {options['latency'] * 1000:.0f} ms per call")
+        for label, seconds in [("one call per review", single), ("batched fan-out", fanout), ("batch endpoint", batched)]:
+            self.stdout.write(f"{label:20} {seconds:7.2f} s   {reviews / seconds:8.1f} reviews/s")
+        self.stdout.write(self.style.SUCCESS(
+            f"throughput gain: {single / fanout:.1f}x (fan-out), {single / batched:.1f}x (batch endpoint)"
+        ))
+
+    def timed(self, run):
+        start = time.perf_counter()
+        run()
+        return time.perf_counter() - start
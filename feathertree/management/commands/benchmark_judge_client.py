@@ -0,0 +1,51 @@
+import statistics
+import time
+
+import requests
+from django.core.management.base import BaseCommand
+
+from feathertree.judge_client import build_session, judge_timeout
+from feathertree.judge_standin import start_standin
+
+
+# Compares a fresh connection per FeatherJudge call (the old requests.post) with the pooled keep-alive
+# session from judge_client, against a local stand-in server. Over plain local HTTP only the TCP handshake is
+# saved; against Baseten each reused connection also skips a TLS handshake, so real savings are larger.
+class Command(BaseCommand):
+    help = "Benchmark per-call connections vs. the pooled judge client against a local stand-in server"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=500, help="Judge calls per client.")
+        parser.add_argument("--latency", type=float, default=0.0, help="Stand-in response delay in seconds.")
+
+    def handle(self, *args, **options):
+        server = start_standin(latency=options["latency"])
+        payload = {"prompt": "x" * 4000, "max_tokens": 512}
+        try:
+            fresh = self.time_calls(options["calls"], lambda: requests.post(
+                server.url, json=payload, timeout=judge_timeout()
+            ))
+            session = build_session()
+            pooled = self.time_calls(options["calls"], lambda: session.post(
+                server.url, json=payload, timeout=judge_timeout()
+            ))
+        finally:
+            server.shutdown()
+
+        self.report("new connection per call", fresh)
+        self.report("pooled keep-alive session", pooled)
+        saved = (statistics.mean(fresh) - statistics.mean(pooled)) * 1000
+        self.stdout.write(self.style.SUCCESS(f"saved per call: {saved:.3f} ms (mean)"))
+
+    def time_calls(self, calls, call):
+        timings = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            call().raise_for_status()
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    def report(self, label, timings):
+        p50 = statistics.median(timings) * 1000
+        mean = statistics.mean(timings) * 1000
+        self.stdout.write(f"{label:26} mean {mean:7.3f} ms   p50 {p50:7.3f} ms")
@@ -0,0 +1,76 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from feathertree.helpers import build_judge_payload, previous_text_budget, query_judge_batch
+from feathertree.judge_context import truncate_to_tokens
+from feathertree.judge_standin import PREFIX_BLOCK_CHARS, start_standin
+
+
+# Compares FEATHERJUDGE_DISPATCH_ORDER "fifo" and "siblings" on a burst of reviews where several
+# continuations of the same chapter arrive interleaved with other stories' submissions. The stand-in charges
+# prefill time for every prompt token outside its prefix cache, so siblings sent after their first one has
+# been answered only pay for their own text, as long as the prefix hasn't been evicted from the (LRU) cache
+# by the time they arrive.
+class Command(BaseCommand):
+    help = "Benchmark sibling-grouped vs. FIFO judge dispatch against a stand-in that simulates prefix caching"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--parents", type=int, default=24, help="Chapters being continued.")
+        parser.add_argument("--siblings", type=int, default=4, help="Submissions continuing each chapter.")
+        parser.add_argument("--prefix-words", type=int, default=2000, help="Length of each story so far, in words.")
+        parser.add_argument(
+            "--cache-stories", type=int, default=12, help="Stand-in prefix cache size, in stories' worth of prompt.",
+        )
+        parser.add_argument("--prefill", type=float, default=0.3, help="Stand-in seconds per 1k uncached prompt tokens.")
+        parser.add_argument("--latency", type=float, default=0.3, help="Stand-in decode time per response (seconds).")
+        parser.add_argument("--capacity", type=int, default=8, help="Requests the stand-in processes at once.")
+        parser.add_argument("--fanout", type=int, default=8, help="Concurrent judge calls.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        pairs, groups = self.synthetic_burst(options, random.Random(options["seed"]))
+        prompt_blocks = len(build_judge_payload(*pairs[0])["prompt"]) // PREFIX_BLOCK_CHARS
+        self.stdout.write(f"{len(pairs)} reviews: {options['parents']} chapters x {options['siblings']} continuations")
+
+        runs = {}
+        for order in ("fifo", "siblings"):
+            server = start_standin(
+                latency=options["latency"], prefill=options["prefill"],
+                prefix_cache=prompt_blocks * options["cache_stories"],
+                capacity=options["capacity"],
+            )
+            try:
+                start = time.perf_counter()
+                query_judge_batch(
+                    pairs, groups=groups, order=order, use_cache=False, urls={"large": server.url},
+                    tiers=["large"], max_workers=options["fanout"],
+                )
+                seconds = time.perf_counter() - start
+            finally:
+                server.shutdown()
+            runs[order] = seconds
+            hit_rate = server.cached_tokens / server.prompt_tokens if server.prompt_tokens else 0
+            self.stdout.write(
+                f"{order:9} {seconds:7.2f} s   {len(pairs) / seconds:6.1f} reviews/s   "
+                f"prefix cache hits {hit_rate:6.1%} of prompt tokens"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"sibling grouping: {1 - runs['siblings'] / runs['fifo']:.1%} less time for the burst"
+        ))
+
+    # Submissions in arrival order: round-robin over the parents, so siblings are never adjacent
+    def synthetic_burst(self, options, rng):
+        vocabulary = [f"word{n}" for n in range(5000)]
+        stories = [
+            " ".join(rng.choice(vocabulary) for _ in range(options["prefix_words"])) for _ in range(options["parents"])
+        ]
+        pairs = []
+        groups = []
+        for _ in range(options["siblings"]):
+            for parent, story in enumerate(stories):
+                current_text = " ".join(rng.choice(vocabulary) for _ in range(200))
+                pairs.append((truncate_to_tokens(story, previous_text_budget(current_text), from_end=True), current_text))
+                groups.append(parent)
+        return pairs, groups
@@ -0,0 +1,73 @@
+import random
+import time
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+
+from feathertree.helpers import build_chapter_tree, flatten_chapter_tree
+from feathertree.models import User, Chapter
+
+
+# Compares the recursive {% include %} chapter tree with the flat single-loop template on a synthetic story.
+# Nothing touches the database: chapters are unsaved instances with ids filled in by hand.
+class Command(BaseCommand):
+    help = "Benchmark recursive vs. flat chapter tree rendering on a synthetic story"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nodes", type=int, default=10000, help="Number of chapters in the synthetic story.")
+        parser.add_argument("--repeat", type=int, default=5, help="Renders per template; the best run is reported.")
+        parser.add_argument("--seed", type=int, default=1, help="Random seed for the tree shape.")
+
+    def handle(self, *args, **options):
+        chapters = self.synthetic_story(options["nodes"], random.Random(options["seed"]))
+        max_depth = max(chapter.depth for chapter in chapters)
+        self.stdout.write(f"Synthetic story: {len(chapters)} chapters, max depth {max_depth}")
+
+        recursive = self.best_of(options["repeat"], lambda: render_to_string(
+            "feathertree/_chapter_tree.html", {"nodes": build_chapter_tree(chapters), "level": 0}
+        ))
+        flat = self.best_of(options["repeat"], lambda: render_to_string(
+            "feathertree/_chapter_tree_flat.html", {"rows": flatten_chapter_tree(chapters)}
+        ))
+
+        self.stdout.write(f"recursive include: {recursive * 1000:9.1f} ms")
+        self.stdout.write(f"flat loop:         {flat * 1000:9.1f} ms")
+        self.stdout.write(self.style.SUCCESS(f"speedup: {recursive / flat:.2f}x"))
+
+    def best_of(self, repeat, render):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            render()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    # A random recursive tree (each chapter continues a uniformly chosen earlier one), returned in pre-order
+    def synthetic_story(self, size, rng):
+        authors = [User(id=i, display_name=f"author{i}") for i in range(1, 21)]
+        timestamp = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+        children = {None: []}
+        for pk in range(1, size + 1):
+            parent_id = rng.randint(1, pk - 1) if pk > 1 else None
+            children[parent_id].append(pk)
+            children[pk] = []
+
+        chapters = []
+        stack = [(pk, None, 0) for pk in reversed(children[None])]
+        while stack:
+            pk, parent_id, depth = stack.pop()
+            chapter = Chapter(
+                id=pk,
+                title=f"Chapter {pk}",
+                ordinal=depth + 1,
+                depth=depth,
+                preorder=len(chapters),
+                previous_chapter_id=parent_id,
+                author=rng.choice(authors),
+                timestamp=timestamp,
+            )
+            chapters.append(chapter)
+            stack.extend((child, pk, depth + 1) for child in reversed(children[pk]))
+        return chapters
@@ -0,0 +1,109 @@
+import ast
+import json
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from feathertree.helpers import build_judge_payload, call_featherjudge, parse_featherjudge_response, should_escalate
+
+
+# Offline evaluation of the review cascade (FEATHERJUDGE_SMALL_MODEL_ID). Every fixture pair is scored by
+# both the small and the large model; the cascade's decision (the small score unless it falls in the
+# ambiguous band) is compared with the large model's, and the calls it saves are priced with --small-cost.
+# Fixtures are the previous_text / current_text_* passages of feather_judge_example.py, read with ast because
+# that script posts to the live endpoint when imported, plus any pairs from --fixtures.
+class Command(BaseCommand):
+    help = "Compare the small-then-large judge cascade with the large model alone on fixture passages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--example", default=str(Path(settings.BASE_DIR) / "feather_judge_example.py"),
+            help="Script to read fixture passages from.",
+        )
+        parser.add_argument(
+            "--fixtures", help='JSON file with more pairs: [{"previous_text": ..., "current_text": ...}, ...].',
+        )
+        parser.add_argument("--small-url", help="Small model endpoint (default: FEATHERJUDGE_SMALL_URL or its model ID).")
+        parser.add_argument("--large-url", help="Large model endpoint (default: FEATHERJUDGE_URL or its model ID).")
+        parser.add_argument(
+            "--small-cost", type=float, default=0.2, help="Cost of a small model call relative to a large one.",
+        )
+
+    def handle(self, *args, **options):
+        pairs = self.example_pairs(options["example"])
+        if options["fixtures"]:
+            with open(options["fixtures"]) as f:
+                pairs += [(f"fixture {n}", p["previous_text"], p["current_text"]) for n, p in enumerate(json.load(f))]
+        if not pairs:
+            raise CommandError("No fixture pairs found.")
+
+        if not (settings.FEATHERJUDGE_SMALL_MODEL_ID or settings.FEATHERJUDGE_SMALL_URL or options["small_url"]):
+            raise CommandError("Set FEATHERJUDGE_SMALL_MODEL_ID or pass --small-url.")
+        urls = {tier: options[f"{tier}_url"] for tier in ("small", "large") if options[f"{tier}_url"]}
+        rows = [
+            self.evaluate(name, previous_text, current_text, urls) for name, previous_text, current_text in pairs
+        ]
+
+        scored = [row for row in rows if row["large"] is not None]
+        if not scored:
+            raise CommandError("The large model returned no usable scores.")
+        n = len(scored)
+        escalated = sum(row["tier"] == "large" for row in scored)
+        exact = sum(row["cascade"] == row["large"] for row in scored)
+        # Publishing threshold used by tasks.apply_review
+        decisions = sum((row["cascade"] > 2) == (row["large"] > 2) for row in scored)
+        cascade_cost = n * options["small_cost"] + escalated
+        cascade_time = sum(row["small_time"] + (row["large_time"] if row["tier"] == "large" else 0) for row in scored)
+        large_time = sum(row["large_time"] for row in scored)
+
+        self.stdout.write(f"{n} pairs scored, {escalated} escalated to the large model")
+        self.stdout.write(f"score agreement:    {exact / n:7.1%}")
+        self.stdout.write(f"publish agreement:  {decisions / n:7.1%}")
+        self.stdout.write(f"relative cost:      {cascade_cost / n:7.2f} (large model alone = 1.00)")
+        self.stdout.write(f"judge time:         {cascade_time:7.2f} s (large model alone {large_time:.2f} s)")
+        self.stdout.write(self.style.SUCCESS(f"cost savings: {1 - cascade_cost / n:.1%}"))
+
+    # (name, previous_text, current_text) for each current_text_* string in the example script
+    def example_pairs(self, path):
+        try:
+            tree = ast.parse(Path(path).read_text())
+        except (OSError, SyntaxError) as e:
+            raise CommandError(f"Could not read {path}: {e}")
+        strings = {}
+        for node in tree.body:
+            if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+                for target in node.targets:
+                    if isinstance(target, ast.Name):
+                        strings[target.id] = node.value.value
+        previous_text = strings.get("previous_text")
+        if previous_text is None:
+            return []
+        return [
+            (name, previous_text, text) for name, text in strings.items() if name.startswith("current_text")
+        ]
+
+    def evaluate(self, name, previous_text, current_text, urls):
+        payload = build_judge_payload(previous_text, current_text)
+        small, small_time = self.score(payload, "small", urls)
+        large, large_time = self.score(payload, "large", urls)
+        if small is None or should_escalate("small", small):
+            tier, cascade = "large", large
+        else:
+            tier, cascade = "small", small
+        self.stdout.write(f"{name:24} small {small}  large {large}  cascade {cascade} ({tier})")
+        return {
+            "small": small, "large": large, "cascade": cascade, "tier": tier,
+            "small_time": small_time, "large_time": large_time,
+        }
+
+    # (score, seconds), with a None score if the answer can't be used
+    def score(self, payload, tier, urls):
+        start = time.perf_counter()
+        try:
+            score, _ = parse_featherjudge_response(call_featherjudge(payload, tier, urls))
+        except Exception as e:
+            self.stderr.write(f"{tier} model: {e}")
+            score = None
+        return score, time.perf_counter() - start
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from feathertree.models import JudgeVerdict
+from feathertree.tasks import evict_judge_verdicts
+
+
+class Command(BaseCommand):
+    help = "Delete expired judge verdicts and the least recently used ones beyond FEATHERJUDGE_VERDICT_MAX_ENTRIES"
+
+    def handle(self, *args, **options):
+        deleted = evict_judge_verdicts()
+        remaining = JudgeVerdict.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Evicted {deleted} verdicts ({remaining} remain)."))
@@ -0,0 +1,176 @@
+import random
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from feathertree.helpers import judge_tiers
+from feathertree.judge_dispatcher import get_dispatcher
+from feathertree.judge_standin import start_standin
+from feathertree_project.celery import app as celery_app
+from feathertree.models import Story, Chapter
+from feathertree.tasks import request_review, review_chapter
+
+
+# Pushes N synthetic chapter submissions through the review pipeline and reports end-to-end latency
+# (from each review's submission to its saved verdict, as seen by polling every --poll seconds) and
+# throughput. By default reviews run in this process on --concurrency
+# threads, standing in for worker processes, against an in-process stand-in server, and follow-up tasks
+# (chapter summaries) run inline too. --celery queues them to the real workers instead (they must be pointed
+# at the same judge, e.g. a `manage.py judge_standin`).
+# The synthetic story is deleted afterwards unless --keep is given.
+class Command(BaseCommand):
+    help = "Load-test review_chapter against a FeatherJudge stand-in and report latency percentiles and tasks/s"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chapters", type=int, default=200, help="Number of synthetic submissions.")
+        parser.add_argument("--concurrency", type=int, default=8, help="Review threads in inline mode.")
+        parser.add_argument("--celery", action="store_true", help="Queue reviews to Celery workers instead.")
+        parser.add_argument("--url", help="Judge URL to use instead of starting an in-process stand-in.")
+        parser.add_argument("--latency", default="lognormal:0.2,0.5", help="Stand-in latency (see judge_standin).")
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--timeout-rate", type=float, default=0.0)
+        parser.add_argument("--capacity", type=int, default=None)
+        parser.add_argument("--deadline", type=float, default=600, help="Give up on unfinished reviews after this many seconds.")
+        parser.add_argument("--poll", type=float, default=0.01, help="Seconds between checks for saved verdicts.")
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic story and chapters.")
+
+    def handle(self, *args, **options):
+        server = None
+        url = options["url"]
+        if url is None:
+            server = start_standin(
+                latency=options["latency"],
+                error_rate=options["error_rate"],
+                timeout_rate=options["timeout_rate"],
+                hang=options["deadline"],
+                capacity=options["capacity"],
+                scores=(2, 3, 4, 5),
+            )
+            url = server.url
+
+        # Inline mode runs follow-up tasks (from setup and cleanup too) here rather than through a broker
+        eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = eager or not options["celery"]
+        try:
+            story, chapter_ids = self.synthetic_submissions(options["chapters"])
+            try:
+                # Every cascade tier goes to the stand-in, and the verdict cache is left alone: the synthetic
+                # texts are unique, and their verdicts are no use to real reviews
+                urls = {tier: url for tier in judge_tiers()}
+                latencies, finished_in, elapsed, unfinished = self.run_reviews(chapter_ids, options, urls)
+                self.report(chapter_ids, latencies, finished_in, elapsed, unfinished, server, options["poll"])
+            finally:
+                if not options["keep"]:
+                    Chapter.objects.filter(story=story, previous_chapter__isnull=True).delete()
+                    story.delete()
+        finally:
+            celery_app.conf.task_always_eager = eager
+            if server is not None:
+                server.shutdown()
+
+    def synthetic_submissions(self, count):
+        run = uuid.uuid4().hex[:8]
+        rng = random.Random(run)
+        author, _ = get_user_model().objects.get_or_create(
+            email="loadtest@feathertree.invalid", defaults={"display_name": "loadtest", "is_active": False}
+        )
+        story = Story.objects.create(title=f"Load test {run}")
+        root = Chapter.objects.create(
+            story=story, author=author, ordinal=1, draft=False, content=f"Load test {run}. The story begins here."
+        )
+        chapter_ids = [
+            Chapter.objects.create(
+                story=story, author=author, ordinal=2, previous_chapter=root, submitted_for_review=True,
+                content=self.synthetic_text(rng, n, run),
+            ).pk
+            for n in range(count)
+        ]
+        return story, chapter_ids
+
+    # Random words, so submissions pass the local pre-screen (prescreen.py) and reach the judge
+    def synthetic_text(self, rng, n, run):
+        body = " ".join(f"word{rng.randrange(50000)}" for _ in range(150))
+        return f"Synthetic continuation {n} of load test {run}. {body}."
+
+    # Submit every review, then poll until each chapter's verdict is saved. Returns per-review latencies
+    # (saved minus submitted), the time from the start of the run to the last saved verdict, total wall time
+    # and the ids still unfinished at the deadline.
+    def run_reviews(self, chapter_ids, options, urls):
+        if options["celery"]:
+            return self.submit_and_poll(chapter_ids, options, request_review)
+
+        executor = ThreadPoolExecutor(max_workers=options["concurrency"])
+        try:
+            return self.submit_and_poll(
+                chapter_ids, options, lambda pk: executor.submit(self.review_inline, pk, urls)
+            )
+        finally:
+            # Reviews still running (and, in async dispatch, verdicts still being written) would otherwise
+            # write to chapters the cleanup is deleting
+            executor.shutdown(wait=True, cancel_futures=True)
+            if settings.FEATHERJUDGE_DISPATCH == "async":
+                get_dispatcher().drain(timeout=settings.FEATHERJUDGE_CALL_DEADLINE)
+
+    def submit_and_poll(self, chapter_ids, options, submit):
+        start = time.monotonic()
+        submitted = {}
+        for chapter_id in chapter_ids:
+            submitted[chapter_id] = time.monotonic()
+            submit(chapter_id)
+
+        latencies = []
+        last_saved = None
+        pending = set(chapter_ids)
+        deadline = start + options["deadline"]
+        while pending and time.monotonic() < deadline:
+            done = set(
+                Chapter.objects.filter(pk__in=pending, submitted_for_review=False).values_list("pk", flat=True)
+            )
+            now = time.monotonic()
+            latencies += [now - submitted[chapter_id] for chapter_id in done]
+            if done:
+                last_saved = now - start
+            pending -= done
+            if pending:
+                time.sleep(options["poll"])
+        return latencies, last_saved, time.monotonic() - start, pending
+
+    def review_inline(self, chapter_id, urls):
+        try:
+            # apply() runs the task here, retries included, as a worker would
+            review_chapter.apply(args=(chapter_id,), kwargs={"urls": urls, "use_cache": False})
+        finally:
+            close_old_connections()
+
+    def report(self, chapter_ids, latencies, finished_in, elapsed, unfinished, server, poll):
+        # Verdicts saved while in-flight reviews were wound down after the deadline don't count
+        outcomes = Chapter.objects.filter(pk__in=set(chapter_ids) - unfinished)
+        published = outcomes.filter(draft=False).count()
+        errored = outcomes.filter(draft=True, submitted_for_review=False, score=0).count()
+        # Throughput up to the last completed review, so stragglers left at the deadline don't dilute it
+        finished_in = finished_in or elapsed
+        self.stdout.write(
+            f"{len(latencies)} of {len(chapter_ids)} reviews finished in {finished_in:.2f} s: "
+            f"{len(latencies) / finished_in:.1f} tasks/s"
+        )
+        if latencies:
+            cuts = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+            self.stdout.write(
+                f"latency p50 {cuts[49] * 1000:.0f} ms   p95 {cuts[94] * 1000:.0f} ms   p99 {cuts[98] * 1000:.0f} ms"
+                f"   (submission to saved verdict, +{poll * 1000:.0f} ms polling resolution)"
+            )
+        self.stdout.write(
+            f"published {published}, declined {len(latencies) - published - errored}, errors {errored}, "
+            f"unfinished {len(unfinished)}"
+        )
+        if server is not None:
+            self.stdout.write(
+                f"stand-in served {server.requests_served} requests "
+                f"({server.errors_injected} errors, {server.timeouts_injected} timeouts injected)"
+            )
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+
+from feathertree.judge_standin import StandinServer
+
+
+class Command(BaseCommand):
+    help = "Run a local FeatherJudge stand-in server (point FEATHERJUDGE_URL at it) for load and soak testing"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8089)
+        parser.add_argument(
+            "--latency", default="lognormal:2,0.5",
+            help='Response time: seconds, or "uniform:LOW,HIGH", "normal:MEAN,SD", "lognormal:MEDIAN,SIGMA", '
+                 '"exponential:MEAN".',
+        )
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with an error.")
+        parser.add_argument("--error-status", type=int, default=500, help="HTTP status for injected errors.")
+        parser.add_argument("--timeout-rate", type=float, default=0.0, help="Fraction of requests that never answer.")
+        parser.add_argument("--hang", type=float, default=600.0, help="How long a timed-out request stalls (seconds).")
+        parser.add_argument("--capacity", type=int, default=None, help="Requests processed at once; the rest queue.")
+        parser.add_argument("--scores", default="2,3,4,5", help="Comma-separated scores to pick verdicts from.")
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--prefill", type=float, default=0.0, help="Seconds per thousand uncached prompt tokens.",
+        )
+        parser.add_argument(
+            "--prefix-cache", type=int, default=0, help="Prompt blocks kept in the prefix cache (0 disables it).",
+        )
+
+    def handle(self, *args, **options):
+        server = StandinServer(
+            (options["host"], options["port"]),
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            error_status=options["error_status"],
+            timeout_rate=options["timeout_rate"],
+            hang=options["hang"],
+            capacity=options["capacity"],
+            scores=[int(score) for score in options["scores"].split(",")],
+            seed=options["seed"],
+            prefill=options["prefill"],
+            prefix_cache=options["prefix_cache"],
+        )
+        self.stdout.write(f"FeatherJudge stand-in listening on {server.url} (batch: {server.batch_url})")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(
+                f"Served {server.requests_served} requests "
+                f"({server.errors_injected} errors, {server.timeouts_injected} timeouts injected, "
+                f"{server.cached_tokens} of {server.prompt_tokens} prompt tokens from the prefix cache)."
+            )
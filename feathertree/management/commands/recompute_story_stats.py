@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from feathertree.models import Story, StoryStats
+
+COUNTERS = ["chapter_count", "draft_count", "branch_count", "max_depth", "word_count", "contributor_count"]
+
+
+class Command(BaseCommand):
+    help = "Recompute StoryStats from scratch to reconcile any drift in the incremental counters"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "story_ids",
+            nargs="*",
+            type=int,
+            help="Only recompute these stories (default: all stories).",
+        )
+
+    def handle(self, *args, **options):
+        stories = Story.objects.order_by("pk")
+        if options["story_ids"]:
+            stories = stories.filter(pk__in=options["story_ids"])
+
+        total = 0
+        drifted = 0
+        for story_id in stories.values_list("pk", flat=True).iterator():
+            with transaction.atomic():
+                before = StoryStats.objects.filter(story_id=story_id).values(*COUNTERS).first()
+                after = StoryStats.objects.recompute(story_id)
+            after = {name: getattr(after, name) for name in COUNTERS}
+            total += 1
+            if before != after:
+                drifted += 1
+                self.stdout.write(f"Story {story_id}: {before} -> {after}")
+
+        self.stdout.write(self.style.SUCCESS(f"Recomputed stats for {total} stories ({drifted} had drifted)."))
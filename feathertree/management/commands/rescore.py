@@ -0,0 +1,136 @@
+import hashlib
+import json
+import time
+from itertools import islice
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from feathertree.helpers import build_judge_payload, query_judge_batch
+from feathertree.judge_breaker import JudgeUnavailable
+from feathertree.models import Chapter, ChapterRescore, RescoreRun
+from feathertree.tasks import review_contexts
+
+
+# Re-scores published chapters with the current judge settings (model IDs, prompt) into ChapterRescore,
+# without touching the chapters themselves. Chapters are streamed in id order, --chunk-size at a time: the
+# contexts of a chunk are assembled with one ancestor query and its judge calls run --parallel at a time.
+# Each chunk is saved together with the run's checkpoint, so running the command again with the same --run
+# resumes after the last saved chunk. Chapters keep the id they got as drafts, so ones published after the
+# checkpoint passed their id are picked up by a final pass over published chapters the run has no score for.
+# With FEATHERJUDGE_BATCH_URL set, each chunk goes to the batch endpoint as a single request, so --chunk-size
+# rather than --parallel bounds the work sent at once.
+class Command(BaseCommand):
+    help = "Re-score published chapters into a separate scores table, resumably and in parallel"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--run", help="Name of the run to start or resume (default: derived from the model IDs and prompt).",
+        )
+        parser.add_argument("--story", type=int, action="append", help="Only re-score this story (repeatable).")
+        parser.add_argument("--chunk-size", type=int, default=100, help="Chapters per checkpoint.")
+        parser.add_argument(
+            "--parallel", type=int, default=settings.FEATHERJUDGE_FANOUT,
+            help="Concurrent judge calls (not used with FEATHERJUDGE_BATCH_URL: a chunk is one batch request).",
+        )
+        parser.add_argument("--no-cache", action="store_true", help="Don't read or write cached judge verdicts.")
+        parser.add_argument("--restart", action="store_true", help="Discard the run's scores and start over.")
+
+    def handle(self, *args, **options):
+        prompt_hash = self.prompt_hash()
+        name = options["run"] or "-".join(
+            filter(None, [settings.FEATHERJUDGE_SMALL_MODEL_ID, settings.FEATHERJUDGE_MODEL_ID, prompt_hash[:12]])
+        )
+        run, created = RescoreRun.objects.get_or_create(
+            name=name,
+            defaults={
+                "model_id": settings.FEATHERJUDGE_MODEL_ID,
+                "small_model_id": settings.FEATHERJUDGE_SMALL_MODEL_ID,
+                "prompt_hash": prompt_hash,
+            },
+        )
+        if options["restart"] and not created:
+            ChapterRescore.objects.filter(run=run).delete()
+            RescoreRun.objects.filter(pk=run.pk).update(
+                last_chapter_id=0, scored=0, failed=0, started_at=timezone.now(), finished_at=None
+            )
+            run.refresh_from_db()
+        elif not created:
+            judge = (settings.FEATHERJUDGE_MODEL_ID, settings.FEATHERJUDGE_SMALL_MODEL_ID, prompt_hash)
+            if (run.model_id, run.small_model_id, run.prompt_hash) != judge:
+                raise CommandError(
+                    f"Run {name!r} was started with other judge settings; use another --run or --restart."
+                )
+            if run.finished_at is not None:
+                self.stdout.write(f"Run {name!r} already finished: {run.scored} scored, {run.failed} failed.")
+                return
+            self.stdout.write(f"Resuming run {name!r} after chapter {run.last_chapter_id}")
+
+        chapters = (
+            Chapter.objects.filter(draft=False)
+            .only("pk", "content", "path", "previous_chapter_id")
+            .order_by("pk")
+        )
+        if options["story"]:
+            chapters = chapters.filter(story_id__in=options["story"])
+
+        options["parallel"] = max(1, options["parallel"])
+        self.score(run, chapters.filter(pk__gt=run.last_chapter_id), options)
+        missed = chapters.filter(pk__lte=run.last_chapter_id).exclude(rescores__run=run)
+        self.score(run, missed, options, advance=False)
+
+        RescoreRun.objects.filter(pk=run.pk).update(finished_at=timezone.now())
+        self.stdout.write(self.style.SUCCESS(f"Run {name!r} finished: {run.scored} scored, {run.failed} failed."))
+
+    # Score `chapters` chunk by chunk, checkpointing after each. With `advance` the checkpoint moves to the end
+    # of the chunk; the final pass over missed chapters (all behind the checkpoint) leaves it where it is.
+    def score(self, run, chapters, options, advance=True):
+        stream = chapters.iterator(chunk_size=options["chunk_size"])
+        start = time.monotonic()
+        done = 0
+        while chunk := list(islice(stream, options["chunk_size"])):
+            results = self.judge(chunk, use_cache=not options["no_cache"], parallel=options["parallel"])
+            rescores = [self.rescore(run, chapter, result) for chapter, result in zip(chunk, results)]
+            RescoreRun.objects.checkpoint(run, rescores, chunk[-1].pk if advance else run.last_chapter_id)
+            done += len(chunk)
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                f"{run.scored + run.failed} chapters ({run.failed} failed), through id {run.last_chapter_id}, "
+                f"{done / elapsed:.1f} chapters/s"
+            )
+
+    # Judge a chunk, waiting out the circuit breaker (up to FEATHERJUDGE_BREAKER_MAX_RETRIES times) for calls
+    # it turned away. Continuations of the same chapter are grouped so they share a cached prompt prefix.
+    def judge(self, chunk, use_cache, parallel):
+        pairs = list(zip(review_contexts(chunk), [chapter.content for chapter in chunk]))
+        groups = [chapter.previous_chapter_id for chapter in chunk]
+        results = query_judge_batch(pairs, use_cache=use_cache, groups=groups, max_workers=parallel)
+        for _ in range(settings.FEATHERJUDGE_BREAKER_MAX_RETRIES):
+            waiting = [index for index, result in enumerate(results) if isinstance(result, JudgeUnavailable)]
+            if not waiting:
+                return results
+            retry_after = max(max(results[index].retry_after for index in waiting), 1)
+            self.stdout.write(f"Judge unavailable, retrying {len(waiting)} calls in {retry_after:.0f}s")
+            time.sleep(retry_after)
+            retried = query_judge_batch(
+                [pairs[index] for index in waiting], use_cache=use_cache, groups=[groups[index] for index in waiting],
+                max_workers=parallel,
+            )
+            for index, result in zip(waiting, retried):
+                results[index] = result
+        if any(isinstance(result, JudgeUnavailable) for result in results):
+            # Nothing from this chunk is saved, so the next run starts with it
+            raise CommandError("The judge is still unavailable; run the command again to resume.")
+        return results
+
+    def rescore(self, run, chapter, result):
+        if isinstance(result, Exception):
+            return ChapterRescore(run=run, chapter=chapter, error=f"{type(result).__name__}: {result}")
+        score, feedback, tier = result
+        return ChapterRescore(run=run, chapter=chapter, score=score, feedback=feedback, review_tier=tier)
+
+    # Identifies the prompt template and sampling parameters, so a changed rubric gets a new run
+    def prompt_hash(self):
+        payload = build_judge_payload("", "")
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from feathertree.tasks import summarize_story_chapters
+
+
+class Command(BaseCommand):
+    help = "Build or refresh the rolling summaries of published chapters (resumable: up-to-date summaries are skipped)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "story_ids",
+            nargs="*",
+            type=int,
+            help="Only summarize these stories (default: all stories).",
+        )
+        parser.add_argument(
+            "--background",
+            action="store_true",
+            help="Queue the work as a Celery task instead of running it here.",
+        )
+
+    def handle(self, *args, **options):
+        if options["background"]:
+            result = summarize_story_chapters.delay(options["story_ids"])
+            self.stdout.write(self.style.SUCCESS(f"Queued summarize_story_chapters ({result.id})."))
+            return
+        written = summarize_story_chapters(options["story_ids"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} chapter summaries."))
@@ -1,7 +1,17 @@
 # This file is meant for Model Manager classes.
 # All custom functionality related to Models besides their definition should go here.
 from django.contrib.auth.base_user import BaseUserManager
+import hashlib
+from collections import defaultdict
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Value
+from django.db.models.functions import Concat, Greatest, Length, Substr
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
+from .judge_context import roll_summary
 
 # Custom user model manager where email is the unique identifier for authentication instead of usernames.
 class UserManager(BaseUserManager):
@@ -26,4 +36,291 @@ class UserManager(BaseUserManager):
             raise ValueError(_("Superuser must have is_staff=True."))
         if extra_fields.get("is_superuser") is not True:
             raise ValueError(_("Superuser must have is_superuser=True."))
-        return self.create_user(email, password, **extra_fields)
\ No newline at end of file
+        return self.create_user(email, password, **extra_fields)
+
+# Chapter querysets and managers.
+# Chapters form a tree per story through previous_chapter. Chapter.path stores the ids of every
+# ancestor from the root down, e.g. "/1/5/9/" for a chapter whose parent is 9, so lineage lookups
+# don't have to walk previous_chapter one SELECT at a time.
+class ChapterQuerySet(models.QuerySet):
+    # Return the root-to-parent chain of `chapter` in story order, using a single query.
+    def ancestors_of(self, chapter):
+        ancestor_ids = chapter.ancestor_ids()
+        if not ancestor_ids:
+            return self.none()
+        # Every ancestor's path is a strict prefix of the next one's, so path length orders the chain.
+        return self.filter(pk__in=ancestor_ids).order_by(Length("path"))
+
+    # Published children of `chapter` (an instance, id or OuterRef) that have a place in the story tree.
+    def published_children_of(self, chapter):
+        return self.filter(previous_chapter=chapter, draft=False, preorder__isnull=False)
+
+    # The descendant helpers below go through the ChapterClosure table (see ChapterClosureManager),
+    # so each one is a single indexed query however large or deep the story is.
+
+    # Every chapter below `chapter` (optionally including itself), nearest first.
+    def descendants_of(self, chapter, include_self=False):
+        return self.filter(
+            ancestor_links__ancestor=chapter,
+            ancestor_links__depth__gte=0 if include_self else 1,
+        ).order_by("ancestor_links__depth", "pk")
+
+    # The chapters that end a branch under `chapter`. With published_only, a chapter whose
+    # children are all drafts still counts as a leaf, matching what readers see.
+    def leaves_of(self, chapter, published_only=False):
+        children = self.model.objects.filter(previous_chapter=OuterRef("pk"))
+        if published_only:
+            children = children.filter(draft=False)
+        leaves = self.descendants_of(chapter, include_self=True).filter(~Exists(children))
+        return leaves.filter(draft=False) if published_only else leaves
+
+    # Annotate subtree_size (the chapter plus everything below it) and subtree_height
+    # (the longest path down from it, 0 for a leaf) on every chapter in the queryset.
+    def with_subtree_stats(self, published_only=False):
+        links = Q(descendant_links__descendant__draft=False) if published_only else Q()
+        return self.annotate(
+            subtree_size=Count("descendant_links", filter=links),
+            subtree_height=Max("descendant_links__depth", filter=links),
+        )
+
+
+class ChapterManager(models.Manager.from_queryset(ChapterQuerySet)):
+    # Rewrite the stored paths and depths of every descendant after `chapter` moved to a new parent. The
+    # descendants are found through ChapterClosure (a move doesn't change them), as path isn't indexed.
+    def move_subtree(self, chapter, old_path):
+        old_prefix = f"{old_path}{chapter.pk}/"
+        new_prefix = f"{chapter.path}{chapter.pk}/"
+        if old_prefix == new_prefix:
+            return
+        self.descendants_of(chapter).update(
+            path=Concat(Value(new_prefix), Substr("path", len(old_prefix) + 1)),
+            depth=F("depth") + (new_prefix.count("/") - old_prefix.count("/")),
+        )
+
+    # Published chapters carry a per-story pre-order position so story_view can read the whole tree with
+    # ORDER BY preorder. A newly published chapter goes right after its parent's published subtree, i.e.
+    # after its older siblings, and everything behind it in the story shifts up by one.
+    # Drafts, and published chapters whose parent is still a draft, have no position.
+    def place_in_preorder(self, chapter):
+        story_model = self.model._meta.get_field("story").related_model
+        with transaction.atomic():
+            # Serialize publishes within a story so two chapters can't claim the same slot
+            story_model.objects.select_for_update().filter(pk=chapter.story_id).exists()
+
+            # A chapter published under an unplaced parent may have published descendants waiting
+            # for a position; renumbering the story places them all at once.
+            if self.descendants_of(chapter).filter(draft=False).exists():
+                chapter.preorder = self.rebuild_preorder(chapter.story_id)[chapter.pk]
+                return
+
+            if chapter.previous_chapter_id is None:
+                subtree_end = self.filter(story_id=chapter.story_id).aggregate(end=Max("preorder"))["end"]
+            else:
+                bounds = self.descendants_of(chapter.previous_chapter_id, include_self=True).aggregate(
+                    end=Max("preorder"),
+                    parent=Max("preorder", filter=Q(pk=chapter.previous_chapter_id)),
+                )
+                if bounds["parent"] is None:
+                    return
+                subtree_end = bounds["end"]
+
+            position = 0 if subtree_end is None else subtree_end + 1
+            self.filter(story_id=chapter.story_id, preorder__gte=position).update(preorder=F("preorder") + 1)
+            self.filter(pk=chapter.pk).update(preorder=position)
+            chapter.preorder = position
+
+    # Renumber every published chapter of a story from scratch and return {chapter id: position}.
+    # Siblings keep their current relative order; chapters that were never placed go after them by timestamp.
+    def rebuild_preorder(self, story_id):
+        rows = self.filter(story_id=story_id).values_list("pk", "previous_chapter_id", "draft", "preorder", "timestamp")
+        children = defaultdict(list)
+        for pk, parent_id, draft, preorder, timestamp in rows:
+            if not draft:
+                children[parent_id].append((preorder is None, preorder or 0, timestamp, pk))
+
+        positions = {pk: None for pk, *_ in rows}
+        stack = sorted(children[None], reverse=True)
+        position = 0
+        while stack:
+            *_, pk = stack.pop()
+            positions[pk] = position
+            position += 1
+            stack.extend(sorted(children[pk], reverse=True))
+
+        self.bulk_update(
+            [self.model(pk=pk, preorder=preorder) for pk, preorder in positions.items()],
+            ["preorder"],
+            batch_size=1000,
+        )
+        return positions
+
+    # Bring the rolling summaries (Chapter.summary) of published chapters up to date, parents before
+    # children: the whole story, or only `root` and its published descendants. A chapter whose
+    # summary_source still matches its inputs (its parent's summary, its own content and the summary
+    # settings) is left alone, and each summary is saved as soon as it's computed, so an interrupted run can
+    # simply be started again. Returns the number of summaries written.
+    def refresh_summaries(self, story_id, root=None):
+        chapters = self.filter(story_id=story_id, draft=False)
+        summaries = {}
+        if root is not None:
+            chapters = chapters.descendants_of(root, include_self=True)
+            summaries[root.previous_chapter_id] = (
+                self.filter(pk=root.previous_chapter_id).values_list("summary", flat=True).first() or ""
+            )
+        else:
+            chapters = chapters.order_by("depth", "pk")
+
+        written = 0
+        rows = chapters.values_list("pk", "previous_chapter_id", "content", "summary", "summary_source")
+        for pk, parent_id, content, summary, source in rows.iterator():
+            parent_summary = summaries.get(parent_id, "")
+            expected_source = hashlib.sha256(
+                f"{settings.CHAPTER_SUMMARY_TOKENS}|{settings.CHAPTER_SUMMARY_LINE_TOKENS}|"
+                f"{parent_summary}\0{content}".encode()
+            ).hexdigest()
+            if source != expected_source:
+                summary = roll_summary(
+                    parent_summary, content, settings.CHAPTER_SUMMARY_TOKENS, settings.CHAPTER_SUMMARY_LINE_TOKENS
+                )
+                # update() rather than save(): summaries aren't shown on any page, so caches stay valid
+                self.filter(pk=pk).update(summary=summary, summary_source=expected_source)
+                written += 1
+            summaries[pk] = summary
+        return written
+
+
+# Closure table rows: one (ancestor, descendant, depth) row for every pair of chapters on the same branch,
+# including a depth 0 row linking each chapter to itself. Rows are removed with their chapters through
+# the CASCADE foreign keys, so only creation and re-parenting need maintaining here.
+class ChapterClosureManager(models.Manager):
+    # Link a freshly created chapter to itself and to every ancestor listed in its path.
+    def link_new_chapter(self, chapter):
+        ancestor_ids = chapter.ancestor_ids()
+        links = [self.model(ancestor_id=chapter.pk, descendant_id=chapter.pk, depth=0)]
+        links += [
+            self.model(ancestor_id=ancestor_id, descendant_id=chapter.pk, depth=len(ancestor_ids) - i)
+            for i, ancestor_id in enumerate(ancestor_ids)
+        ]
+        self.bulk_create(links)
+
+    # Detach the subtree rooted at `chapter` from its old ancestors and attach it under the new ones.
+    def relink_subtree(self, chapter):
+        subtree = list(self.filter(ancestor=chapter).values_list("descendant_id", "depth"))
+        subtree_ids = [descendant_id for descendant_id, _ in subtree]
+        self.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+
+        ancestor_ids = chapter.ancestor_ids()
+        self.bulk_create(
+            self.model(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=len(ancestor_ids) - i + depth)
+            for i, ancestor_id in enumerate(ancestor_ids)
+            for descendant_id, depth in subtree
+        )
+
+
+# Incremental maintenance of StoryStats. Each update is a single UPDATE with F() expressions, so concurrent
+# publishes in one story don't lose counts; the existence checks around them can race, which is what
+# recompute() (and the recompute_story_stats command) is for.
+class StoryStatsManager(models.Manager):
+    def record_new_draft(self, chapter):
+        self.get_or_create(story_id=chapter.story_id)
+        self.filter(story_id=chapter.story_id).update(draft_count=F("draft_count") + 1)
+
+    def record_publish(self, chapter, was_draft):
+        chapters = type(chapter).objects.filter(story_id=chapter.story_id, draft=False).exclude(pk=chapter.pk)
+        new_contributor = not chapters.filter(author_id=chapter.author_id).exists()
+        # The new chapter ends a branch unless it already has published continuations, and it
+        # extends (rather than adds) a branch if its parent used to be a published leaf.
+        is_leaf = not chapters.filter(previous_chapter=chapter).exists()
+        extends_leaf = (
+            chapter.previous_chapter_id is not None
+            and chapters.filter(pk=chapter.previous_chapter_id).exists()
+            and not chapters.filter(previous_chapter_id=chapter.previous_chapter_id).exists()
+        )
+
+        self.get_or_create(story_id=chapter.story_id)
+        self.filter(story_id=chapter.story_id).update(
+            chapter_count=F("chapter_count") + 1,
+            draft_count=Greatest(F("draft_count") - int(was_draft), 0),
+            branch_count=Greatest(F("branch_count") + int(is_leaf) - int(extends_leaf), 0),
+            max_depth=Greatest(F("max_depth"), chapter.depth + 1),
+            word_count=F("word_count") + chapter.word_count(),
+            contributor_count=F("contributor_count") + int(new_contributor),
+        )
+
+    # Rebuild a story's stats from its chapters
+    def recompute(self, story_id):
+        chapters = apps.get_model("feathertree", "Chapter").objects.filter(story_id=story_id)
+        published = chapters.filter(draft=False)
+        totals = chapters.aggregate(
+            chapter_count=Count("pk", filter=Q(draft=False)),
+            draft_count=Count("pk", filter=Q(draft=True)),
+            max_depth=Max("depth", filter=Q(draft=False)),
+            contributor_count=Count("author", filter=Q(draft=False), distinct=True),
+        )
+        totals["max_depth"] = totals["max_depth"] + 1 if totals["max_depth"] is not None else 0
+        totals["branch_count"] = published.filter(
+            ~Exists(published.filter(previous_chapter=OuterRef("pk")))
+        ).count()
+        totals["word_count"] = sum(
+            len(content.split()) for content in published.values_list("content", flat=True).iterator()
+        )
+        stats, _ = self.update_or_create(story_id=story_id, defaults=totals)
+        return stats
+
+
+class JudgeVerdictManager(models.Manager):
+    # Verdicts younger than FEATHERJUDGE_VERDICT_TTL seconds
+    def fresh(self):
+        cutoff = timezone.now() - timedelta(seconds=settings.FEATHERJUDGE_VERDICT_TTL)
+        return self.filter(created_at__gte=cutoff)
+
+    # The fresh verdict stored under `key`, or None. Hits are recorded for least-recently-used eviction.
+    def lookup(self, key):
+        verdict = self.fresh().filter(pk=key).first()
+        if verdict is not None:
+            self.record_hit(key)
+        return verdict
+
+    def record_hit(self, key):
+        self.filter(pk=key).update(last_used_at=timezone.now(), hit_count=F("hit_count") + 1)
+
+    def store(self, key, model_id, score, feedback):
+        now = timezone.now()
+        verdict, _ = self.update_or_create(
+            pk=key,
+            defaults={"model_id": model_id, "score": score, "feedback": feedback, "created_at": now, "last_used_at": now},
+        )
+        return verdict
+
+    # Delete expired verdicts, then the least recently used ones beyond FEATHERJUDGE_VERDICT_MAX_ENTRIES.
+    # Returns the number of rows deleted.
+    def evict(self):
+        cutoff = timezone.now() - timedelta(seconds=settings.FEATHERJUDGE_VERDICT_TTL)
+        expired, _ = self.filter(created_at__lt=cutoff).delete()
+        overflow = list(
+            self.order_by("-last_used_at", "-pk").values_list("pk", flat=True)[settings.FEATHERJUDGE_VERDICT_MAX_ENTRIES:]
+        )
+        evicted, _ = self.filter(pk__in=overflow).delete()
+        return expired + evicted
+
+
+class RescoreRunManager(models.Manager):
+    # Save a chunk of ChapterRescore rows and move the run's checkpoint past them in one transaction, so a
+    # crash never leaves scores behind the checkpoint or the checkpoint behind the scores
+    def checkpoint(self, run, rescores, last_chapter_id):
+        ChapterRescore = apps.get_model("feathertree", "ChapterRescore")
+        failed = sum(rescore.score is None for rescore in rescores)
+        with transaction.atomic():
+            ChapterRescore.objects.bulk_create(
+                rescores,
+                update_conflicts=True,
+                unique_fields=["run", "chapter"],
+                update_fields=["score", "feedback", "review_tier", "error", "created_at"],
+            )
+            self.filter(pk=run.pk).update(
+                last_chapter_id=last_chapter_id,
+                scored=F("scored") + len(rescores) - failed,
+                failed=F("failed") + failed,
+            )
+        run.refresh_from_db(fields=["last_chapter_id", "scored", "failed"])
+
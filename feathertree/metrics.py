@@ -0,0 +1,137 @@
+# Prometheus metrics for feathertree. Define every metric here so names stay consistent across modules.
+#
+# Web and Celery worker processes each record their own values. With PROMETHEUS_MULTIPROC_DIR set (before
+# any process starts; the directory should be emptied on deploy) they write them to files there, and the
+# /metrics view aggregates every process's files (metrics_registry). Gauges say how values from several
+# processes combine.
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+
+# Rendered HTML fragment cache (caching.cached_fragment). Hit rate = hit / (hit + miss) per fragment.
+FRAGMENT_CACHE_REQUESTS = Counter(
+    "feathertree_fragment_cache_requests_total",
+    "Lookups in the rendered fragment cache, by fragment and result (hit or miss).",
+    ["fragment", "result"],
+)
+
+# FeatherJudge endpoint protection (judge_breaker.py)
+JUDGE_BREAKER_STATE = Gauge(
+    "feathertree_judge_breaker_state",
+    "FeatherJudge circuit breaker state, by cascade tier: 0 closed, 1 half-open, 2 open.",
+    ["tier"],
+    multiprocess_mode="livemax",
+)
+JUDGE_BREAKER_TRANSITIONS = Counter(
+    "feathertree_judge_breaker_transitions_total",
+    "FeatherJudge circuit breaker state changes, by cascade tier and the state entered.",
+    ["tier", "state"],
+)
+JUDGE_CONCURRENCY_LIMIT = Gauge(
+    "feathertree_judge_concurrency_limit",
+    "Current adaptive (AIMD) limit on concurrent FeatherJudge calls, by client (sync or async) and cascade tier.",
+    ["client", "tier"],
+    multiprocess_mode="livesum",
+)
+JUDGE_IN_FLIGHT = Gauge(
+    "feathertree_judge_in_flight",
+    "FeatherJudge calls currently in flight, by client (sync or async) and cascade tier.",
+    ["client", "tier"],
+    multiprocess_mode="livesum",
+)
+
+# Review cascade (helpers.query_judge_cascade): share of scores the small model settles on its own
+JUDGE_TIER_DECISIONS = Counter(
+    "feathertree_judge_tier_decisions_total",
+    "Review scores decided by each tier of the judge cascade (small or large model).",
+    ["tier"],
+)
+
+# Local pre-screen of review submissions (prescreen.py): decline or forward, by reason
+PRESCREEN_DECISIONS = Counter(
+    "feathertree_prescreen_decisions_total",
+    "Pre-screen decisions on review submissions, by decision (decline or forward) and reason.",
+    ["decision", "reason"],
+)
+
+# Review pipeline (tasks.py, helpers.py)
+REVIEW_QUEUE_WAIT = Histogram(
+    "feathertree_review_queue_wait_seconds",
+    "Time from a review being queued (request_review) to review_chapter starting on a worker.",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+REVIEW_CONTEXT_SECONDS = Histogram(
+    "feathertree_review_context_seconds",
+    "Time to fetch ancestors and fit them into the prompt as previous text, per chapter or batch of chapters.",
+)
+JUDGE_PROMPT_CHARS = Histogram(
+    "feathertree_judge_prompt_chars",
+    "Size of FeatherJudge prompts in characters.",
+    buckets=(1000, 2000, 4000, 8000, 16000, 32000, 64000),
+)
+JUDGE_PROMPT_TOKENS = Histogram(
+    "feathertree_judge_prompt_tokens",
+    "Estimated size of FeatherJudge prompts in tokens (judge_context.estimate_tokens).",
+    buckets=(256, 512, 1024, 2048, 4096, 6144, 8192, 16384),
+)
+JUDGE_REQUEST_SECONDS = Histogram(
+    "feathertree_judge_request_seconds",
+    "FeatherJudge HTTP request latency, by cascade tier and status (HTTP status code, timeout or error).",
+    ["tier", "status"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+JUDGE_PARSE_FAILURES = Counter(
+    "feathertree_judge_parse_failures_total",
+    "FeatherJudge responses parse_featherjudge_response could not read, by reason.",
+    ["reason"],
+)
+REVIEW_SCORES = Counter(
+    "feathertree_review_scores_total",
+    "Review scores saved, by score and the tier that decided it (failed for reviews that errored).",
+    ["tier", "score"],
+)
+
+REQUEST_SECONDS = Histogram(
+    "feathertree_request_seconds",
+    "Total time to handle a request, by URL name (performance.PerformanceMiddleware).",
+    ["view"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUEST_QUERIES = Histogram(
+    "feathertree_request_queries",
+    "SQL queries run per request, by URL name.",
+    ["view"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+REQUEST_QUERY_SECONDS = Histogram(
+    "feathertree_request_query_seconds",
+    "Time spent in SQL queries per request, by URL name.",
+    ["view"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+REQUEST_TEMPLATE_SECONDS = Histogram(
+    "feathertree_request_template_seconds",
+    "Time spent rendering templates per request (including queries run from templates), by URL name.",
+    ["view"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+QUERY_BUDGET_EXCEEDED = Counter(
+    "feathertree_query_budget_exceeded_total",
+    "Requests that ran more SQL queries than their view's QUERY_BUDGETS entry, by URL name.",
+    ["view"],
+)
+
+
+# The registry to export: every process's metrics in multiprocess mode, otherwise this process's
+def metrics_registry():
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+# Remove an exited process's live gauges (multiprocess mode)
+def mark_process_dead(pid):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
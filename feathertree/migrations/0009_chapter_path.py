@@ -0,0 +1,41 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+# Fill in Chapter.path for existing rows. Parents are resolved in memory so this costs one read and one bulk write.
+def backfill_chapter_paths(apps, schema_editor):
+    Chapter = apps.get_model("feathertree", "Chapter")
+    parent_by_id = dict(Chapter.objects.values_list("id", "previous_chapter_id"))
+
+    paths = {}
+    for chapter_id in parent_by_id:
+        # Climb to the nearest chapter whose path is already known (or the root), then fill back down
+        chain = []
+        current = chapter_id
+        while current is not None and current not in paths:
+            chain.append(current)
+            current = parent_by_id.get(current)
+        prefix = paths[current] + f"{current}/" if current is not None else "/"
+        for pk in reversed(chain):
+            paths[pk] = prefix
+            prefix = f"{prefix}{pk}/"
+
+    chapters = [Chapter(id=pk, path=path) for pk, path in paths.items()]
+    Chapter.objects.bulk_update(chapters, ["path"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0008_alter_chapter_story'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='path',
+            field=models.CharField(db_index=True, default='/', editable=False, max_length=2048),
+        ),
+        migrations.RunPython(backfill_chapter_paths, migrations.RunPython.noop),
+    ]
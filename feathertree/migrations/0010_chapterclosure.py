@@ -0,0 +1,50 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Build closure rows for existing chapters from the materialized paths added in 0009.
+def backfill_chapter_closure(apps, schema_editor):
+    Chapter = apps.get_model("feathertree", "Chapter")
+    ChapterClosure = apps.get_model("feathertree", "ChapterClosure")
+
+    links = []
+    for chapter_id, path in Chapter.objects.values_list("id", "path").iterator():
+        ancestor_ids = [int(pk) for pk in path.strip("/").split("/") if pk]
+        links.append(ChapterClosure(ancestor_id=chapter_id, descendant_id=chapter_id, depth=0))
+        links += [
+            ChapterClosure(ancestor_id=ancestor_id, descendant_id=chapter_id, depth=len(ancestor_ids) - i)
+            for i, ancestor_id in enumerate(ancestor_ids)
+        ]
+        if len(links) >= 5000:
+            ChapterClosure.objects.bulk_create(links)
+            links = []
+    ChapterClosure.objects.bulk_create(links)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0009_chapter_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChapterClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='feathertree.chapter')),
+                ('descendant', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='feathertree.chapter')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='chapter_closure_anc_depth_idx'), models.Index(fields=['descendant', 'depth'], name='chapter_closure_desc_depth_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='chapterclosure',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='chapter_closure_unique_link'),
+        ),
+        migrations.RunPython(backfill_chapter_closure, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:33
+
+from collections import defaultdict
+from django.db import migrations, models
+
+
+# Fill in depth for every chapter and number each story's published chapters in pre-order,
+# ordering siblings the way story_view used to (ordinal, then timestamp).
+def backfill_chapter_preorder(apps, schema_editor):
+    Chapter = apps.get_model("feathertree", "Chapter")
+
+    rows = list(Chapter.objects.values_list("id", "story_id", "previous_chapter_id", "draft", "path", "ordinal", "timestamp"))
+    children = defaultdict(list)
+    for pk, story_id, parent_id, draft, path, ordinal, timestamp in rows:
+        if not draft:
+            children[(story_id, parent_id)].append((ordinal, timestamp, pk))
+
+    preorder = {}
+    for story_id in {row[1] for row in rows}:
+        stack = sorted(children[(story_id, None)], reverse=True)
+        position = 0
+        while stack:
+            *_, pk = stack.pop()
+            preorder[pk] = position
+            position += 1
+            stack.extend(sorted(children[(story_id, pk)], reverse=True))
+
+    chapters = [
+        Chapter(id=pk, depth=path.count("/") - 1, preorder=preorder.get(pk))
+        for pk, _, _, _, path, _, _ in rows
+    ]
+    Chapter.objects.bulk_update(chapters, ["depth", "preorder"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0010_chapterclosure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='preorder',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='chapter',
+            index=models.Index(fields=['story', 'preorder'], name='chapter_story_preorder_idx'),
+        ),
+        migrations.RunPython(backfill_chapter_preorder, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Compute stats for every existing story in one pass over its chapters.
+def backfill_story_stats(apps, schema_editor):
+    Story = apps.get_model("feathertree", "Story")
+    Chapter = apps.get_model("feathertree", "Chapter")
+    StoryStats = apps.get_model("feathertree", "StoryStats")
+
+    stats = {story_id: StoryStats(story_id=story_id) for story_id in Story.objects.values_list("id", flat=True)}
+    authors = {story_id: set() for story_id in stats}
+    published_parents = set()
+    published = []
+    rows = Chapter.objects.values_list("id", "story_id", "previous_chapter_id", "draft", "depth", "author_id", "content")
+    for pk, story_id, parent_id, draft, depth, author_id, content in rows.iterator():
+        story_stats = stats[story_id]
+        if draft:
+            story_stats.draft_count += 1
+            continue
+        story_stats.chapter_count += 1
+        story_stats.max_depth = max(story_stats.max_depth, depth + 1)
+        story_stats.word_count += len(content.split())
+        authors[story_id].add(author_id)
+        published_parents.add(parent_id)
+        published.append((pk, story_id))
+
+    for pk, story_id in published:
+        if pk not in published_parents:
+            stats[story_id].branch_count += 1
+    for story_id, story_authors in authors.items():
+        stats[story_id].contributor_count = len(story_authors)
+
+    StoryStats.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0011_chapter_preorder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoryStats',
+            fields=[
+                ('story', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='feathertree.story')),
+                ('chapter_count', models.PositiveIntegerField(default=0)),
+                ('draft_count', models.PositiveIntegerField(default=0)),
+                ('branch_count', models.PositiveIntegerField(default=0)),
+                ('max_depth', models.PositiveIntegerField(default=0)),
+                ('word_count', models.PositiveIntegerField(default=0)),
+                ('contributor_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_story_stats, migrations.RunPython.noop),
+    ]
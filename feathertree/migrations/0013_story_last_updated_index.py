@@ -0,0 +1,17 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0012_storystats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['-last_updated', '-id'], name='story_last_updated_id_idx'),
+        ),
+    ]
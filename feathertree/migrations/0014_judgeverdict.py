@@ -0,0 +1,26 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:44
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0013_story_last_updated_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JudgeVerdict',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('model_id', models.CharField(max_length=64)),
+                ('score', models.IntegerField()),
+                ('feedback', models.TextField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.25 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0014_judgeverdict'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='summary',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='chapter',
+            name='summary_source',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.25 on 2026-10-18 13:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0015_chapter_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='review_tier',
+            field=models.CharField(blank=True, choices=[('prescreen', 'Pre-screen'), ('small', 'Small judge model'), ('large', 'Judge model')], default='', max_length=16),
+        ),
+    ]
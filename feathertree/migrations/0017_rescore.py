@@ -0,0 +1,47 @@
+# Generated by Django 4.2.25 on 2026-10-18 13:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0016_chapter_review_tier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RescoreRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('model_id', models.CharField(max_length=64)),
+                ('small_model_id', models.CharField(blank=True, default='', max_length=64)),
+                ('prompt_hash', models.CharField(max_length=64)),
+                ('last_chapter_id', models.BigIntegerField(default=0)),
+                ('scored', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ChapterRescore',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.IntegerField(blank=True, null=True)),
+                ('feedback', models.TextField(blank=True, default='')),
+                ('review_tier', models.CharField(blank=True, default='', max_length=16)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chapter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rescores', to='feathertree.chapter')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rescores', to='feathertree.rescorerun')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chapterrescore',
+            constraint=models.UniqueConstraint(fields=('run', 'chapter'), name='rescore_run_chapter_unique'),
+        ),
+    ]
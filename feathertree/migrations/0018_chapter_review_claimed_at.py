@@ -0,0 +1,18 @@
+# Generated by Django 4.2.25 on 2026-10-18 13:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0017_rescore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chapter',
+            name='review_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
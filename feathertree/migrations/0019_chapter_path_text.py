@@ -0,0 +1,22 @@
+# Generated by Django 4.2.25 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0018_chapter_review_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chapter',
+            name='path',
+            field=models.TextField(default='/', editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chapter',
+            index=models.Index(fields=['path'], name='chapter_path_idx', opclasses=['text_pattern_ops']),
+        ),
+    ]
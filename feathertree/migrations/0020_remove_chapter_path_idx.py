@@ -0,0 +1,17 @@
+# Generated by Django 4.2.25 on 2026-10-18 14:10
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feathertree', '0019_chapter_path_text'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chapter',
+            name='chapter_path_idx',
+        ),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.db.models import UniqueConstraint
 from django.db.models.functions import Lower
-from .managers import UserManager
+from django.utils import timezone
+from .managers import (
+    UserManager, ChapterManager, ChapterClosureManager, StoryStatsManager, JudgeVerdictManager, RescoreRunManager,
+)
 
 # Field Classes
 # These are all Django class extensions & Django method overrides
@@ -47,6 +50,13 @@ class User(AbstractUser):
 class Story(models.Model):
     title = models.CharField(max_length=250) # Story titles are required
     last_updated = models.DateTimeField(auto_now=True) # Tracks when last chapter was successfully added...
+
+    class Meta:
+        indexes = [
+            # Supports the keyset-paginated stories listing
+            models.Index(fields=["-last_updated", "-id"], name="story_last_updated_id_idx"),
+        ]
+
     def __str__(self):
         return self.title
 
@@ -59,8 +69,19 @@ class Chapter(models.Model):
     content = models.TextField() # requires some text
     draft = models.BooleanField(default=True)
     submitted_for_review = models.BooleanField(default=False) # used to track locked drafts
+    # When a review task last took this submission (tasks.claim_review); cleared once the review is saved.
+    # Submissions whose claim is older than tasks.review_claim_timeout() were lost and get re-queued.
+    review_claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
     score = models.IntegerField(default=0) # generated by the system to determine quality of chapter
     feedback = models.TextField(default="") # generated by system to provide user with feeback on how to improve chapter quality
+    # Which stage of the review cascade decided the score: the local pre-screen, the small judge model or the
+    # full one. Empty for chapters never reviewed, or whose review failed.
+    review_tier = models.CharField(
+        max_length=16,
+        blank=True,
+        default="",
+        choices=[("prescreen", "Pre-screen"), ("small", "Small judge model"), ("large", "Judge model")],
+    )
     # ForeignKey links Chapter to Story, establishing the one-to-many relationship
     story = models.ForeignKey(Story, on_delete=models.PROTECT, related_name="chapters")
     author = models.ForeignKey(User, on_delete=models.PROTECT)
@@ -71,5 +92,174 @@ class Chapter(models.Model):
         related_name="next_chapters",
         on_delete=models.CASCADE,
     )
+    # Materialized ancestry: ids of every ancestor from the root down, e.g. "/1/5/9/". Root chapters store "/".
+    # Unbounded, since each level adds a few characters and branches can run hundreds of chapters deep. Not
+    # indexed: a btree entry is capped (about 2.7 kB on PostgreSQL), and ChapterClosure answers ancestor and
+    # descendant queries.
+    path = models.TextField(default="/", editable=False)
+    depth = models.PositiveIntegerField(default=0, editable=False) # Number of ancestors, 0 for the first chapter
+    # Position in a depth-first walk of the story's published chapters (see ChapterManager.place_in_preorder)
+    preorder = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    # Rolling "story so far" summary of this chapter and its ancestors, used as review context by descendants.
+    # summary_source is a hash of the inputs it was built from (see ChapterManager.refresh_summaries).
+    summary = models.TextField(blank=True, default="", editable=False)
+    summary_source = models.CharField(max_length=64, blank=True, default="", editable=False)
+
+    objects = ChapterManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["story", "preorder"], name="chapter_story_preorder_idx"),
+        ]
+
+    def __str__(self):
+        return self.title
+
+    # Ids of every ancestor, root first
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.path.strip("/").split("/") if pk]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored draft flag so save() can tell when a chapter gets published
+        instance._stored_draft = dict(zip(field_names, values)).get("draft")
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        ancestor_ids = self.ancestor_ids()
+        stored_parent_id = ancestor_ids[-1] if ancestor_ids else None
+        # Only rebuild the path when it no longer matches previous_chapter, so plain edits don't fetch the parent
+        moved = not adding and stored_parent_id != self.previous_chapter_id
+        publishing = not self.draft and self.preorder is None
+        newly_published = not self.draft and (adding or getattr(self, "_stored_draft", None) is True)
+        self._newly_published = newly_published # read by the post_save receivers in signals.py
+        if not (adding or moved or publishing or newly_published):
+            super().save(*args, **kwargs)
+            self._stored_draft = self.draft
+            return
+
+        old_path = self.path
+        if adding or moved:
+            parent = self.previous_chapter
+            self.path = f"{parent.path}{parent.pk}/" if parent is not None else "/"
+            self.depth = parent.depth + 1 if parent is not None else 0
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = set(kwargs["update_fields"]) | {"path", "depth"}
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding:
+                ChapterClosure.objects.link_new_chapter(self)
+            elif moved:
+                # Re-parenting (e.g. from the admin) has to carry the whole subtree along
+                Chapter.objects.move_subtree(self, old_path)
+                ChapterClosure.objects.relink_subtree(self)
+                self.preorder = Chapter.objects.rebuild_preorder(self.story_id)[self.pk]
+            if publishing and not moved:
+                Chapter.objects.place_in_preorder(self)
+
+            if newly_published:
+                StoryStats.objects.record_publish(self, was_draft=not adding)
+            elif adding:
+                StoryStats.objects.record_new_draft(self)
+        self._stored_draft = self.draft
+
+    def word_count(self):
+        return len(self.content.split())
+
+
+# Denormalized per-story numbers for list and story pages, kept current by Chapter.save() and the
+# post_delete signal in signals.py. They describe what readers see, i.e. published chapters, except
+# draft_count. Run `manage.py recompute_story_stats` to reconcile any drift.
+class StoryStats(models.Model):
+    story = models.OneToOneField(Story, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    chapter_count = models.PositiveIntegerField(default=0)
+    draft_count = models.PositiveIntegerField(default=0)
+    branch_count = models.PositiveIntegerField(default=0) # Published chapters with no published continuation
+    max_depth = models.PositiveIntegerField(default=0) # Chapters in the longest published branch
+    word_count = models.PositiveIntegerField(default=0)
+    contributor_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = StoryStatsManager()
+
+    def __str__(self):
+        return f"Stats for {self.story}"
+
+
+# Closure table over the chapter tree: one row per (ancestor, descendant) pair on the same branch,
+# with depth = number of hops between them. Powers the descendant/leaf/subtree helpers on Chapter.objects.
+class ChapterClosure(models.Model):
+    ancestor = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name="descendant_links", db_index=False)
+    descendant = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name="ancestor_links", db_index=False)
+    depth = models.PositiveIntegerField()
+
+    objects = ChapterClosureManager()
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["ancestor", "descendant"], name="chapter_closure_unique_link"),
+        ]
+        indexes = [
+            models.Index(fields=["ancestor", "depth"], name="chapter_closure_anc_depth_idx"),
+            models.Index(fields=["descendant", "depth"], name="chapter_closure_desc_depth_idx"),
+        ]
+
+
+# Cached FeatherJudge verdicts, keyed by a sha256 of everything that goes into a judge call (prompt, model
+# and sampling parameters), so resubmitting an unchanged chapter doesn't call the LLM again.
+# Redis sits in front of this table (caching.get_judge_verdict); expiry and eviction live on the manager.
+class JudgeVerdict(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+    model_id = models.CharField(max_length=64)
+    score = models.IntegerField()
+    feedback = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # Uses served from Redis are recorded at most once per FEATHERJUDGE_VERDICT_TOUCH_INTERVAL
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+    hit_count = models.PositiveIntegerField(default=0)
+
+    objects = JudgeVerdictManager()
+
+    def __str__(self):
+        return f"Verdict {self.key[:12]} (score {self.score})"
+
+
+# A bulk re-scoring pass over published chapters (manage.py rescore), e.g. after a judge model or rubric
+# change. Scores go to ChapterRescore, never to the chapters, so publish state is untouched. Chapters are
+# scored in id order and last_chapter_id checkpoints progress, so an interrupted run resumes where it stopped.
+class RescoreRun(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    model_id = models.CharField(max_length=64)
+    small_model_id = models.CharField(max_length=64, blank=True, default="") # first tier of the cascade, if any
+    prompt_hash = models.CharField(max_length=64) # sha256 of the prompt template and sampling parameters
+    last_chapter_id = models.BigIntegerField(default=0)
+    scored = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    objects = RescoreRunManager()
+
+    def __str__(self):
+        return self.name
+
+
+class ChapterRescore(models.Model):
+    run = models.ForeignKey(RescoreRun, on_delete=models.CASCADE, related_name="rescores")
+    chapter = models.ForeignKey(Chapter, on_delete=models.CASCADE, related_name="rescores")
+    score = models.IntegerField(null=True, blank=True) # None if the judge call failed (see error)
+    feedback = models.TextField(blank=True, default="")
+    review_tier = models.CharField(max_length=16, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=["run", "chapter"], name="rescore_run_chapter_unique"),
+        ]
+
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return f"{self.run} / chapter {self.chapter_id}: {self.score}"
@@ -0,0 +1,103 @@
+# Pagination helpers for the stories listing.
+#
+# The listing is keyset (cursor) paginated on (last_updated, id): each page is a single indexed range scan
+# no matter how deep someone pages, and no COUNT(*) is needed. Cursors are opaque to clients.
+# EstimatedCountPaginator backs the optional numbered-page mode without counting the whole table.
+import base64
+import binascii
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+
+def encode_cursor(story):
+    raw = f"{story.last_updated.isoformat()}|{story.pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+# Returns (last_updated, id), or None for a missing or malformed cursor
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, pk = raw.rsplit("|", 1)
+        last_updated = parse_datetime(timestamp)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if last_updated is None:
+        return None
+    return last_updated, pk
+
+
+class KeysetPage:
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.has_previous and self.object_list else None
+
+
+# One page of `queryset` (stories, newest first) after or before the given cursor. Fetches one extra row
+# to find out whether there is another page in the direction of travel.
+def keyset_paginate(queryset, per_page, after=None, before=None):
+    after = decode_cursor(after)
+    before = decode_cursor(before) if after is None else None
+
+    if before is not None:
+        last_updated, pk = before
+        rows = list(
+            queryset
+            .filter(Q(last_updated__gt=last_updated) | Q(last_updated=last_updated, pk__gt=pk))
+            .order_by("last_updated", "pk")[:per_page + 1]
+        )
+        has_previous = len(rows) > per_page
+        return KeysetPage(rows[:per_page][::-1], has_next=True, has_previous=has_previous)
+
+    queryset = queryset.order_by("-last_updated", "-pk")
+    if after is not None:
+        last_updated, pk = after
+        queryset = queryset.filter(Q(last_updated__lt=last_updated) | Q(last_updated=last_updated, pk__lt=pk))
+    rows = list(queryset[:per_page + 1])
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_previous=after is not None)
+
+
+# A Paginator whose count comes from the planner's row estimate on PostgreSQL when the queryset is an
+# unfiltered table scan. Page numbers near the end may be slightly off, which is fine for browsing.
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == "postgresql" and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            # reltuples is -1 (or 0) until the table has been analyzed
+            if row and row[0] > 0:
+                return row[0]
+        return super().count
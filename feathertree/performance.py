@@ -0,0 +1,129 @@
+# Per-request cost accounting.
+#
+# PerformanceMiddleware measures every request: SQL query count and time (through a database execute
+# wrapper), template render time (through the TimedDjangoTemplates backend) and total time. The numbers go
+# out as a Server-Timing header, so they show up in the browser's network panel, and into Prometheus
+# histograms labelled by URL name (e.g. "feathertree:story_view"). Views with a budget in QUERY_BUDGETS
+# log a warning with their most repeated SQL statements when they run more queries than that.
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.backends.django import DjangoTemplates, Template, reraise
+
+from .metrics import (
+    QUERY_BUDGET_EXCEEDED, REQUEST_QUERIES, REQUEST_QUERY_SECONDS, REQUEST_SECONDS, REQUEST_TEMPLATE_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+SQL_SAMPLE_SIZE = 5  # distinct statements quoted in a budget warning
+
+_current = ContextVar("feathertree_request_stats", default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.statements = Counter()
+
+    # Database execute wrapper (see connection.execute_wrapper)
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_seconds += time.perf_counter() - start
+            self.queries += 1
+            self.statements[sql] += 1
+
+    @contextmanager
+    def rendering(self):
+        # Templates rendered from inside another render (e.g. by a template tag) are already being timed
+        self.template_depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.template_depth -= 1
+            if not self.template_depth:
+                self.template_seconds += time.perf_counter() - start
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        if stats is None:
+            return super().render(context, request)
+        with stats.rendering():
+            return super().render(context, request)
+
+
+# The standard Django template backend, with renders timed for PerformanceMiddleware
+class TimedDjangoTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None or not match.url_name:
+        return "<unmatched>"
+    return match.view_name
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(stats.record_query))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        total = time.perf_counter() - start
+
+        view = view_label(request)
+        REQUEST_SECONDS.labels(view=view).observe(total)
+        REQUEST_QUERIES.labels(view=view).observe(stats.queries)
+        REQUEST_QUERY_SECONDS.labels(view=view).observe(stats.query_seconds)
+        REQUEST_TEMPLATE_SECONDS.labels(view=view).observe(stats.template_seconds)
+
+        if settings.SERVER_TIMING:
+            response["Server-Timing"] = ", ".join([
+                f'db;dur={stats.query_seconds * 1000:.1f};desc="{stats.queries} queries"',
+                f"tpl;dur={stats.template_seconds * 1000:.1f}",
+                f"total;dur={total * 1000:.1f}",
+            ])
+
+        budget = settings.QUERY_BUDGETS.get(view)
+        if budget is not None and stats.queries > budget:
+            QUERY_BUDGET_EXCEEDED.labels(view=view).inc()
+            sample = "\n".join(
+                f"  {count}x {sql}" for sql, count in stats.statements.most_common(SQL_SAMPLE_SIZE)
+            )
+            logger.warning(
+                "%s ran %d SQL queries (budget %d) in %.1f ms for %s. Most repeated:\n%s",
+                view, stats.queries, budget, stats.query_seconds * 1000, request.path, sample,
+            )
+        return response
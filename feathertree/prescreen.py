@@ -0,0 +1,95 @@
+# Local pre-screen for review submissions, run before the FeatherJudge call.
+#
+# Some submissions fail review for reasons that don't need a language model: almost no text, filler that
+# repeats a few words, a copy of the chapter it continues (or of another continuation of it), or a length
+# wildly out of line with the parent. prescreen() declines those locally with feedback saying why, and
+# forwards everything else to the judge. Texts are compared as hashed bag-of-words vectors (cosine
+# similarity against the parent and siblings in one matrix product). Every decision is counted in
+# PRESCREEN_DECISIONS so the thresholds in settings can be tuned from the decline rates.
+import re
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import PRESCREEN_DECISIONS
+
+_WORDS = re.compile(r"\w+")
+VECTOR_SIZE = 4096
+
+# Score recorded for locally declined chapters ("No continuity" on the judge's rubric)
+DECLINE_SCORE = 1
+
+FEEDBACK = {
+    "too_short": "This chapter is too short to review. Please develop the continuation further and resubmit.",
+    "filler": "This chapter repeats the same few words over and over. Please write a real continuation.",
+    "copy_of_parent": "This chapter repeats the chapter it continues. Please write new text that moves the story on.",
+    "duplicate": "This chapter duplicates another continuation of the same chapter. Please write your own continuation.",
+    "length_ratio": "This chapter's length is far out of proportion to the chapter it continues. Please revise it.",
+}
+
+
+@dataclass
+class PrescreenResult:
+    decision: str  # "decline" or "forward"
+    reason: str
+    similarity: float = 0.0
+
+    @property
+    def feedback(self):
+        return FEEDBACK.get(self.reason, "")
+
+
+def words(text):
+    return _WORDS.findall(text.lower())
+
+
+# Hashed bag-of-words counts. crc32 rather than hash() so vectors are the same in every process.
+def text_vector(tokens):
+    buckets = np.fromiter((zlib.crc32(token.encode()) % VECTOR_SIZE for token in tokens), dtype=np.int64, count=len(tokens))
+    return np.bincount(buckets, minlength=VECTOR_SIZE).astype(np.float64)
+
+
+# Cosine similarity of `vector` against each row of `matrix`
+def cosine_similarities(vector, matrix):
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norms > 0, matrix @ vector / norms, 0.0)
+
+
+# Decide `text` locally or forward it. `parent_text` is the chapter it continues (None for a first chapter)
+# and `sibling_texts` other continuations of the same parent.
+def prescreen(text, parent_text=None, sibling_texts=()):
+    result = _prescreen(text, parent_text, list(sibling_texts))
+    PRESCREEN_DECISIONS.labels(decision=result.decision, reason=result.reason).inc()
+    return result
+
+
+def _prescreen(text, parent_text, sibling_texts):
+    tokens = words(text)
+    if len(tokens) < settings.PRESCREEN_MIN_WORDS:
+        return PrescreenResult("decline", "too_short")
+    # Distinct words per square root of length (Guiraud's index) stays roughly level as prose gets longer,
+    # unlike the plain distinct/total ratio, so long chapters aren't mistaken for filler
+    if len(set(tokens)) / len(tokens) ** 0.5 < settings.PRESCREEN_MIN_RICHNESS:
+        return PrescreenResult("decline", "filler")
+
+    if parent_text is not None:
+        parent_tokens = words(parent_text)
+        if parent_tokens:
+            ratio = len(tokens) / len(parent_tokens)
+            if not 1 / settings.PRESCREEN_MAX_LENGTH_RATIO <= ratio <= settings.PRESCREEN_MAX_LENGTH_RATIO:
+                return PrescreenResult("decline", "length_ratio")
+
+    others = ([parent_text] if parent_text is not None else []) + sibling_texts
+    if others:
+        matrix = np.stack([text_vector(words(other)) for other in others])
+        similarities = cosine_similarities(text_vector(tokens), matrix)
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity >= settings.PRESCREEN_DUPLICATE_SIMILARITY:
+            reason = "copy_of_parent" if parent_text is not None and best == 0 else "duplicate"
+            return PrescreenResult("decline", reason, similarity)
+        return PrescreenResult("forward", "ambiguous", similarity)
+    return PrescreenResult("forward", "ambiguous")
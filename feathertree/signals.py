@@ -0,0 +1,53 @@
+# Signal receivers for the feathertree models. Connected in FeathertreeConfig.ready().
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Chapter, Story, StoryStats
+from .caching import bump_story_version, bump_story_list_version
+from .tasks import summarize_chapter
+
+
+# Deleting chapters (including cascades to their descendants) changes the story's stats in ways that
+# aren't worth tracking incrementally, so rebuild them. A cascade sends one signal per chapter but shares
+# the same origin, so each story is only recomputed once per delete() call.
+@receiver(post_delete, sender=Chapter)
+def refresh_story_stats_after_delete(sender, instance, origin=None, **kwargs):
+    refreshed = getattr(origin, "_refreshed_story_ids", None)
+    if refreshed is None:
+        refreshed = set()
+        if origin is not None:
+            origin._refreshed_story_ids = refreshed
+    if instance.story_id in refreshed:
+        return
+    refreshed.add(instance.story_id)
+    StoryStats.objects.recompute(instance.story_id)
+
+
+# Cache invalidation (see caching.py). Versions are bumped right away, so the rest of this request sees
+# fresh data, and again once the transaction commits, so nothing cached from the pre-commit state
+# in the meantime survives.
+def _bump_after_commit(bump, *args):
+    bump(*args)
+    transaction.on_commit(lambda: bump(*args), robust=True)
+
+@receiver(post_save, sender=Chapter)
+@receiver(post_delete, sender=Chapter)
+def invalidate_story_cache_for_chapter(sender, instance, **kwargs):
+    _bump_after_commit(bump_story_version, instance.story_id)
+    # Saves that matter to the listing also save the story; deletes only change its stats
+    if kwargs.get("signal") is post_delete:
+        _bump_after_commit(bump_story_list_version)
+
+@receiver(post_save, sender=Story)
+@receiver(post_delete, sender=Story)
+def invalidate_story_cache_for_story(sender, instance, **kwargs):
+    _bump_after_commit(bump_story_version, instance.pk)
+    _bump_after_commit(bump_story_list_version)
+
+
+# Newly published chapters get their rolling summary in the background, once the publish has committed
+@receiver(post_save, sender=Chapter)
+def summarize_published_chapter(sender, instance, **kwargs):
+    if getattr(instance, "_newly_published", False):
+        chapter_id = instance.pk
+        transaction.on_commit(lambda: summarize_chapter.delay(chapter_id), robust=True)
@@ -16,8 +16,14 @@ document.addEventListener("DOMContentLoaded", function () {
   });
 });
 
-function toggleChapterChildren(chapterId) {
-  const list = document.getElementById(`children-${chapterId}`);
+async function toggleChapterChildren(chapterId) {
+  let list = document.getElementById(`children-${chapterId}`);
+  const toggle = document.getElementById(`chapter-toggle-${chapterId}`);
+
+  // Branches below the initially rendered levels are fetched the first time they're opened
+  if (!list && toggle?.dataset.childrenUrl) {
+    list = await loadChapterChildren(toggle);
+  }
   if (!list) return;
 
   const isExpanded = list.classList.contains("is-expanded");
@@ -27,9 +33,100 @@ function toggleChapterChildren(chapterId) {
   list.classList.toggle("is-collapsed", isExpanded);
 
   // Toggle aria + open state on the button
-  const toggle = document.getElementById(`chapter-toggle-${chapterId}`);
   if (toggle) {
     toggle.setAttribute("aria-expanded", !isExpanded ? "true" : "false");
     toggle.classList.toggle("is-open", !isExpanded);
   }
 }
+
+// Fetch a chapter's children and append them under its tree node, using the same markup as
+// _chapter_tree_flat.html. Returns the new (collapsed) children list, or null if the request failed.
+async function loadChapterChildren(toggle) {
+  if (toggle.dataset.loading) return null;
+  toggle.dataset.loading = "true";
+
+  try {
+    const response = await fetch(toggle.dataset.childrenUrl, { headers: { Accept: "application/json" } });
+    if (!response.ok) return null;
+    const data = await response.json();
+
+    const chapterId = toggle.id.replace("chapter-toggle-", "");
+    const level = Number(toggle.dataset.level || 0) + 1;
+
+    const list = document.createElement("ul");
+    list.id = `children-${chapterId}`;
+    list.className = "chapter-children is-collapsed";
+    const tree = document.createElement("ul");
+    tree.className = `chapter-tree level-${level}`;
+    data.children.forEach((child) => tree.appendChild(buildChapterNode(child, level)));
+    list.appendChild(tree);
+
+    toggle.closest(".chapter-tree-node").appendChild(list);
+    delete toggle.dataset.childrenUrl;
+    return list;
+  } catch (err) {
+    console.error("Could not load chapter children", err);
+    return null;
+  } finally {
+    delete toggle.dataset.loading;
+  }
+}
+
+function buildChapterNode(child, level) {
+  const item = document.createElement("li");
+  item.className = "chapter-tree-node";
+
+  const inner = document.createElement("div");
+  inner.className = "chapter-tree-node-inner";
+  const pill = document.createElement("div");
+  pill.className = "chapter-node-pill chapter-pill--with-toggle";
+
+  if (child.has_children) {
+    const button = document.createElement("button");
+    button.type = "button";
+    button.className = "chapter-toggle";
+    button.id = `chapter-toggle-${child.id}`;
+    button.setAttribute("aria-controls", `children-${child.id}`);
+    button.setAttribute("aria-expanded", "false");
+    button.dataset.childrenUrl = child.children_url;
+    button.dataset.level = level;
+    button.addEventListener("click", () => toggleChapterChildren(child.id));
+    button.append("▸");
+    const label = document.createElement("span");
+    label.className = "sr-only";
+    label.textContent = `Toggle children of chapter ${child.ordinal}`;
+    button.appendChild(label);
+    pill.appendChild(button);
+  } else {
+    const spacer = document.createElement("span");
+    spacer.className = "chapter-toggle-spacer";
+    pill.appendChild(spacer);
+  }
+
+  const text = document.createElement("div");
+  text.className = "chapter-pill-text";
+
+  const titleRow = document.createElement("div");
+  titleRow.className = "chapter-pill-title-row";
+  const title = document.createElement("a");
+  title.className = "chapter-link-title";
+  title.href = child.url;
+  title.textContent = child.title || "Untitled";
+  titleRow.appendChild(title);
+
+  const meta = document.createElement("div");
+  meta.className = "chapter-meta";
+  const author = document.createElement("a");
+  author.href = child.author_url;
+  author.textContent = child.author;
+  meta.appendChild(author);
+  if (child.date) {
+    meta.append(` · ${child.date}`);
+  }
+
+  text.append(titleRow, meta);
+  pill.appendChild(text);
+  inner.appendChild(pill);
+  item.appendChild(inner);
+  return item;
+}
@@ -1,38 +1,141 @@
 # feathertree/tasks.py
 import os
 from celery import shared_task
-from .models import Chapter
-from .helpers import query_judge
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import Chapter, JudgeVerdict, Story
+from .helpers import (
+    query_judge_cascade, query_judge_batch, previous_text_budget, build_judge_payload, judge_verdict_key,
+    judge_tiers, should_escalate,
+)
+from .caching import bump_story_version, get_judge_verdict, store_judge_verdict
+from .judge_dispatcher import get_dispatcher
+from .judge_context import JudgePromptTooLong, build_previous_text
+from .judge_breaker import JudgeUnavailable
+from .judge_client import judge_model_id
+from .prescreen import DECLINE_SCORE, prescreen
+from .metrics import JUDGE_TIER_DECISIONS, REVIEW_CONTEXT_SECONDS, REVIEW_QUEUE_WAIT, REVIEW_SCORES
 import datetime
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
-@shared_task
-def review_chapter(chapter_id):
+# `enqueued_at` (a time.time() timestamp) is when the review was queued, for the queue wait metric.
+# `attempt` counts the breaker retries earlier tasks already spent on this submission (async dispatch
+# re-queues it as a new task), so FEATHERJUDGE_BREAKER_MAX_RETRIES bounds the total. `urls` and `use_cache`
+# go to the judge calls (see helpers.query_judge), e.g. for judge_loadtest to review against a stand-in.
+@shared_task(bind=True)
+def review_chapter(self, chapter_id, enqueued_at=None, attempt=0, urls=None, use_cache=True):
+    if enqueued_at is not None and not self.request.retries:
+        REVIEW_QUEUE_WAIT.observe(max(0, time.time() - enqueued_at))
+
     # Get chapter by ID
     try:
         chapter = Chapter.objects.get(pk=chapter_id)
     except Chapter.DoesNotExist:
         return 0, f"Chapter with ID {chapter_id} not found."
+    claim_review([chapter_id])
+
+    # Obvious declines are decided locally, without a judge call
+    verdict = prescreen_review(chapter)
+    if verdict is not None:
+        apply_review(chapter, *verdict)
+        return verdict[0]
 
-    previous_text = ""
-    # Walk backward through linked chapters
-    current = chapter
-    while current.previous_chapter is not None:
-        current = current.previous_chapter
-        previous_text = current.content + "\n" + previous_text  # prepend previous content
+    previous_text = review_context(chapter)
+
+    if settings.FEATHERJUDGE_DISPATCH == "async":
+        return dispatch_review(chapter, previous_text, {"attempt": attempt, "urls": urls, "use_cache": use_cache})
 
     # Call LLM and generate score w/ feedback
+    tier = ""
     try:
-        score, feedback = query_judge(previous_text, chapter.content)
-    except:
-        logger.exception("Error in query_judge for chapter with ID: %s", chapter_id)
-        score = 0
-        feedback = "Error querying review system."
-        chapter.submitted_for_review = False
-        chapter.save()
+        score, feedback, tier = query_judge_cascade(previous_text, chapter.content, use_cache=use_cache, urls=urls)
+    except JudgeUnavailable as e:
+        # The judge is down or overloaded: keep the submission and try again once the breaker half-opens
+        if attempt + self.request.retries < settings.FEATHERJUDGE_BREAKER_MAX_RETRIES:
+            countdown = max(e.retry_after, 1)
+            claim_review([chapter_id], delay=countdown)
+            raise self.retry(countdown=countdown, max_retries=None)
+        score, feedback = review_failure(chapter, e)
+    except Exception as e:
+        score, feedback = review_failure(chapter, e)
+
+    apply_review(chapter, score, feedback, tier)
+    return score
+
+
+# Fetch every earlier chapter of this branch in one query, root first, and fit them into the prompt.
+# Older ancestors are covered by the stored summary of the nearest one that doesn't fit verbatim
+@REVIEW_CONTEXT_SECONDS.time()
+def review_context(chapter):
+    ancestors = list(Chapter.objects.ancestors_of(chapter).values_list("content", "summary"))
+    return build_previous_text(
+        [content for content, _ in ancestors],
+        previous_text_budget(chapter.content),
+        summaries=[summary for _, summary in ancestors],
+    )
+
+# review_context for many chapters, with the ancestors of all of them fetched in a single query
+@REVIEW_CONTEXT_SECONDS.time()
+def review_contexts(chapters):
+    ancestor_ids = {pk for chapter in chapters for pk in chapter.ancestor_ids()}
+    ancestors = {
+        pk: (content, summary)
+        for pk, content, summary in Chapter.objects.filter(pk__in=ancestor_ids).values_list("pk", "content", "summary")
+    }
+    contexts = []
+    for chapter in chapters:
+        chain = [ancestors[pk] for pk in chapter.ancestor_ids() if pk in ancestors]
+        contexts.append(build_previous_text(
+            [content for content, _ in chain],
+            previous_text_budget(chapter.content),
+            summaries=[summary for _, summary in chain],
+        ))
+    return contexts
+
+# (score, feedback, "prescreen") for a submission the local pre-screen (prescreen.py) declines, or None to
+# send it to the judge. The chapter is compared with its parent and with the published continuations of that
+# parent; other drafts (pending or declined, perhaps by another author) don't count.
+def prescreen_review(chapter):
+    if not settings.PRESCREEN_ENABLED:
+        return None
+    related = (
+        Chapter.objects.filter(story_id=chapter.story_id)
+        .filter(Q(pk=chapter.previous_chapter_id) | Q(previous_chapter_id=chapter.previous_chapter_id, draft=False))
+        .exclude(pk=chapter.pk)
+        .values_list("pk", "content")
+    )
+    parent_text = None
+    sibling_texts = []
+    for pk, content in related:
+        if pk == chapter.previous_chapter_id:
+            parent_text = content
+        else:
+            sibling_texts.append(content)
+    result = prescreen(chapter.content, parent_text, sibling_texts)
+    if result.decision == "decline":
+        logger.info("Pre-screen declined chapter with ID %s (%s)", chapter.pk, result.reason)
+        return DECLINE_SCORE, result.feedback, "prescreen"
+    return None
 
+# Score and feedback for a chapter whose review raised `error`
+def review_failure(chapter, error):
+    if isinstance(error, JudgeUnavailable):
+        logger.warning("Gave up reviewing chapter with ID %s: %s", chapter.pk, error)
+        return 0, "The review system is temporarily unavailable. Please resubmit later."
+    if isinstance(error, JudgePromptTooLong):
+        logger.warning("Chapter with ID %s is too long to review: %s", chapter.pk, error)
+        return 0, "This chapter is too long for the review system. Please shorten it and resubmit."
+    logger.error("Error in query_judge for chapter with ID: %s", chapter.pk, exc_info=error)
+    return 0, "Error querying review system."
+
+# `tier` is the review stage that decided the score (Chapter.review_tier), empty for failed reviews
+def apply_review(chapter, score, feedback, tier=""):
     # Mark as published (draft=False) if the score exceeds some threshold
     # And update the story last_updated field
     if score > 2:
@@ -46,9 +149,219 @@ def review_chapter(chapter_id):
     # Store score & feedback and indicate review is complete:
     chapter.score = score
     chapter.feedback = feedback
+    chapter.review_tier = tier
     chapter.submitted_for_review = False
+    chapter.review_claimed_at = None
 
     # Save the object:
     chapter.save()
+    REVIEW_SCORES.labels(tier=tier or "failed", score=score).inc()
+
+
+# Async dispatch: hand the judge call to this process's dispatcher and return without waiting for it.
+# Cached verdicts and prompts that can't be sent are settled here. `review` holds the review_chapter
+# arguments the dispatcher needs (attempt, urls, use_cache); it comes back with the verdict.
+def dispatch_review(chapter, previous_text, review):
+    try:
+        payload = build_judge_payload(previous_text, chapter.content)
+    except JudgePromptTooLong as e:
+        score, feedback = review_failure(chapter, e)
+        apply_review(chapter, score, feedback)
+        return score
+    # Walk the cascade through cached verdicts; the dispatcher takes over from the first tier without one
+    tiers = judge_tiers()
+    for index, tier in enumerate(tiers):
+        verdict = get_judge_verdict(judge_verdict_key(payload, tier, review["urls"])) if review["use_cache"] else None
+        if verdict is None:
+            get_dispatcher().submit(chapter.pk, payload, tiers[index:], group=chapter.previous_chapter_id, review=review)
+            return None
+        if not should_escalate(tier, verdict[0]):
+            JUDGE_TIER_DECISIONS.labels(tier=tier).inc()
+            apply_review(chapter, *verdict, tier)
+            return verdict[0]
+
+# Save a batch of dispatcher results, [(chapter_id, verdict key, (score, feedback, tier) or exception,
+# review_chapter arguments)], in one transaction. Publishing goes through apply_review (it moves the chapter
+# into the story tree); declines are a single bulk update.
+def apply_review_results(results):
+    chapters = Chapter.objects.select_related("story").in_bulk([chapter_id for chapter_id, _, _, _ in results])
+    declined = []
+    with transaction.atomic():
+        for chapter_id, key, result, review in results:
+            chapter = chapters.get(chapter_id)
+            if chapter is None:
+                continue
+            attempt = review.get("attempt", 0)
+            if isinstance(result, JudgeUnavailable) and attempt < settings.FEATHERJUDGE_BREAKER_MAX_RETRIES:
+                # Still submitted; review again once the breaker half-opens
+                countdown = max(result.retry_after, 1)
+                claim_review([chapter_id], delay=countdown)
+                review_chapter.apply_async((chapter_id,), {**review, "attempt": attempt + 1}, countdown=countdown)
+                continue
+            tier = ""
+            if isinstance(result, Exception):
+                score, feedback = review_failure(chapter, result)
+            else:
+                score, feedback, tier = result
+                if review.get("use_cache", True):
+                    store_judge_verdict(key, judge_model_id(tier), score, feedback)
+                JUDGE_TIER_DECISIONS.labels(tier=tier).inc()
+            if score > 2:
+                apply_review(chapter, score, feedback, tier)
+            else:
+                chapter.score = score
+                chapter.feedback = feedback
+                chapter.review_tier = tier
+                chapter.submitted_for_review = False
+                chapter.review_claimed_at = None
+                declined.append(chapter)
+                REVIEW_SCORES.labels(tier=tier or "failed", score=score).inc()
+        Chapter.objects.bulk_update(
+            declined, ["score", "feedback", "review_tier", "submitted_for_review", "review_claimed_at"]
+        )
+    # bulk_update sends no signals, so invalidate the affected stories' pages here
+    for story_id in {chapter.story_id for chapter in declined}:
+        bump_story_version(story_id)
+
+
+# Review batching. With FEATHERJUDGE_BATCH_WINDOW > 0, request_review doesn't start a review task per
+# chapter. It schedules one flush_review_batch at the end of the window, and the flush judges all pending
+# submissions (chapters still marked submitted_for_review) together, FEATHERJUDGE_BATCH_SIZE at a time.
+# A full batch doesn't wait for the window: an atomic counter of submissions since the last flush started
+# triggers one every FEATHERJUDGE_BATCH_SIZE. A cache lock keeps concurrent flushes from claiming the same
+# chapters.
+REVIEW_BATCH_SCHEDULED_KEY = "review-batch:scheduled"
+REVIEW_BATCH_PENDING_KEY = "review-batch:pending"
+REVIEW_BATCH_LOCK_KEY = "review-batch:lock"
+
+def request_review(chapter_id):
+    window = settings.FEATHERJUDGE_BATCH_WINDOW
+    if window <= 0:
+        # Claimed from the moment it's queued, so a task message that never arrives leaves a stale claim
+        claim_review([chapter_id])
+        review_chapter.delay(chapter_id=chapter_id, enqueued_at=time.time())
+        return
+    timeout = max(1, int(window))
+    if cache.add(REVIEW_BATCH_SCHEDULED_KEY, True, timeout=timeout):
+        flush_review_batch.apply_async(countdown=window)
+    try:
+        pending = cache.incr(REVIEW_BATCH_PENDING_KEY)
+    except ValueError:  # first submission since the last flush started
+        pending = 1 if cache.add(REVIEW_BATCH_PENDING_KEY, 1, timeout=timeout) else cache.incr(REVIEW_BATCH_PENDING_KEY)
+    if pending % settings.FEATHERJUDGE_BATCH_SIZE == 0:
+        flush_review_batch.delay()
 
-    return score
\ No newline at end of file
+def pending_reviews():
+    return Chapter.objects.filter(draft=True, submitted_for_review=True).order_by("pk")
+
+# Review claims. Queueing a review task, and the task starting, stamp review_claimed_at (a queryset update,
+# so the chapter's timestamp is untouched), and saving the verdict clears it. A review held back for a
+# breaker retry is claimed until the retry is due. A claim older than review_claim_timeout() means the
+# review was lost, in the broker or with its worker: requeue_stale_reviews, run by Celery beat every
+# FEATHERJUDGE_REVIEW_SWEEP_INTERVAL seconds, queues those chapters again. Batched submissions stay
+# unclaimed until a flush takes them, and flush_review_batch leaves chapters with a live claim alone.
+def claim_review(chapter_ids, delay=0):
+    claimed_at = timezone.now() + datetime.timedelta(seconds=delay)
+    Chapter.objects.filter(pk__in=chapter_ids).update(review_claimed_at=claimed_at)
+
+# Longest a live review can hold its claim: the async call deadline, or a sync call per cascade tier
+def review_claim_timeout():
+    sync_call = settings.FEATHERJUDGE_CONNECT_TIMEOUT + settings.FEATHERJUDGE_READ_TIMEOUT
+    seconds = max(settings.FEATHERJUDGE_CALL_DEADLINE, sync_call * len(judge_tiers()))
+    return datetime.timedelta(seconds=seconds + settings.FEATHERJUDGE_REVIEW_CLAIM_MARGIN)
+
+# Pending submissions no live review is working on
+def unclaimed_reviews():
+    stale = timezone.now() - review_claim_timeout()
+    return pending_reviews().filter(Q(review_claimed_at__isnull=True) | Q(review_claimed_at__lt=stale))
+
+@shared_task
+def requeue_stale_reviews():
+    if settings.FEATHERJUDGE_BATCH_WINDOW > 0:
+        # Pending submissions are the flush's to take; start one if the scheduled flush never ran
+        waiting = unclaimed_reviews().count()
+        if waiting and not cache.get(REVIEW_BATCH_SCHEDULED_KEY):
+            logger.warning("Flushing %d pending reviews no review batch is scheduled for", waiting)
+            flush_review_batch.delay()
+        return waiting
+    stale = timezone.now() - review_claim_timeout()
+    chapter_ids = list(pending_reviews().filter(review_claimed_at__lt=stale).values_list("pk", flat=True))
+    # request_review claims them again, so a re-queued task that is lost too is swept up next time
+    for chapter_id in chapter_ids:
+        logger.warning("Re-queueing the review of chapter with ID %s; its last review was lost", chapter_id)
+        request_review(chapter_id)
+    return len(chapter_ids)
+
+# `attempt` counts the consecutive flushes the breaker has turned away, bounded like review_chapter's retries
+@shared_task
+def flush_review_batch(attempt=0):
+    # Submissions from now on need a new flush
+    cache.delete_many([REVIEW_BATCH_SCHEDULED_KEY, REVIEW_BATCH_PENDING_KEY])
+    # The lock outlives any batch (each call is bounded by the read timeout) in case a worker dies holding it
+    lock_timeout = int(settings.FEATHERJUDGE_CONNECT_TIMEOUT + settings.FEATHERJUDGE_READ_TIMEOUT) * 2 + 60
+    if not cache.add(REVIEW_BATCH_LOCK_KEY, True, timeout=lock_timeout):
+        return 0  # another flush is running and will look for more work when it's done
+
+    retry_after = None
+    unavailable = []
+    try:
+        claimed = list(unclaimed_reviews().select_related("story")[:settings.FEATHERJUDGE_BATCH_SIZE])
+        claim_review([chapter.pk for chapter in claimed])
+        chapters = []
+        for chapter in claimed:
+            verdict = prescreen_review(chapter)
+            if verdict is not None:
+                apply_review(chapter, *verdict)
+            else:
+                chapters.append(chapter)
+        results = query_judge_batch(
+            list(zip(review_contexts(chapters), [chapter.content for chapter in chapters])),
+            groups=[chapter.previous_chapter_id for chapter in chapters],
+        )
+        for chapter, result in zip(chapters, results):
+            if isinstance(result, JudgeUnavailable) and attempt < settings.FEATHERJUDGE_BREAKER_MAX_RETRIES:
+                # Left pending (and unclaimed) for a later flush
+                retry_after = max(retry_after or 0, result.retry_after, 1)
+                unavailable.append(chapter.pk)
+                continue
+            if isinstance(result, Exception):
+                result = review_failure(chapter, result)
+            apply_review(chapter, *result)
+    finally:
+        Chapter.objects.filter(pk__in=unavailable).update(review_claimed_at=None)
+        cache.delete(REVIEW_BATCH_LOCK_KEY)
+
+    if retry_after is not None:
+        flush_review_batch.apply_async(kwargs={"attempt": attempt + 1}, countdown=retry_after)
+    elif unclaimed_reviews().exists():
+        flush_review_batch.delay()
+    return len(claimed)
+
+
+# Delete expired and least recently used judge verdicts (see JudgeVerdictManager.evict); run by Celery beat
+@shared_task
+def evict_judge_verdicts():
+    return JudgeVerdict.objects.evict()
+
+
+# Build or refresh the rolling summary of a newly published chapter (and of its published descendants).
+# Published ancestors that were never summarized are filled in first. Safe to run more than once.
+@shared_task
+def summarize_chapter(chapter_id):
+    chapter = Chapter.objects.filter(pk=chapter_id, draft=False).first()
+    if chapter is None:
+        return 0
+    unsummarized = Chapter.objects.ancestors_of(chapter).filter(draft=False, summary_source="").first()
+    return Chapter.objects.refresh_summaries(chapter.story_id, unsummarized or chapter)
+
+# Backfill or refresh the summaries of every published chapter, one story at a time. Up-to-date summaries
+# are skipped, so an interrupted run resumes where it stopped when started again.
+@shared_task
+def summarize_story_chapters(story_ids=None):
+    stories = Story.objects.order_by("pk")
+    if story_ids:
+        stories = stories.filter(pk__in=story_ids)
+    written = 0
+    for story_id in stories.values_list("pk", flat=True).iterator():
+        written += Chapter.objects.refresh_summaries(story_id)
+    return written
@@ -1,5 +1,43 @@
-from django.test import TestCase
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from prometheus_client import REGISTRY, generate_latest
+from feathertree_project.celery import app as celery_app
+from .models import Story, Chapter, ChapterClosure, StoryStats, JudgeVerdict, RescoreRun, ChapterRescore
+from .helpers import (
+    build_chapter_tree, flatten_chapter_tree, query_judge, query_judge_batch, call_featherjudge, call_featherjudge_batch,
+    parse_featherjudge_response,
+    build_judge_payload, previous_text_budget,
+)
+from .judge_standin import start_standin
+from .judge_context import JudgePromptTooLong, build_previous_text, estimate_tokens
+from . import judge_breaker, judge_client, urls
+from .judge_breaker import JudgeUnavailable
+from .tasks import (
+    apply_review_results, claim_review, evict_judge_verdicts, flush_review_batch, request_review, requeue_stale_reviews, review_chapter, review_context, summarize_chapter,
+    summarize_story_chapters, REVIEW_BATCH_SCHEDULED_KEY,
+)
+from .judge_dispatcher import get_dispatcher
+from .tokens import account_activation_token
+from .metrics import metrics_registry
+from .views import story_tree_rows
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import os
+import re
+import requests
+import tempfile
+import time
 
 class UsersManagersTests(TestCase):
     def test_create_user(self):
@@ -37,4 +75,1122 @@ class UsersManagersTests(TestCase):
             pass
         with self.assertRaises(ValueError):
             User.objects.create_superuser(
-                email="super@user.com", password="foo", is_superuser=False)
\ No newline at end of file
+                email="super@user.com", password="foo", is_superuser=False)
+
+
+# Shared fixtures for tests that build chapter trees
+class ChapterTreeTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.author = User.objects.create_user(email="author@user.com", password="foo", display_name="author")
+        self.story = Story.objects.create(title="A Story")
+
+    def add_chapter(self, previous_chapter=None, **fields):
+        ordinal = previous_chapter.ordinal + 1 if previous_chapter else 1
+        return Chapter.objects.create(
+            story=self.story,
+            author=fields.pop("author", self.author),
+            ordinal=ordinal,
+            content=fields.pop("content", f"Chapter {ordinal}"),
+            previous_chapter=previous_chapter,
+            **fields,
+        )
+
+
+class ChapterAncestryTests(ChapterTreeTestCase):
+    def test_path_is_maintained_on_save(self):
+        root = self.add_chapter()
+        child = self.add_chapter(root)
+        grandchild = self.add_chapter(child)
+        self.assertEqual(root.path, "/")
+        self.assertEqual(child.path, f"/{root.pk}/")
+        self.assertEqual(grandchild.path, f"/{root.pk}/{child.pk}/")
+
+    def test_ancestors_of_returns_chain_in_one_query(self):
+        chain = [self.add_chapter()]
+        for _ in range(5):
+            chain.append(self.add_chapter(chain[-1]))
+        with self.assertNumQueries(1):
+            ancestors = list(Chapter.objects.ancestors_of(chain[-1]))
+        self.assertEqual(ancestors, chain[:-1])
+        self.assertEqual(list(Chapter.objects.ancestors_of(chain[0])), [])
+
+    def test_moving_a_chapter_rewrites_descendant_paths(self):
+        root = self.add_chapter()
+        left = self.add_chapter(root)
+        right = self.add_chapter(root)
+        leaf = self.add_chapter(left)
+        left.previous_chapter = right
+        left.save()
+        leaf.refresh_from_db()
+        self.assertEqual(leaf.path, f"/{root.pk}/{right.pk}/{left.pk}/")
+        self.assertEqual(list(Chapter.objects.ancestors_of(leaf)), [root, right, left])
+
+    def test_deep_paths_are_stored_whole(self):
+        # Large ids make a branch a few hundred chapters deep run past the old 2048-character column and
+        # PostgreSQL's btree entry limit (about 2.7 kB)
+        chain = [self.add_chapter(pk=10**9)]
+        for _ in range(300):
+            chain.append(self.add_chapter(chain[-1], pk=chain[-1].pk + 1))
+        leaf = Chapter.objects.get(pk=chain[-1].pk)
+        self.assertGreater(len(leaf.path), 3000)
+        self.assertEqual(leaf.ancestor_ids(), [chapter.pk for chapter in chain[:-1]])
+        self.assertEqual(list(Chapter.objects.ancestors_of(leaf)), chain[:-1])
+
+
+class ChapterClosureTests(ChapterTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        # root -> a -> a1, a2 (draft); root -> b
+        self.root = self.add_chapter(draft=False)
+        self.a = self.add_chapter(self.root, draft=False)
+        self.a1 = self.add_chapter(self.a, draft=False)
+        self.a2 = self.add_chapter(self.a)
+        self.b = self.add_chapter(self.root, draft=False)
+
+    def test_links_are_created_with_chapters(self):
+        depths = dict(ChapterClosure.objects.filter(descendant=self.a1).values_list("ancestor_id", "depth"))
+        self.assertEqual(depths, {self.a1.pk: 0, self.a.pk: 1, self.root.pk: 2})
+
+    def test_descendants_and_leaves(self):
+        with self.assertNumQueries(1):
+            descendants = list(Chapter.objects.descendants_of(self.root))
+        self.assertEqual(descendants, [self.a, self.b, self.a1, self.a2])
+        self.assertEqual(set(Chapter.objects.leaves_of(self.root)), {self.a1, self.a2, self.b})
+        self.assertEqual(set(Chapter.objects.leaves_of(self.a, published_only=True)), {self.a1})
+
+    def test_subtree_stats(self):
+        root = Chapter.objects.with_subtree_stats().get(pk=self.root.pk)
+        self.assertEqual((root.subtree_size, root.subtree_height), (5, 2))
+        a = Chapter.objects.with_subtree_stats(published_only=True).get(pk=self.a.pk)
+        self.assertEqual((a.subtree_size, a.subtree_height), (2, 1))
+
+    def test_links_follow_moves_and_deletes(self):
+        self.a.previous_chapter = self.b
+        self.a.save()
+        self.assertEqual(ChapterClosure.objects.get(ancestor=self.root, descendant=self.a1).depth, 3)
+        self.assertTrue(ChapterClosure.objects.filter(ancestor=self.b, descendant=self.a2).exists())
+        self.a.delete()
+        self.assertFalse(ChapterClosure.objects.filter(descendant_id__in=[self.a1.pk, self.a2.pk]).exists())
+
+
+class ChapterPreorderTests(ChapterTreeTestCase):
+    def publish(self, chapter):
+        chapter.draft = False
+        chapter.save()
+
+    def preorder(self):
+        return list(
+            Chapter.objects.filter(story=self.story, preorder__isnull=False)
+            .order_by("preorder").values_list("title", "depth")
+        )
+
+    def test_published_chapters_are_placed_after_older_siblings(self):
+        root = self.add_chapter(title="root", draft=False)
+        a = self.add_chapter(root, title="a", draft=False)
+        b = self.add_chapter(root, title="b")
+        self.add_chapter(a, title="a1", draft=False)
+        self.assertEqual(self.preorder(), [("root", 0), ("a", 1), ("a1", 2)])
+        self.publish(b)
+        self.add_chapter(b, title="b1", draft=False)
+        self.add_chapter(a, title="a2", draft=False)
+        self.assertEqual(
+            self.preorder(),
+            [("root", 0), ("a", 1), ("a1", 2), ("a2", 2), ("b", 1), ("b1", 2)],
+        )
+
+    def test_children_of_drafts_are_placed_when_the_draft_is_published(self):
+        root = self.add_chapter(title="root", draft=False)
+        a = self.add_chapter(root, title="a")
+        self.add_chapter(a, title="a1", draft=False)
+        self.add_chapter(root, title="b", draft=False)
+        self.assertEqual(self.preorder(), [("root", 0), ("b", 1)])
+        self.publish(a)
+        self.assertEqual(self.preorder(), [("root", 0), ("b", 1), ("a", 1), ("a1", 2)])
+
+    @override_settings(STORY_TREE_INITIAL_LEVELS=0)
+    def test_story_view_renders_tree_in_preorder(self):
+        root = self.add_chapter(title="root", draft=False)
+        a = self.add_chapter(root, title="a", draft=False)
+        self.add_chapter(root, title="hidden draft")
+        self.add_chapter(a, title="a1", draft=False)
+        rows = story_tree_rows(self.story.pk, 0)
+        self.assertEqual([(row["chapter"].title, row["level"]) for row in rows], [("root", 0), ("a", 1), ("a1", 2)])
+        response = self.client.get(reverse("feathertree:story_view", args=[self.story.pk]))
+        self.assertContains(response, "a1")
+        self.assertNotContains(response, "hidden draft")
+
+    def test_flat_and_recursive_tree_templates_render_the_same_markup(self):
+        root = self.add_chapter(title="root", draft=False)
+        a = self.add_chapter(root, title="a", draft=False)
+        a1 = self.add_chapter(a, title="a1", draft=False)
+        self.add_chapter(a1, title="a1x", draft=False)
+        self.add_chapter(a, title="a2", draft=False)
+        self.add_chapter(root, title="b", draft=False)
+        self.add_chapter(title="second root", draft=False)
+        chapters = list(Chapter.objects.filter(story=self.story).order_by("preorder"))
+
+        recursive = render_to_string("feathertree/_chapter_tree.html", {"nodes": build_chapter_tree(chapters), "level": 0})
+        flat = render_to_string("feathertree/_chapter_tree_flat.html", {"rows": flatten_chapter_tree(chapters)})
+        strip = lambda html: re.sub(r"\s+", "", html)
+        self.assertEqual(strip(flat), strip(recursive))
+
+    @override_settings(STORY_TREE_INITIAL_LEVELS=2)
+    def test_story_view_defers_deep_levels_to_children_endpoint(self):
+        root = self.add_chapter(title="root", draft=False)
+        a = self.add_chapter(root, title="a", draft=False)
+        a1 = self.add_chapter(a, title="a1", draft=False)
+        self.add_chapter(a1, title="a1x", draft=False)
+        self.add_chapter(a, title="a draft")
+        self.add_chapter(root, title="b", draft=False)
+
+        rows = story_tree_rows(self.story.pk, 2)
+        self.assertEqual([(row["chapter"].title, row["is_lazy"]) for row in rows], [("root", False), ("a", True), ("b", False)])
+        response = self.client.get(reverse("feathertree:story_view", args=[self.story.pk]))
+        self.assertContains(response, reverse("feathertree:chapter_children", args=[a.pk]))
+
+        response = self.client.get(reverse("feathertree:chapter_children", args=[a.pk]))
+        self.assertIn("max-age", response["Cache-Control"])
+        children = response.json()["children"]
+        self.assertEqual([(child["title"], child["has_children"]) for child in children], [("a1", True)])
+
+        children_url = reverse("feathertree:chapter_children", args=[a.pk])
+        not_modified = self.client.get(children_url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(not_modified.status_code, 304)
+
+        # Unpublishing a child doesn't touch Story.last_updated, but still changes the listing
+        a1.draft = True
+        a1.save()
+        response = self.client.get(children_url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["children"], [])
+
+        # An unpublished parent is a 404, without a validator a later request could revalidate against
+        etag = response["ETag"]
+        a.draft = True
+        a.save()
+        response = self.client.get(children_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.has_header("ETag"))
+
+
+class StoryStatsTests(ChapterTreeTestCase):
+    def stats(self):
+        stats = StoryStats.objects.get(story=self.story)
+        return {name: getattr(stats, name) for name in ["chapter_count", "draft_count", "branch_count", "max_depth", "word_count", "contributor_count"]}
+
+    def assertStatsMatchRecompute(self):
+        incremental = self.stats()
+        StoryStats.objects.recompute(self.story.pk)
+        self.assertEqual(incremental, self.stats())
+
+    def test_stats_follow_drafts_publishes_and_deletes(self):
+        User = get_user_model()
+        other = User.objects.create_user(email="other@user.com", password="foo", display_name="other")
+        root = self.add_chapter(content="one two three", draft=False)
+        a = self.add_chapter(root, content="four five")
+        self.assertEqual(self.stats(), {
+            "chapter_count": 1, "draft_count": 1, "branch_count": 1,
+            "max_depth": 1, "word_count": 3, "contributor_count": 1,
+        })
+
+        a = Chapter.objects.get(pk=a.pk)
+        a.draft = False
+        a.save()
+        self.add_chapter(root, content="six", draft=False, author=other)
+        self.assertEqual(self.stats(), {
+            "chapter_count": 3, "draft_count": 0, "branch_count": 2,
+            "max_depth": 2, "word_count": 6, "contributor_count": 2,
+        })
+        self.assertStatsMatchRecompute()
+
+        self.add_chapter(a, content="seven", draft=False)
+        a.delete()
+        self.assertEqual(self.stats()["chapter_count"], 2)
+        self.assertStatsMatchRecompute()
+
+
+class StoriesPaginationTests(TestCase):
+    def setUp(self):
+        for i in range(25):
+            Story.objects.create(title=f"Story {i}")
+
+    def test_cursor_pages_walk_forward_and_back(self):
+        url = reverse("feathertree:stories")
+        titles = list(Story.objects.order_by("-last_updated", "-pk").values_list("title", flat=True))
+
+        first = self.client.get(url).context["stories_page"]
+        self.assertEqual([story.title for story in first], titles[:10])
+        self.assertFalse(first.has_previous)
+
+        second = self.client.get(url, {"after": first.next_cursor}).context["stories_page"]
+        self.assertEqual([story.title for story in second], titles[10:20])
+
+        third = self.client.get(url, {"after": second.next_cursor}).context["stories_page"]
+        self.assertEqual([story.title for story in third], titles[20:])
+        self.assertIsNone(third.next_cursor)
+
+        back = self.client.get(url, {"before": third.previous_cursor}).context["stories_page"]
+        self.assertEqual([story.title for story in back], titles[10:20])
+        self.assertTrue(back.has_previous)
+
+    def test_bad_cursor_falls_back_to_first_page(self):
+        page = self.client.get(reverse("feathertree:stories"), {"after": "not-a-cursor"}).context["stories_page"]
+        self.assertEqual(len(page), 10)
+        self.assertFalse(page.has_previous)
+
+    @override_settings(STORIES_NUMBERED_PAGES=True)
+    def test_numbered_mode(self):
+        page = self.client.get(reverse("feathertree:stories"), {"page": 3}).context["stories_page"]
+        self.assertEqual(page.number, 3)
+        self.assertEqual(len(page.object_list), 5)
+
+
+class PageCacheTests(ChapterTreeTestCase):
+    def test_cached_pages_follow_chapter_changes(self):
+        root = self.add_chapter(title="root", draft=False)
+        child = self.add_chapter(root, title="the sequel")
+        story_url = reverse("feathertree:story_view", args=[self.story.pk])
+        chapter_url = reverse("feathertree:chapter_view", args=[root.pk])
+
+        self.assertNotContains(self.client.get(story_url), "the sequel")
+        self.assertNotContains(self.client.get(chapter_url), "the sequel")
+        with self.assertNumQueries(2):  # the ETag lookup and the story; the tree comes from the cache
+            self.client.get(story_url)
+
+        child = Chapter.objects.get(pk=child.pk)
+        child.draft = False
+        child.save()
+        self.assertContains(self.client.get(story_url), "the sequel")
+        self.assertContains(self.client.get(chapter_url), "the sequel")
+
+        child.delete()
+        self.assertNotContains(self.client.get(story_url), "the sequel")
+
+    def test_rendered_tree_fragment_is_cached_per_viewer_class(self):
+        self.add_chapter(title="root", draft=False)
+        story_url = reverse("feathertree:story_view", args=[self.story.pk])
+        fragment = f"chapter_tree:{settings.STORY_TREE_INITIAL_LEVELS}"
+        count = lambda result: REGISTRY.get_sample_value(
+            "feathertree_fragment_cache_requests_total", {"fragment": fragment, "result": result}
+        ) or 0
+        hits_before, misses_before = count("hit"), count("miss")
+
+        self.client.get(story_url)
+        self.client.get(story_url)
+        self.client.force_login(self.author)
+        self.client.get(story_url)
+        self.assertEqual(count("hit") - hits_before, 1)
+        self.assertEqual(count("miss") - misses_before, 2)
+
+    def test_conditional_get_returns_304_until_something_changes(self):
+        root = self.add_chapter(title="root", draft=False)
+        draft = self.add_chapter(root, title="work in progress")
+        story_url = reverse("feathertree:story_view", args=[self.story.pk])
+        chapter_url = reverse("feathertree:chapter_view", args=[root.pk])
+        stories_url = reverse("feathertree:stories")
+
+        for url in (story_url, chapter_url, stories_url):
+            etag = self.client.get(url)["ETag"]
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # Signed-in viewers get their own validators, and drafts are always rendered fresh
+        anonymous_etag = self.client.get(story_url)["ETag"]
+        self.client.force_login(self.author)
+        self.assertNotEqual(self.client.get(story_url)["ETag"], anonymous_etag)
+        draft_url = reverse("feathertree:chapter_view", args=[draft.pk])
+        self.assertFalse(self.client.get(draft_url).has_header("ETag"))
+
+        etag = self.client.get(story_url)["ETag"]
+        draft = Chapter.objects.get(pk=draft.pk)
+        draft.draft = False
+        draft.save()
+        self.assertContains(self.client.get(story_url, HTTP_IF_NONE_MATCH=etag), "work in progress")
+
+
+class JudgeClientTests(TestCase):
+    def setUp(self):
+        self.server = start_standin()
+        self.addCleanup(self.server.shutdown)
+        judge_client.reset_session()
+        cache.clear()
+
+    def test_judge_calls_reuse_one_session_per_process(self):
+        with override_settings(FEATHERJUDGE_URL=self.server.url):
+            self.assertEqual(query_judge("Once upon a time.", "Then it ended."), (4, "The continuation follows on naturally."))
+            session = judge_client.get_session()
+            query_judge("Once upon a time.", "Then it ended.", use_cache=False)
+            self.assertEqual(self.server.requests_served, 2)
+            self.assertIs(judge_client.get_session(), session)
+
+            # A forked child must not reuse its parent's connections
+            judge_client.reset_session()
+            self.assertIsNot(judge_client.get_session(), session)
+
+    def test_identical_judge_calls_are_answered_from_the_verdict_cache(self):
+        with override_settings(FEATHERJUDGE_URL=self.server.url):
+            first = query_judge("Once upon a time.", "Then it ended.")
+            self.assertEqual(query_judge("Once upon a time.", "Then it ended."), first)
+            self.assertEqual(self.server.requests_served, 1)
+
+            # Redis is only a front: the verdict survives a cache flush
+            cache.clear()
+            self.assertEqual(query_judge("Once upon a time.", "Then it ended."), first)
+            self.assertEqual(self.server.requests_served, 1)
+
+            query_judge("Once upon a time.", "Then it went on.")
+            self.assertEqual(self.server.requests_served, 2)
+
+            # A new model behind the same URL doesn't get the old model's verdicts
+            with override_settings(FEATHERJUDGE_MODEL_ID="another-model"):
+                query_judge("Once upon a time.", "Then it went on.")
+            self.assertEqual(self.server.requests_served, 3)
+
+        with override_settings(FEATHERJUDGE_VERDICT_MAX_ENTRIES=2):
+            self.assertEqual(evict_judge_verdicts(), 1)
+        with override_settings(FEATHERJUDGE_VERDICT_TTL=0):
+            self.assertEqual(evict_judge_verdicts(), 2)
+        self.assertIn("evict-judge-verdicts", settings.CELERY_BEAT_SCHEDULE)
+
+    def test_redis_hits_keep_verdicts_from_being_evicted(self):
+        with override_settings(FEATHERJUDGE_URL=self.server.url):
+            query_judge("Once upon a time.", "Then it ended.")
+            query_judge("Once upon a time.", "Then it went on.")
+            hot = JudgeVerdict.objects.order_by("created_at").first()
+            JudgeVerdict.objects.filter(pk=hot.pk).update(last_used_at=timezone.now() - timedelta(days=1))
+
+            # Served from Redis, recorded once per touch interval
+            for _ in range(3):
+                query_judge("Once upon a time.", "Then it ended.")
+            self.assertEqual(self.server.requests_served, 2)
+        hot.refresh_from_db()
+        self.assertEqual(hot.hit_count, 1)
+        with override_settings(FEATHERJUDGE_VERDICT_MAX_ENTRIES=1):
+            JudgeVerdict.objects.evict()
+        self.assertEqual(list(JudgeVerdict.objects.values_list("pk", flat=True)), [hot.pk])
+
+
+class ChapterSummaryTests(ChapterTreeTestCase):
+    def test_summaries_roll_down_each_branch_and_refresh_idempotently(self):
+        root = self.add_chapter(draft=False, content="A fox found a key. It was old. The fox hid it.")
+        child = self.add_chapter(root, draft=False, content="A crow saw everything.")
+        self.add_chapter(child, content="Still a draft.")
+
+        self.assertEqual(summarize_story_chapters(), 2)
+        child.refresh_from_db()
+        self.assertEqual(child.summary, "A fox found a key. ... The fox hid it.\nA crow saw everything.")
+        self.assertEqual(summarize_story_chapters(), 0)  # nothing changed, nothing rewritten
+
+        # An edited ancestor refreshes its whole published subtree
+        Chapter.objects.filter(pk=root.pk).update(content="A wolf found a key.")
+        self.assertEqual(summarize_chapter(root.pk), 2)
+        child.refresh_from_db()
+        self.assertTrue(child.summary.startswith("A wolf found a key."))
+
+    def test_review_context_uses_summary_beyond_verbatim_ancestors(self):
+        ancestors = ["Opening. " + "word " * 300, "Middle. " + "word " * 300, "Recent chapter."]
+        summaries = ["Opening.", "Opening.\nMiddle.", "Opening.\nMiddle.\nRecent chapter."]
+        previous_text = build_previous_text(ancestors, 200, summaries=summaries)
+        self.assertEqual(previous_text, "[Summary of earlier chapters]\nOpening.\nMiddle.\nRecent chapter.\n")
+
+
+# Submissions here are placeholders that the local pre-screen would decline
+@override_settings(PRESCREEN_ENABLED=False)
+class ReviewBatchTests(ChapterTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = start_standin()
+        self.addCleanup(self.server.shutdown)
+        root = self.add_chapter(draft=False, content="It began.")
+        self.submissions = [
+            self.add_chapter(root, submitted_for_review=True, content=f"Continuation {n}.") for n in range(3)
+        ]
+
+    def assertAllPublished(self):
+        for chapter in self.submissions:
+            chapter.refresh_from_db()
+            self.assertEqual((chapter.draft, chapter.submitted_for_review, chapter.score), (False, False, 4))
+
+    def test_flush_fans_out_pending_reviews(self):
+        # Leftover submissions are flushed by a follow-up task, run inline here
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        with override_settings(FEATHERJUDGE_URL=self.server.url, FEATHERJUDGE_BATCH_SIZE=2):
+            self.assertEqual(flush_review_batch(), 2)
+        self.assertEqual(self.server.requests_served, 3)
+        self.assertAllPublished()
+
+    def test_flush_uses_batch_endpoint(self):
+        with override_settings(FEATHERJUDGE_URL=self.server.url, FEATHERJUDGE_BATCH_URL=self.server.batch_url):
+            self.assertEqual(flush_review_batch(), 3)
+        self.assertEqual(self.server.requests_served, 1)
+        self.assertAllPublished()
+
+    @override_settings(FEATHERJUDGE_BATCH_WINDOW=60, FEATHERJUDGE_BATCH_SIZE=2)
+    def test_a_full_batch_is_flushed_before_the_window_ends(self):
+        with mock.patch.object(flush_review_batch, "apply_async") as scheduled, \
+                mock.patch.object(flush_review_batch, "delay") as early:
+            request_review(self.submissions[0].pk)
+            self.assertFalse(early.called)
+            request_review(self.submissions[1].pk)
+            self.assertEqual(early.call_count, 1)
+            request_review(self.submissions[2].pk)
+        scheduled.assert_called_once_with(countdown=60)
+        self.assertEqual(early.call_count, 1)
+
+    def test_flush_leaves_reviews_in_flight_alone(self):
+        in_flight = self.submissions[0]
+        claim_review([in_flight.pk])
+        with override_settings(FEATHERJUDGE_URL=self.server.url):
+            self.assertEqual(flush_review_batch(), 2)
+        in_flight.refresh_from_db()
+        self.assertTrue(in_flight.submitted_for_review)
+
+    def test_lost_reviews_are_requeued(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        lost, in_flight = self.submissions[:2]
+        claim_review([lost.pk], delay=-3600)
+        claim_review([in_flight.pk])
+        with override_settings(FEATHERJUDGE_URL=self.server.url), self.assertLogs("feathertree.tasks", "WARNING"):
+            self.assertEqual(requeue_stale_reviews(), 1)
+        lost.refresh_from_db()
+        in_flight.refresh_from_db()
+        self.assertEqual((lost.draft, lost.submitted_for_review, lost.review_claimed_at), (False, False, None))
+        self.assertTrue(in_flight.submitted_for_review)
+
+    def test_reviews_lost_in_the_broker_are_requeued(self):
+        chapter = self.submissions[0]
+        # The task message is lost before the review starts, and so is the one the first sweep sends
+        with mock.patch.object(review_chapter, "delay") as lost:
+            request_review(chapter.pk)
+            chapter.refresh_from_db()
+            self.assertIsNotNone(chapter.review_claimed_at)
+            claim_review([chapter.pk], delay=-3600)
+            with self.assertLogs("feathertree.tasks", "WARNING"):
+                self.assertEqual(requeue_stale_reviews(), 1)
+            chapter.refresh_from_db()
+            self.assertIsNotNone(chapter.review_claimed_at)
+            claim_review([chapter.pk], delay=-3600)
+        self.assertEqual(lost.call_count, 2)
+
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        with override_settings(FEATHERJUDGE_URL=self.server.url), self.assertLogs("feathertree.tasks", "WARNING"):
+            self.assertEqual(requeue_stale_reviews(), 1)
+        chapter.refresh_from_db()
+        self.assertEqual((chapter.draft, chapter.submitted_for_review, chapter.review_claimed_at), (False, False, None))
+
+    def test_reviews_can_target_another_judge_without_the_verdict_cache(self):
+        chapter = self.submissions[0]
+        review_chapter.apply(args=(chapter.pk,), kwargs={"urls": {"large": self.server.url}, "use_cache": False})
+        chapter.refresh_from_db()
+        self.assertEqual((chapter.draft, chapter.score), (False, 4))
+        self.assertEqual(self.server.requests_served, 1)
+        self.assertFalse(JudgeVerdict.objects.exists())
+
+    @override_settings(FEATHERJUDGE_BATCH_WINDOW=60)
+    def test_lost_batch_flushes_are_restarted(self):
+        with mock.patch.object(flush_review_batch, "apply_async"):
+            request_review(self.submissions[0].pk)  # the scheduled flush never runs
+        with mock.patch.object(flush_review_batch, "delay") as flush:
+            self.assertEqual(requeue_stale_reviews(), 3)
+            self.assertFalse(flush.called)  # still waiting for the window
+            cache.delete(REVIEW_BATCH_SCHEDULED_KEY)  # the window is over
+            with self.assertLogs("feathertree.tasks", "WARNING"):
+                requeue_stale_reviews()
+        flush.assert_called_once_with()
+
+    @override_settings(FEATHERJUDGE_BREAKER_MAX_RETRIES=2)
+    def test_breaker_retries_are_bounded_across_requeues(self):
+        unavailable = lambda pairs, **kwargs: [JudgeUnavailable(5) for _ in pairs]
+        with mock.patch("feathertree.tasks.query_judge_batch", unavailable), \
+                mock.patch.object(flush_review_batch, "apply_async") as reschedule:
+            flush_review_batch(attempt=1)
+            reschedule.assert_called_once_with(kwargs={"attempt": 2}, countdown=5)
+            flush_review_batch(attempt=2)
+        for chapter in self.submissions:
+            chapter.refresh_from_db()
+            self.assertFalse(chapter.submitted_for_review)
+            self.assertIn("temporarily unavailable", chapter.feedback)
+
+    @override_settings(FEATHERJUDGE_BREAKER_MAX_RETRIES=2)
+    def test_dispatcher_requeues_are_bounded(self):
+        retried, given_up = self.submissions[:2]
+        with mock.patch.object(review_chapter, "apply_async") as requeue:
+            apply_review_results([
+                (retried.pk, "key", JudgeUnavailable(5), {"attempt": 1}),
+                (given_up.pk, "key", JudgeUnavailable(5), {"attempt": 2}),
+            ])
+        requeue.assert_called_once_with((retried.pk,), {"attempt": 2}, countdown=5)
+        retried.refresh_from_db()
+        given_up.refresh_from_db()
+        self.assertTrue(retried.submitted_for_review)
+        self.assertFalse(given_up.submitted_for_review)
+
+
+# The dispatcher saves verdicts from its own thread, so the data has to be committed
+@override_settings(PRESCREEN_ENABLED=False)
+class JudgeDispatcherTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        # Publishing queues summarize_chapter on commit; run it inline rather than through a broker
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        self.server = start_standin(latency=0.05)
+        self.addCleanup(self.server.shutdown)
+        author = get_user_model().objects.create_user(email="author@user.com", password="foo")
+        story = Story.objects.create(title="A Story")
+        root = Chapter.objects.create(story=story, author=author, ordinal=1, content="It began.", draft=False)
+        self.submissions = [
+            Chapter.objects.create(
+                story=story, author=author, ordinal=2, content=f"Continuation {n}.",
+                previous_chapter=root, submitted_for_review=True,
+            )
+            for n in range(20)
+        ]
+
+    def test_async_reviews_run_concurrently_and_are_saved_in_batches(self):
+        with override_settings(FEATHERJUDGE_URL=self.server.url, FEATHERJUDGE_DISPATCH="async"):
+            for chapter in self.submissions:
+                self.assertIsNone(review_chapter(chapter.pk))
+            self.assertTrue(get_dispatcher().drain(timeout=10))
+
+        self.assertEqual(self.server.requests_served, 20)
+        published = Chapter.objects.filter(pk__in=[c.pk for c in self.submissions], draft=False, score=4)
+        self.assertEqual(published.count(), 20)
+
+    def test_async_reviews_can_target_another_judge_without_the_verdict_cache(self):
+        urls = {"large": self.server.url}
+        with override_settings(FEATHERJUDGE_DISPATCH="async"):
+            for chapter in self.submissions[:3]:
+                self.assertIsNone(review_chapter(chapter.pk, urls=urls, use_cache=False))
+            self.assertTrue(get_dispatcher().drain(timeout=10))
+        self.assertEqual(self.server.requests_served, 3)
+        self.assertEqual(Chapter.objects.filter(draft=False, score=4).count(), 3)
+        self.assertFalse(JudgeVerdict.objects.exists())
+
+
+class PrescreenTests(ChapterTreeTestCase):
+    PARENT = (
+        "The lighthouse keeper climbed the stairs at dusk, counting each step as her father had taught her. "
+        "At the top she found the lamp already burning and a stranger's coat folded on the chair."
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.server = start_standin()
+        self.addCleanup(self.server.shutdown)
+        self.root = self.add_chapter(draft=False, content=self.PARENT)
+
+    def decisions(self, decision, reason):
+        return REGISTRY.get_sample_value(
+            "feathertree_prescreen_decisions_total", {"decision": decision, "reason": reason}
+        ) or 0
+
+    def review(self, content):
+        chapter = self.add_chapter(self.root, submitted_for_review=True, content=content)
+        with override_settings(FEATHERJUDGE_URL=self.server.url):
+            review_chapter(chapter.pk)
+        chapter.refresh_from_db()
+        return chapter
+
+    def test_obvious_failures_are_declined_without_a_judge_call(self):
+        short_before = self.decisions("decline", "too_short")
+        copy_before = self.decisions("decline", "copy_of_parent")
+
+        short = self.review("The end.")
+        copy = self.review(self.PARENT)
+
+        self.assertEqual(self.server.requests_served, 0)
+        for chapter in (short, copy):
+            self.assertEqual((chapter.draft, chapter.submitted_for_review, chapter.score), (True, False, 1))
+            self.assertEqual(chapter.review_tier, "prescreen")
+        self.assertIn("too short", short.feedback)
+        self.assertIn("repeats the chapter it continues", copy.feedback)
+        self.assertEqual(self.decisions("decline", "too_short"), short_before + 1)
+        self.assertEqual(self.decisions("decline", "copy_of_parent"), copy_before + 1)
+
+    def test_plausible_continuations_are_forwarded(self):
+        forwarded_before = self.decisions("forward", "ambiguous")
+        chapter = self.review(
+            "She lifted the coat and a brass key slipped from its pocket, ringing on the iron floor. "
+            "Below, the door she had locked behind her creaked open, and slow footsteps began to climb."
+        )
+        self.assertEqual(self.server.requests_served, 1)
+        self.assertEqual((chapter.draft, chapter.score), (False, 4))
+        self.assertEqual(self.decisions("forward", "ambiguous"), forwarded_before + 1)
+
+    def test_only_published_siblings_count_as_duplicates(self):
+        text = (
+            "She lifted the coat and a brass key slipped from its pocket, ringing on the iron floor. "
+            "Below, the door she had locked behind her creaked open, and slow footsteps began to climb."
+        )
+        other_author = get_user_model().objects.create_user(email="other@user.com", password="foo")
+        self.add_chapter(self.root, author=other_author, content=text)  # someone else's pending draft
+        chapter = self.review(text)
+        self.assertEqual((chapter.draft, chapter.score), (False, 4))
+
+        duplicate = self.review(text)
+        self.assertEqual((duplicate.draft, duplicate.review_tier), (True, "prescreen"))
+        self.assertIn("duplicates another continuation", duplicate.feedback)
+
+
+class JudgeCascadeTests(ChapterTreeTestCase):
+    CONTINUATION = (
+        "She lifted the coat and a brass key slipped from its pocket, ringing on the iron floor. "
+        "Below, the door she had locked behind her creaked open, and slow footsteps began to climb."
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.root = self.add_chapter(draft=False, content=PrescreenTests.PARENT)
+
+    def review(self, small_score):
+        small = start_standin(scores=(small_score,))
+        large = start_standin(scores=(5,))
+        for server in (small, large):
+            self.addCleanup(server.shutdown)
+        chapter = self.add_chapter(self.root, submitted_for_review=True, content=self.CONTINUATION)
+        with override_settings(
+            FEATHERJUDGE_SMALL_MODEL_ID="small", FEATHERJUDGE_SMALL_URL=small.url, FEATHERJUDGE_URL=large.url
+        ):
+            review_chapter(chapter.pk)
+        chapter.refresh_from_db()
+        return chapter, small.requests_served, large.requests_served
+
+    def test_confident_small_model_score_is_final(self):
+        chapter, small_calls, large_calls = self.review(small_score=4)
+        self.assertEqual((small_calls, large_calls), (1, 0))
+        self.assertEqual((chapter.draft, chapter.score, chapter.review_tier), (False, 4, "small"))
+
+    def test_ambiguous_small_model_score_escalates(self):
+        chapter, small_calls, large_calls = self.review(small_score=3)
+        self.assertEqual((small_calls, large_calls), (1, 1))
+        self.assertEqual((chapter.draft, chapter.score, chapter.review_tier), (False, 5, "large"))
+
+    @override_settings(FEATHERJUDGE_BREAKER_FAILURES=1, FEATHERJUDGE_BREAKER_COOLDOWN=60)
+    def test_unavailable_small_model_escalates(self):
+        judge_breaker.reset_state()
+        self.addCleanup(judge_breaker.reset_state)
+        judge_breaker.get_breaker("small").record_failure()
+        chapter, small_calls, large_calls = self.review(small_score=4)
+        self.assertEqual((small_calls, large_calls), (0, 1))
+        self.assertEqual((chapter.draft, chapter.score, chapter.review_tier), (False, 5, "large"))
+
+    def test_evaluation_reports_agreement_and_savings(self):
+        small = start_standin(scores=(4,))
+        large = start_standin(scores=(5,))
+        for server in (small, large):
+            self.addCleanup(server.shutdown)
+        out = StringIO()
+        call_command("evaluate_judge_cascade", small_url=small.url, large_url=large.url, stdout=out)
+        output = out.getvalue()
+        # The example script has a good and a bad continuation; neither is escalated
+        self.assertIn("2 pairs scored, 0 escalated", output)
+        self.assertIn("score agreement:       0.0%", output)
+        self.assertIn("publish agreement:   100.0%", output)
+        self.assertIn("cost savings: 80.0%", output)
+
+
+class RescoreTests(ChapterTreeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = start_standin(scores=(2,))
+        self.addCleanup(self.server.shutdown)
+        root = self.add_chapter(draft=False, content="It began.")
+        self.published = [root] + [self.add_chapter(root, draft=False, content=f"Branch {n}.") for n in range(3)]
+        self.draft = self.add_chapter(root, content="Not yet.")
+
+    def rescore(self, **options):
+        with override_settings(FEATHERJUDGE_URL=self.server.url, FEATHERJUDGE_VERDICT_TTL=0):
+            call_command("rescore", run="test", chunk_size=2, stdout=StringIO(), **options)
+
+    def test_rescore_writes_scores_without_touching_chapters(self):
+        self.rescore()
+
+        run = RescoreRun.objects.get(name="test")
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual((run.scored, run.failed, run.last_chapter_id), (4, 0, self.published[-1].pk))
+        self.assertEqual(
+            sorted(ChapterRescore.objects.filter(run=run).values_list("chapter_id", "score")),
+            [(chapter.pk, 2) for chapter in self.published],
+        )
+        # A score of 2 would decline a submission, but rescoring leaves publish state alone
+        self.assertEqual(Chapter.objects.filter(draft=False).count(), 4)
+        self.assertFalse(Chapter.objects.filter(score=2).exists())
+
+    def test_interrupted_run_resumes_after_its_checkpoint(self):
+        self.rescore()
+        # As if the process died after the first chunk was saved
+        run = RescoreRun.objects.get(name="test")
+        ChapterRescore.objects.filter(run=run, chapter__in=self.published[2:]).delete()
+        RescoreRun.objects.filter(pk=run.pk).update(
+            last_chapter_id=self.published[1].pk, scored=2, finished_at=None
+        )
+
+        self.rescore()
+        self.assertEqual(self.server.requests_served, 4 + 2)
+        self.assertEqual(ChapterRescore.objects.filter(run=run).count(), 4)
+
+    def test_parallelism_is_passed_to_the_judge_client(self):
+        fanout = settings.FEATHERJUDGE_FANOUT
+        with mock.patch(
+            "feathertree.management.commands.rescore.query_judge_batch", wraps=query_judge_batch
+        ) as batch:
+            self.rescore(parallel=fanout + 4)
+        self.assertEqual({call.kwargs["max_workers"] for call in batch.call_args_list}, {fanout + 4})
+        self.assertEqual(settings.FEATHERJUDGE_FANOUT, fanout)
+
+    def test_chapters_published_behind_the_checkpoint_are_scored(self):
+        self.rescore()
+        run = RescoreRun.objects.get(name="test")
+        # Published after the checkpoint passed its id: resume the run as if it had been interrupted
+        RescoreRun.objects.filter(pk=run.pk).update(last_chapter_id=self.draft.pk + 1, finished_at=None)
+        self.draft.draft = False
+        self.draft.save()
+
+        self.rescore()
+        self.assertEqual(self.server.requests_served, 4 + 1)
+        self.assertTrue(ChapterRescore.objects.filter(run=run, chapter=self.draft).exists())
+        run.refresh_from_db()
+        self.assertEqual(run.last_chapter_id, self.draft.pk + 1)
+
+
+class MetricsTests(ChapterTreeTestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_review_is_instrumented_and_exported(self):
+        server = start_standin()
+        self.addCleanup(server.shutdown)
+        root = self.add_chapter(draft=False, content=PrescreenTests.PARENT)
+        chapter = self.add_chapter(root, submitted_for_review=True, content=JudgeCascadeTests.CONTINUATION)
+        waits = self.sample("feathertree_review_queue_wait_seconds_count")
+        calls = self.sample("feathertree_judge_request_seconds_count", tier="large", status="200")
+        scores = self.sample("feathertree_review_scores_total", tier="large", score="4")
+        contexts = self.sample("feathertree_review_context_seconds_count")
+
+        with override_settings(FEATHERJUDGE_URL=server.url):
+            review_chapter(chapter.pk, enqueued_at=time.time() - 5)
+
+        self.assertEqual(self.sample("feathertree_review_queue_wait_seconds_count"), waits + 1)
+        self.assertGreaterEqual(self.sample("feathertree_review_queue_wait_seconds_sum"), 5)
+        self.assertEqual(self.sample("feathertree_judge_request_seconds_count", tier="large", status="200"), calls + 1)
+        self.assertEqual(self.sample("feathertree_review_scores_total", tier="large", score="4"), scores + 1)
+        self.assertEqual(self.sample("feathertree_review_context_seconds_count"), contexts + 1)
+
+        response = self.client.get(reverse("feathertree:metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"feathertree_judge_prompt_tokens_bucket", response.content)
+
+    def test_async_review_decisions_are_counted_by_tier(self):
+        chapter = self.add_chapter(self.add_chapter(draft=False), submitted_for_review=True)
+        before = self.sample("feathertree_judge_tier_decisions_total", tier="small")
+        apply_review_results([(chapter.pk, "verdict-key", (4, "Good.", "small"), {})])
+        self.assertEqual(self.sample("feathertree_judge_tier_decisions_total", tier="small"), before + 1)
+
+    def test_parse_failures_are_counted(self):
+        before = self.sample("feathertree_judge_parse_failures_total", reason="missing_score")
+        with self.assertRaises(ValueError):
+            parse_featherjudge_response("<feedback>Fine.</feedback>")
+        self.assertEqual(self.sample("feathertree_judge_parse_failures_total", reason="missing_score"), before + 1)
+
+    def test_metrics_token_is_required_when_set(self):
+        with override_settings(METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get(reverse("feathertree:metrics")).status_code, 403)
+            response = self.client.get(reverse("feathertree:metrics"), HTTP_AUTHORIZATION="Bearer wrong")
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(reverse("feathertree:metrics"), HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(response.status_code, 200)
+
+    def test_metrics_are_private_in_production_without_a_token(self):
+        with override_settings(METRICS_TOKEN=None, DEVELOPMENT_MODE=False):
+            self.assertEqual(self.client.get(reverse("feathertree:metrics")).status_code, 403)
+            self.client.force_login(self.author)
+            self.assertEqual(self.client.get(reverse("feathertree:metrics")).status_code, 403)
+            get_user_model().objects.filter(pk=self.author.pk).update(is_staff=True)
+            self.assertEqual(self.client.get(reverse("feathertree:metrics")).status_code, 200)
+
+    def test_multiprocess_registry_reads_the_shared_directory(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": directory}):
+            registry = metrics_registry()
+            self.assertIsNot(registry, REGISTRY)
+            self.assertEqual(generate_latest(registry), b"")
+
+
+class PerformanceMiddlewareTests(ChapterTreeTestCase):
+    @override_settings(SERVER_TIMING=True)
+    def test_requests_are_timed_by_url_name(self):
+        self.add_chapter(title="root", draft=False)
+        labels = {"view": "feathertree:story_view"}
+        before = REGISTRY.get_sample_value("feathertree_request_queries_count", labels) or 0
+
+        response = self.client.get(reverse("feathertree:story_view", args=[self.story.pk]))
+
+        timing = response["Server-Timing"]
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r"tpl;dur=[\d.]+")
+        self.assertRegex(timing, r"total;dur=[\d.]+")
+        self.assertEqual(REGISTRY.get_sample_value("feathertree_request_queries_count", labels), before + 1)
+        self.assertGreater(REGISTRY.get_sample_value("feathertree_request_template_seconds_sum", labels), 0)
+
+    def test_exceeding_the_query_budget_logs_the_sql(self):
+        self.add_chapter(title="root", draft=False)
+        url = reverse("feathertree:story_view", args=[self.story.pk])
+        with override_settings(QUERY_BUDGETS={"feathertree:story_view": 0}):
+            with self.assertLogs("feathertree.performance", level="WARNING") as logs:
+                self.client.get(url)
+        self.assertIn("feathertree:story_view ran", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+        with override_settings(QUERY_BUDGETS={"feathertree:story_view": 1000}, SERVER_TIMING=False):
+            with self.assertNoLogs("feathertree.performance", level="WARNING"):
+                response = self.client.get(url)
+        self.assertFalse(response.has_header("Server-Timing"))
+
+
+# Every URL in feathertree/urls.py runs the same number of queries however big the stories behind it are, so
+# an N+1 pattern (a template dereferencing a relation per chapter, a per-row lookup in a view) fails here
+# rather than in production. Counts are for a cold cache, the worst case, and include the session lookups of
+# signed-in requests. Go through QUERY_BUDGETS in settings.py when a count here legitimately changes.
+class QueryCountTests(TestCase):
+    SIZES = (2, 8, 40)  # chapters per story; bigger sites also have more stories and drafts
+
+    # case: (URL name, queries on a cold cache)
+    QUERIES = {
+        "index": ("index", 0),
+        "user_create": ("user_create", 0),
+        "user_profile": ("user_profile", 2),
+        "user_profile_own": ("user_profile", 5),
+        "user_activation": ("user_activation", 1),
+        "stories": ("stories", 2),
+        "story_create": ("story_create", 0),
+        "story_view": ("story_view", 3),
+        "chapter_create": ("chapter_create", 1),
+        "chapter_view": ("chapter_view", 3),
+        "chapter_view_draft": ("chapter_view", 5),
+        "chapter_children": ("chapter_children", 3),
+        "metrics": ("metrics", 0),
+        "new_user_instructions": ("new_user_instructions", 0),
+        "successful_logout": ("successful_logout", 0),
+        "test_page": ("test_page", 2),
+    }
+
+    # A site with `size`-chapter branching stories (three continuations per chapter, every fourth one a
+    # draft) written by a rotating set of authors, the first of whom also has a draft in every story.
+    # Returns the objects the cases below point at.
+    def build_site(self, size):
+        User = get_user_model()
+        authors = [
+            User.objects.create_user(email=f"author{n}-{size}@user.com", password="foo", display_name=f"author {n}-{size}")
+            for n in range(3)
+        ]
+        for n in range(1 + size // 8):
+            story = Story.objects.create(title=f"Story {n} of {size}")
+            chapters = []
+            for i in range(size):
+                parent = chapters[(i - 1) // 3] if chapters else None
+                chapters.append(Chapter.objects.create(
+                    story=story,
+                    author=authors[i % len(authors)],
+                    ordinal=parent.ordinal + 1 if parent else 1,
+                    title=f"Chapter {i}",
+                    content=f"Chapter {i} of story {n}",
+                    previous_chapter=parent,
+                    draft=i > 0 and i % 4 == 0,
+                ))
+            draft = Chapter.objects.create(
+                story=story, author=authors[0], ordinal=chapters[-1].ordinal + 1, title="Work in progress",
+                content="Not finished yet", previous_chapter=chapters[-1], draft=True,
+            )
+        return {"author": authors[0], "story": story, "root": chapters[0], "leaf": chapters[-1], "draft": draft}
+
+    # case -> (url, user to sign in as or None)
+    def requests_for(self, site):
+        author, story, root, leaf = site["author"], site["story"], site["root"], site["leaf"]
+        activation = {
+            "uidb64": urlsafe_base64_encode(force_bytes(author.pk)),
+            "token": account_activation_token.make_token(author),
+        }
+        url = lambda name, *args, **kwargs: reverse(f"feathertree:{name}", args=args, kwargs=kwargs)
+        return {
+            "index": (url("index"), None),
+            "user_create": (url("user_create"), None),
+            "user_profile": (url("user_profile", author.pk), None),
+            "user_profile_own": (url("user_profile", author.pk), author),
+            "user_activation": (url("user_activation", **activation), None),
+            "stories": (url("stories"), None),
+            "story_create": (url("story_create"), None),
+            "story_view": (url("story_view", story.pk), None),
+            "chapter_create": (url("chapter_create", leaf.pk), None),
+            "chapter_view": (url("chapter_view", root.pk), None),
+            "chapter_view_draft": (url("chapter_view", site["draft"].pk), author),
+            "chapter_children": (url("chapter_children", root.pk), None),
+            "metrics": (url("metrics"), None),
+            "new_user_instructions": (url("new_user_instructions"), None),
+            "successful_logout": (url("successful_logout"), None),
+            "test_page": (url("test_page", leaf.pk), None),
+        }
+
+    def count_queries(self, url, user):
+        self.client.logout()
+        if user is not None:
+            self.client.force_login(user)
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertLess(response.status_code, 400, url)
+        return len(queries)
+
+    def test_every_url_is_covered(self):
+        names = {pattern.name for pattern in urls.urlpatterns}
+        self.assertEqual(names, {name for name, _ in self.QUERIES.values()})
+
+    def test_query_counts_do_not_grow_with_the_data(self):
+        for size in self.SIZES:
+            for case, (url, user) in self.requests_for(self.build_site(size)).items():
+                name, expected = self.QUERIES[case]
+                with self.subTest(case=case, size=size):
+                    self.assertEqual(self.count_queries(url, user), expected)
+                    self.assertLessEqual(expected, settings.QUERY_BUDGETS.get(f"feathertree:{name}", expected))
+
+
+class JudgeStandinTests(TestCase):
+    def test_standin_injects_errors_and_samples_latency(self):
+        server = start_standin(latency="uniform:0,0.01", error_rate=1.0, error_status=503, seed=1)
+        self.addCleanup(server.shutdown)
+        response = requests.post(server.url, json={"prompt": "x"}, timeout=5)
+        self.assertEqual((response.status_code, server.errors_injected), (503, 1))
+
+        server.error_rate = 0
+        server.scores = [2]
+        self.assertEqual(parse_featherjudge_response(requests.post(server.url, json={}, timeout=5).json()["text"])[0], 2)
+        with self.assertRaises(ValueError):
+            start_standin(latency="gamma:1,2")
+
+
+class JudgeBreakerTests(TestCase):
+    def setUp(self):
+        judge_breaker.reset_state()
+        self.addCleanup(judge_breaker.reset_state)
+
+    @override_settings(FEATHERJUDGE_URL="http://127.0.0.1:9/unreachable", FEATHERJUDGE_BREAKER_FAILURES=2,
+                       FEATHERJUDGE_BREAKER_COOLDOWN=60)
+    def test_breaker_opens_after_repeated_failures(self):
+        for _ in range(2):
+            self.assertIsNone(call_featherjudge({"prompt": "x"})[0])
+        with self.assertRaises(JudgeUnavailable):
+            call_featherjudge({"prompt": "x"})
+        self.assertEqual(REGISTRY.get_sample_value("feathertree_judge_breaker_state", {"tier": "large"}), 2)
+        # The small model's endpoint has its own breaker
+        self.assertFalse(judge_breaker.get_breaker("small").is_open())
+
+    def test_half_open_breaker_lets_one_probe_through(self):
+        breaker = judge_breaker.CircuitBreaker(failure_threshold=1, cooldown=0)
+        breaker.record_failure()
+        breaker.before_call()  # the probe
+        with self.assertRaises(JudgeUnavailable):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, judge_breaker.CLOSED)
+
+    @override_settings(FEATHERJUDGE_BATCH_URL="http://judge.invalid/batch", FEATHERJUDGE_BREAKER_FAILURES=1,
+                       FEATHERJUDGE_BREAKER_COOLDOWN=0)
+    def test_batch_calls_always_settle_the_half_open_probe(self):
+        breaker = judge_breaker.get_breaker()
+        malformed = mock.Mock(status_code=200, **{"json.return_value": {"unexpected": []}})
+        for outcome, state in [(malformed, judge_breaker.CLOSED), (RuntimeError("boom"), judge_breaker.OPEN)]:
+            breaker.record_failure()  # open; with no cooldown the next call is the half-open probe
+            with mock.patch("feathertree.helpers.post_judge_batch", side_effect=[outcome]), \
+                    self.assertLogs("feathertree.helpers", "ERROR"):
+                results = call_featherjudge_batch([{"prompt": "x"}] * 2)
+            self.assertEqual([score for score, _ in results], [None, None])
+            self.assertEqual((breaker.state, breaker.probing), (state, False))
+        breaker.before_call()  # a new probe is let through
+
+    def test_limiter_backs_off_multiplicatively_and_recovers_additively(self):
+        limiter = judge_breaker.AdaptiveLimiter(minimum=1, maximum=8, latency_target=1, client="test")
+        self.assertTrue(limiter.acquire(timeout=0))
+        limiter.release(latency=5, ok=True)  # too slow
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(4):
+            self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        for _ in range(4):
+            limiter.release(latency=0.1, ok=True)
+        self.assertEqual(int(limiter.limit), 4)
+        self.assertGreater(limiter.limit, 4.9)
+
+        limiter.widen(12)
+        self.assertEqual(limiter.maximum, 12)
+        self.assertGreater(limiter.limit, 8.9)
+
+    def test_wider_fan_out_widens_the_limit_and_connection_pool(self):
+        server = start_standin()
+        self.addCleanup(server.shutdown)
+        judge_client.reset_session()
+        self.addCleanup(judge_client.reset_session)
+        workers = settings.FEATHERJUDGE_FANOUT + settings.FEATHERJUDGE_POOL_SIZE
+        with override_settings(FEATHERJUDGE_URL=server.url, FEATHERJUDGE_BATCH_URL=None):
+            texts = call_featherjudge_batch([{"prompt": "x"}] * 2, max_workers=workers)
+        self.assertEqual(len(texts), 2)
+        self.assertEqual(judge_breaker.get_limiter().maximum, workers)
+        adapter = judge_client.get_session().get_adapter("http://")
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], workers)
+
+
+class PromptPrefixTests(ChapterTreeTestCase):
+    def test_sibling_reviews_share_a_prompt_prefix(self):
+        root = self.add_chapter(draft=False, content="The old bridge had stood for a hundred years. " * 40)
+        short = self.add_chapter(root, content="It fell that night.")
+        long = self.add_chapter(root, content="The river rose all week, carrying branches and fence posts. " * 30)
+
+        short_prompt = build_judge_payload(review_context(short), short.content)["prompt"]
+        long_prompt = build_judge_payload(review_context(long), long.content)["prompt"]
+        self.assertEqual(previous_text_budget(short.content), previous_text_budget(long.content))
+        shared = short_prompt.index("<current_text>")
+        self.assertEqual(short_prompt[:shared], long_prompt[:shared])
+        self.assertIn(root.content.strip(), short_prompt[:shared])
+
+    def test_sibling_order_sends_siblings_after_their_prefix_is_cached(self):
+        stories = ["Once upon a time " * 300, "Long ago and far away " * 300]
+        pairs = [(stories[n % 2], f"Continuation number {n}.") for n in range(6)]
+        groups = [n % 2 for n in range(6)]
+        hit_rates = {}
+        for order in ("fifo", "siblings"):
+            server = start_standin(latency=0.05, prefill=0.05, prefix_cache=10000)
+            self.addCleanup(server.shutdown)
+            with override_settings(
+                FEATHERJUDGE_URL=server.url, FEATHERJUDGE_FANOUT=6, FEATHERJUDGE_DISPATCH_ORDER=order,
+                FEATHERJUDGE_VERDICT_TTL=0,
+            ):
+                results = query_judge_batch(pairs, groups=groups)
+            self.assertEqual([result[0] for result in results], [4] * 6)
+            hit_rates[order] = server.cached_tokens / server.prompt_tokens
+        # All six go out at once in FIFO order; grouped, four of them find their story cached
+        self.assertGreater(hit_rates["siblings"], 0.6)
+        self.assertGreater(hit_rates["siblings"], hit_rates["fifo"] + 0.3)
+
+
+class JudgeContextTests(TestCase):
+    def test_previous_text_keeps_nearest_ancestors_verbatim_within_budget(self):
+        ancestors = [f"Chapter {n}: " + "word " * 200 for n in range(1, 21)]
+        budget = 1000
+        previous_text = build_previous_text(ancestors, budget, excerpt_tokens=50)
+
+        self.assertLessEqual(estimate_tokens(previous_text), budget)
+        self.assertTrue(previous_text.endswith(ancestors[-1] + "\n"))
+        self.assertIn(ancestors[-2], previous_text)
+        self.assertIn("Chapter 16: word word", previous_text)  # an excerpt of an older chapter
+        self.assertNotIn(ancestors[-6], previous_text)
+        self.assertTrue(previous_text.startswith("[Earlier chapters omitted]"))
+
+        # Everything fits: the old behaviour
+        self.assertEqual(build_previous_text(ancestors[:2], budget), ancestors[0] + "\n" + ancestors[1] + "\n")
+
+    @override_settings(FEATHERJUDGE_URL="http://127.0.0.1:9/unreachable", FEATHERJUDGE_CONTEXT_TOKENS=1000)
+    def test_oversized_prompts_are_rejected_before_sending(self):
+        with self.assertRaises(JudgePromptTooLong):
+            query_judge("", "word " * 1000)
@@ -20,6 +20,10 @@ urlpatterns = [
     path("story/<int:story_id>/view", views.story_view, name="story_view"),
     path("chapter/<int:prev_chapter_id>/create", views.chapter_create, name="chapter_create"),
     path("chapter/<int:chapter_id>/view", views.chapter_view, name="chapter_view"),
+    path("chapter/<int:chapter_id>/children.json", views.chapter_children, name="chapter_children"),
+
+    # Prometheus metrics:
+    path("metrics", views.metrics, name="metrics"),
 
     # Static Page URLs:
     path("user/new-user-instructions", views.new_user_instructions, name="new_user_instructions"),
@@ -1,17 +1,31 @@
 from django.contrib.auth import login
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponseRedirect, Http404, HttpResponseForbidden, HttpResponse
+from django.template.loader import render_to_string
+from django.http import HttpResponseRedirect, Http404, HttpResponseForbidden, HttpResponse, JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.utils.formats import date_format
+from django.utils.timezone import localtime
+from django.db.models import Exists, Max, OuterRef
+from django.conf import settings
 from django.urls import reverse
-from django.core.paginator import Paginator
 from .models import User, Story, Chapter
 from .forms import UserCreationForm, StoryCreationForm, ChapterCreationForm
-from .helpers import form_invalid_response, form_invalid_response_w_msg
+from .helpers import form_invalid_response, form_invalid_response_w_msg, flatten_chapter_tree
+from .pagination import EstimatedCountPaginator, keyset_paginate, decode_cursor
+from .caching import (
+    cached_for_story, cached_for_story_list, cached_fragment, viewer_class,
+    get_story_version, get_story_list_version, make_etag, viewer_etag_key,
+)
 from .mailers import send_new_user_confirmation_email
 from .tokens import account_activation_token
 from django.utils.http import urlsafe_base64_decode
 from django.utils.encoding import force_str
-from .tasks import review_chapter
+from .tasks import request_review
+from .metrics import metrics_registry
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from itertools import groupby
+import hmac
 import os
 
 def index(request):
@@ -60,6 +74,7 @@ def user_profile(request, user_id):
     drafts = (
         Chapter.objects
         .filter(author=profile_user, draft=True)
+        .select_related('story')
         .order_by('-timestamp')
     )
 
@@ -101,6 +116,8 @@ def user_activation(request, **kwargs):
             return HttpResponseRedirect(reverse("feathertree:index"))
 
 # Story Views:
+STORIES_PER_PAGE = 10  # make user-adjustable later
+
 def story_create(request):
     if request.method == "POST":
         form = StoryCreationForm(request.POST)
@@ -112,26 +129,43 @@ def story_create(request):
         form = StoryCreationForm()
         return render(request, "feathertree/story_create.html", {"form": form})
 
+def stories_etag(request):
+    newest = Story.objects.aggregate(newest=Max("last_updated"))["newest"]
+    return make_etag(
+        "stories", newest, get_story_list_version(), settings.STORIES_NUMBERED_PAGES,
+        request.GET.urlencode(), viewer_etag_key(request.user),
+    )
+
+@condition(etag_func=stories_etag)
 def stories(request): # a list of recently updated stories
     stories_qs = (
         Story.objects
-        .order_by("-last_updated")
+        .select_related("stats")
+        .order_by("-last_updated", "-pk")
     )
 
-    paginator = Paginator(stories_qs, 10)  # 10 stories per page, make user-adjustable later
-    page_number = request.GET.get("page")
-    stories_page = paginator.get_page(page_number)
+    # Numbered pages are opt-in: they need a (estimated) count and an OFFSET scan per page
+    if settings.STORIES_NUMBERED_PAGES:
+        paginator = EstimatedCountPaginator(stories_qs, STORIES_PER_PAGE)
+        stories_page = paginator.get_page(request.GET.get("page"))
+    else:
+        # Ignore malformed cursors up front so junk query strings can't fill the cache
+        after = request.GET.get("after") if decode_cursor(request.GET.get("after")) else None
+        before = request.GET.get("before") if decode_cursor(request.GET.get("before")) else None
+        stories_page = cached_for_story_list(
+            f"page:{after}:{before}",
+            lambda: keyset_paginate(stories_qs, STORIES_PER_PAGE, after=after, before=before),
+        )
 
-    print(stories_page)
-    
     return render(request, "feathertree/stories.html", {
         "stories_page": stories_page,
+        "numbered_pages": settings.STORIES_NUMBERED_PAGES,
     })
 
 
 # Used to create a chapter beyond the first one
 def chapter_create(request, prev_chapter_id):
-    prev_chapter = get_object_or_404(Chapter, pk=prev_chapter_id)
+    prev_chapter = get_object_or_404(Chapter.objects.select_related("story"), pk=prev_chapter_id)
     story = prev_chapter.story
     # if this is a POST request we need to process the form data
     if request.method == "POST":
@@ -153,66 +187,136 @@ def chapter_create(request, prev_chapter_id):
         form = ChapterCreationForm()
         return render(request, "feathertree/chapter_create.html", {"form": form, "prev_chapter_id": prev_chapter_id})
 
-def story_view(request, story_id):
-    story = get_object_or_404(Story, pk=story_id)
-
-    # Only include non-draft chapters
-    chapters = list(
+# Flat rows (see helpers.flatten_chapter_tree) for a story's published chapter tree
+def story_tree_rows(story_id, initial_levels):
+    # Published chapters in pre-order, so every parent arrives before its children and
+    # siblings already come in display order. Drafts never get a position.
+    chapters = (
         Chapter.objects
-        .filter(story=story, draft=False)
-        .select_related("previous_chapter")
-        .order_by("ordinal", "timestamp")
+        .filter(story_id=story_id, draft=False, preorder__isnull=False)
+        .select_related("author")
+        .order_by("preorder")
     )
-
-    # Build node objects for the tree
-    nodes_by_id = {}
-    for ch in chapters:
-        nodes_by_id[ch.id] = {
-            "chapter": ch,
-            "children": [],
-        }
-
-    roots = []
-
-    # Wire up parent-child relationships
-    for ch in chapters:
-        node = nodes_by_id[ch.id]
-        if ch.previous_chapter_id:
-            parent = nodes_by_id.get(ch.previous_chapter_id)
-            if parent:
-                parent["children"].append(node)
-        else:
-            roots.append(node)
-
-    # Sort children consistently
-    def sort_children(node):
-        node["children"].sort(
-            key=lambda n: (
-                n["chapter"].ordinal,
-                n["chapter"].timestamp or n["chapter"].id
-            )
+    # Big stories only get their top levels rendered; the rest is loaded on demand via chapter_children
+    if initial_levels:
+        chapters = chapters.filter(depth__lt=initial_levels).annotate(
+            has_published_children=Exists(Chapter.objects.published_children_of(OuterRef("pk")))
         )
-        for child in node["children"]:
-            sort_children(child)
 
-    for root in roots:
-        sort_children(root)
+    # Flatten into rows the template can render in a single loop
+    return flatten_chapter_tree(chapters)
 
-    # First non-draft chapter for CTA
-    first_chapter = roots[0]["chapter"] if roots else None
+def render_chapter_tree(story_id, initial_levels):
+    chapter_rows = cached_for_story(
+        story_id,
+        f"tree:{initial_levels}",
+        lambda: story_tree_rows(story_id, initial_levels),
+    )
+    if not chapter_rows:
+        return ""
+    return render_to_string("feathertree/_chapter_tree_flat.html", {"rows": chapter_rows})
+
+def story_view_etag(request, story_id):
+    last_updated = Story.objects.filter(pk=story_id).values_list("last_updated", flat=True).first()
+    if last_updated is None:
+        return None
+    return make_etag(
+        "story", story_id, last_updated, get_story_version(story_id),
+        settings.STORY_TREE_INITIAL_LEVELS, viewer_etag_key(request.user),
+    )
+
+@condition(etag_func=story_view_etag)
+def story_view(request, story_id):
+    story = get_object_or_404(Story.objects.select_related("stats"), pk=story_id)
+
+    # The rendered tree is cached per story version and viewer class, so a warm request does no tree work
+    # at all. On a miss the rows come from the data cache (see caching.py) and get rendered once.
+    initial_levels = settings.STORY_TREE_INITIAL_LEVELS
+    chapter_tree_html = cached_fragment(
+        story.id,
+        f"chapter_tree:{initial_levels}",
+        viewer_class(request.user),
+        lambda: render_chapter_tree(story.id, initial_levels),
+    )
 
     return render(
         request,
         "feathertree/story_view.html",
         {
             "story": story,
-            "chapter_tree": roots,
-            "first_chapter": first_chapter,
+            "chapter_tree_html": chapter_tree_html,
         },
     )
 
+# Compact JSON listing of a published chapter's published children, used by story_tree.js to expand
+# branches story_view didn't render. Responses can be cached; they only change when the story does. The
+# validator is the story's cache version rather than Story.last_updated, which deleting or unpublishing a
+# chapter doesn't touch. Drafts and missing chapters (a 404) get no validator.
+def chapter_children_etag(request, chapter_id):
+    story_id = Chapter.objects.filter(pk=chapter_id, draft=False).values_list("story_id", flat=True).first()
+    if story_id is None:
+        return None
+    return make_etag("children", chapter_id, get_story_version(story_id))
+
+@cache_control(public=True, max_age=settings.STORY_TREE_CHILDREN_MAX_AGE)
+@condition(etag_func=chapter_children_etag)
+def chapter_children(request, chapter_id):
+    chapter = get_object_or_404(Chapter, pk=chapter_id, draft=False)
+
+    children = (
+        Chapter.objects.published_children_of(chapter)
+        .select_related("author")
+        .annotate(has_published_children=Exists(Chapter.objects.published_children_of(OuterRef("pk"))))
+        .order_by("preorder")
+    )
+
+    return JsonResponse({
+        "children": [
+            {
+                "id": child.id,
+                "title": child.title,
+                "ordinal": child.ordinal,
+                "url": reverse("feathertree:chapter_view", args=[child.id]),
+                "children_url": reverse("feathertree:chapter_children", args=[child.id]),
+                "has_children": child.has_published_children,
+                "author": child.author.display_name,
+                "author_url": reverse("feathertree:user_profile", kwargs={"user_id": child.author_id}),
+                "date": date_format(localtime(child.timestamp), "M j, Y") if child.timestamp else "",
+            }
+            for child in children
+        ]
+    })
+
+def next_chapters_for(chapter, include_drafts):
+    next_chapters = (
+        chapter.next_chapters.all().select_related("story").order_by("timestamp")
+    )
+    if not include_drafts:
+        next_chapters = next_chapters.filter(draft=False)
+    return list(next_chapters)
+
+# Drafts never get an ETag: their page carries the edit form (with a CSRF token) and review status,
+# so authors and moderators always get a fresh render.
+def chapter_view_etag(request, chapter_id):
+    row = (
+        Chapter.objects.filter(pk=chapter_id)
+        .values_list("draft", "timestamp", "story_id", "story__last_updated")
+        .first()
+    )
+    if row is None or row[0]:
+        return None
+    _, timestamp, story_id, story_updated = row
+    return make_etag(
+        "chapter", chapter_id, timestamp, story_updated, get_story_version(story_id),
+        viewer_etag_key(request.user),
+    )
+
+@condition(etag_func=chapter_view_etag)
 def chapter_view(request, chapter_id):
-    chapter = get_object_or_404(Chapter, pk=chapter_id)
+    # The template shows the story, author and previous chapter; fetch them with the chapter
+    chapter = get_object_or_404(
+        Chapter.objects.select_related("story", "author", "previous_chapter"), pk=chapter_id
+    )
     user = request.user
 
     is_author = user.is_authenticated and (user == getattr(chapter, "author", None))
@@ -241,16 +345,18 @@ def chapter_view(request, chapter_id):
             # Save edits AND request publication in one go
             obj.submitted_for_review = True
             obj.save()
-            # Create publication review task
-            review_chapter.delay(chapter_id=chapter.id)
+            # Create publication review task (or add it to the next review batch)
+            request_review(chapter.id)
             return redirect("feathertree:chapter_view", chapter_id=chapter.id)
         # if invalid, fall through and render with errors
         
-    next_chapters = (
-        chapter.next_chapters.all().select_related("story").order_by("timestamp")
+    # Cached per story version; authors and moderators also see draft continuations
+    include_drafts = is_author or can_moderate
+    next_chapters = cached_for_story(
+        chapter.story_id,
+        f"next:{chapter.id}:{'all' if include_drafts else 'published'}",
+        lambda: next_chapters_for(chapter, include_drafts),
     )
-    if not (is_author or can_moderate):
-        next_chapters = next_chapters.filter(draft=False)
 
     return render(
         request,
@@ -276,6 +382,19 @@ def successful_logout(request):
 def successful_email_sent(request):
     return render(request, "feathertree/successful_email_sent.html")
 
+# Prometheus scrape endpoint (see metrics.py). Scrapers send METRICS_TOKEN as a bearer token; staff can look
+# in from the browser. Without a token configured it is only open in development.
+def metrics(request):
+    token = settings.METRICS_TOKEN
+    if token:
+        authorization = request.headers.get("Authorization", "")
+        allowed = hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    else:
+        allowed = settings.DEVELOPMENT_MODE
+    if not (allowed or request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
+
 
 
 ##############################################################################################################################
@@ -332,13 +451,8 @@ def test_page(request, chapter_id):
     score = 0
     feedback = ""
 
-    # Start with this chapter’s content
-    previous_text = ""
-
-    # Walk backward through linked chapters
-    current = chapter
-    while current.previous_chapter is not None:
-        current = current.previous_chapter
-        previous_text = current.content + "\n" + previous_text  # prepend previous content
+    # Collect every earlier chapter of this branch in one query, root first
+    ancestor_contents = Chapter.objects.ancestors_of(chapter).values_list("content", flat=True)
+    previous_text = "".join(content + "\n" for content in ancestor_contents)
 
     return render(request, "feathertree/test_page.html", {"content": content, "previous_text": previous_text})
\ No newline at end of file
@@ -8,6 +8,7 @@
 
 import os
 from celery import Celery
+from celery.signals import worker_process_shutdown
 from django.conf import settings
 
 # this code copied from manage.py
@@ -22,4 +23,10 @@ app = Celery("feathertree_project")
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # discover and load tasks.py from from all registered Django apps
-app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
\ No newline at end of file
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+# In Prometheus multiprocess mode, stop reporting the live gauges of worker processes that have exited
+@worker_process_shutdown.connect
+def mark_metrics_process_dead(pid=None, **kwargs):
+    from feathertree.metrics import mark_process_dead
+    mark_process_dead(pid or os.getpid())
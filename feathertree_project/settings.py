@@ -35,6 +35,82 @@ BASETEN_DEPLOYMENT_TYPE = "production" # this is eventually included as part of
 if DEVELOPMENT_MODE == False:
     BASETEN_DEPLOYMENT_TYPE = "production"
 FEATHERJUDGE_MODEL_ID = os.getenv("FEATHERJUDGE_MODEL_ID", "rwny1n13") # defaults to original model ID
+FEATHERJUDGE_URL = os.getenv("FEATHERJUDGE_URL") # overrides the Baseten URL, e.g. to point at a local stand-in
+# Review cascade: with a small model ID set, that cheaper model scores every submission first and the model
+# above is only consulted when its score falls in the ambiguous band FEATHERJUDGE_ESCALATE_MIN..MAX
+# (or its answer can't be used). Empty (the default) sends every review to FEATHERJUDGE_MODEL_ID.
+FEATHERJUDGE_SMALL_MODEL_ID = os.getenv("FEATHERJUDGE_SMALL_MODEL_ID", "")
+FEATHERJUDGE_SMALL_URL = os.getenv("FEATHERJUDGE_SMALL_URL") # like FEATHERJUDGE_URL, for the small model
+FEATHERJUDGE_ESCALATE_MIN = int(os.getenv("FEATHERJUDGE_ESCALATE_MIN", "2"))
+FEATHERJUDGE_ESCALATE_MAX = int(os.getenv("FEATHERJUDGE_ESCALATE_MAX", "3"))
+# HTTP client for FeatherJudge calls (see feathertree/judge_client.py). Each worker process keeps a pool of
+# keep-alive connections; the connect timeout is short so an unreachable endpoint fails fast.
+FEATHERJUDGE_POOL_SIZE = int(os.getenv("FEATHERJUDGE_POOL_SIZE", "10"))
+FEATHERJUDGE_CONNECT_TIMEOUT = float(os.getenv("FEATHERJUDGE_CONNECT_TIMEOUT", "5"))
+FEATHERJUDGE_READ_TIMEOUT = float(os.getenv("FEATHERJUDGE_READ_TIMEOUT", "120"))
+# Review batching (feathertree/tasks.py). With a window > 0, submissions are collected for that many
+# seconds (or until FEATHERJUDGE_BATCH_SIZE are pending) and judged together: in one request to
+# FEATHERJUDGE_BATCH_URL if the deployment has a batch endpoint, otherwise as up to FEATHERJUDGE_FANOUT
+# concurrent calls. A window of 0 reviews every chapter in its own task.
+FEATHERJUDGE_BATCH_WINDOW = float(os.getenv("FEATHERJUDGE_BATCH_WINDOW", "0"))
+FEATHERJUDGE_BATCH_SIZE = int(os.getenv("FEATHERJUDGE_BATCH_SIZE", "16"))
+FEATHERJUDGE_BATCH_URL = os.getenv("FEATHERJUDGE_BATCH_URL")
+FEATHERJUDGE_FANOUT = int(os.getenv("FEATHERJUDGE_FANOUT", "8"))
+# Order of judge calls within a batch or dispatcher: "siblings" holds continuations of the same chapter back
+# until the first of them has been answered, then sends the rest together, so they hit the inference server's
+# cached prompt prefix; "fifo" sends everything as it comes.
+FEATHERJUDGE_DISPATCH_ORDER = os.getenv("FEATHERJUDGE_DISPATCH_ORDER", "siblings")
+# How review_chapter makes its judge call: "sync" blocks the worker process on the call; "async" hands it to
+# the process's asyncio dispatcher (feathertree/judge_dispatcher.py), which keeps up to
+# FEATHERJUDGE_MAX_IN_FLIGHT calls in flight, gives each FEATHERJUDGE_CALL_DEADLINE seconds from submission,
+# and saves verdicts in batches of up to FEATHERJUDGE_WRITE_BATCH_SIZE every FEATHERJUDGE_WRITE_INTERVAL seconds.
+FEATHERJUDGE_DISPATCH = os.getenv("FEATHERJUDGE_DISPATCH", "sync")
+FEATHERJUDGE_MAX_IN_FLIGHT = int(os.getenv("FEATHERJUDGE_MAX_IN_FLIGHT", "200"))
+FEATHERJUDGE_CALL_DEADLINE = float(os.getenv("FEATHERJUDGE_CALL_DEADLINE", "150"))
+FEATHERJUDGE_WRITE_BATCH_SIZE = int(os.getenv("FEATHERJUDGE_WRITE_BATCH_SIZE", "50"))
+FEATHERJUDGE_WRITE_INTERVAL = float(os.getenv("FEATHERJUDGE_WRITE_INTERVAL", "0.5"))
+# Lost reviews (feathertree/tasks.py, review claims): a submission whose review has held its claim for longer
+# than the longest judge call plus FEATHERJUDGE_REVIEW_CLAIM_MARGIN seconds is queued again by the
+# requeue_stale_reviews task, which Celery beat runs every FEATHERJUDGE_REVIEW_SWEEP_INTERVAL seconds.
+FEATHERJUDGE_REVIEW_CLAIM_MARGIN = float(os.getenv("FEATHERJUDGE_REVIEW_CLAIM_MARGIN", "60"))
+FEATHERJUDGE_REVIEW_SWEEP_INTERVAL = float(os.getenv("FEATHERJUDGE_REVIEW_SWEEP_INTERVAL", "60"))
+# Endpoint protection (feathertree/judge_breaker.py), kept separately for each cascade tier: the breaker
+# opens after this many consecutive failed calls and probes again after the cooldown (seconds). Concurrency adapts between FEATHERJUDGE_CONCURRENCY_MIN
+# and the client's maximum (FEATHERJUDGE_FANOUT or FEATHERJUDGE_MAX_IN_FLIGHT), backing off when calls fail
+# or take longer than FEATHERJUDGE_LATENCY_TARGET seconds. Reviews (and review batches) that find the breaker
+# open are retried up to FEATHERJUDGE_BREAKER_MAX_RETRIES times in all, then fail as unavailable.
+FEATHERJUDGE_BREAKER_FAILURES = int(os.getenv("FEATHERJUDGE_BREAKER_FAILURES", "5"))
+FEATHERJUDGE_BREAKER_COOLDOWN = float(os.getenv("FEATHERJUDGE_BREAKER_COOLDOWN", "30"))
+FEATHERJUDGE_BREAKER_MAX_RETRIES = int(os.getenv("FEATHERJUDGE_BREAKER_MAX_RETRIES", "20"))
+FEATHERJUDGE_CONCURRENCY_MIN = int(os.getenv("FEATHERJUDGE_CONCURRENCY_MIN", "1"))
+FEATHERJUDGE_LATENCY_TARGET = float(os.getenv("FEATHERJUDGE_LATENCY_TARGET", "30"))
+# Local pre-screen before the judge call (feathertree/prescreen.py). Submissions are declined without a judge
+# call if they have fewer than PRESCREEN_MIN_WORDS words, too few distinct words for their length
+# (distinct / sqrt(total) below PRESCREEN_MIN_RICHNESS), a length more than
+# PRESCREEN_MAX_LENGTH_RATIO times longer or shorter than their parent, or a bag-of-words cosine similarity of
+# at least PRESCREEN_DUPLICATE_SIMILARITY to their parent or a sibling.
+PRESCREEN_ENABLED = os.getenv("PRESCREEN_ENABLED", "True") == "True"
+PRESCREEN_MIN_WORDS = int(os.getenv("PRESCREEN_MIN_WORDS", "20"))
+PRESCREEN_MIN_RICHNESS = float(os.getenv("PRESCREEN_MIN_RICHNESS", "2.0"))
+PRESCREEN_MAX_LENGTH_RATIO = float(os.getenv("PRESCREEN_MAX_LENGTH_RATIO", "50"))
+PRESCREEN_DUPLICATE_SIMILARITY = float(os.getenv("PRESCREEN_DUPLICATE_SIMILARITY", "0.95"))
+# Context window of the FeatherJudge model, in tokens. Review prompts are fitted to it (feathertree/judge_context.py).
+FEATHERJUDGE_CONTEXT_TOKENS = int(os.getenv("FEATHERJUDGE_CONTEXT_TOKENS", "8192"))
+# Room kept for the chapter under review when sizing previous text, so that sibling continuations shorter
+# than this share the same prompt prefix (see helpers.previous_text_budget)
+FEATHERJUDGE_CURRENT_TEXT_TOKENS = int(os.getenv("FEATHERJUDGE_CURRENT_TEXT_TOKENS", "2048"))
+# Rolling per-chapter summaries used as review context for older ancestors: total size, and size of the
+# line each chapter contributes (tokens)
+CHAPTER_SUMMARY_TOKENS = int(os.getenv("CHAPTER_SUMMARY_TOKENS", "600"))
+CHAPTER_SUMMARY_LINE_TOKENS = int(os.getenv("CHAPTER_SUMMARY_LINE_TOKENS", "60"))
+# Verdict cache (JudgeVerdict): identical judge calls reuse the stored score/feedback for this many seconds
+# (0 turns the cache off). Celery beat removes expired and least recently used entries every
+# FEATHERJUDGE_VERDICT_EVICT_INTERVAL seconds (tasks.evict_judge_verdicts, also `manage.py evict_judge_verdicts`).
+FEATHERJUDGE_VERDICT_TTL = int(os.getenv("FEATHERJUDGE_VERDICT_TTL", str(30 * 24 * 60 * 60)))
+FEATHERJUDGE_VERDICT_MAX_ENTRIES = int(os.getenv("FEATHERJUDGE_VERDICT_MAX_ENTRIES", "100000"))
+FEATHERJUDGE_VERDICT_EVICT_INTERVAL = float(os.getenv("FEATHERJUDGE_VERDICT_EVICT_INTERVAL", "3600"))
+# Verdicts served from Redis have their last use written to the table at most this often (seconds)
+FEATHERJUDGE_VERDICT_TOUCH_INTERVAL = int(os.getenv("FEATHERJUDGE_VERDICT_TOUCH_INTERVAL", "600"))
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.getenv("DEBUG", "False") == "True"
@@ -55,6 +131,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'feathertree.performance.PerformanceMiddleware', # first, so it times everything below it
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,7 +148,7 @@ ROOT_URLCONF = 'feathertree_project.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'feathertree.performance.TimedDjangoTemplates', # DjangoTemplates with render timing
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -158,6 +235,16 @@ STATICFILES_FINDERS = [
     'django.contrib.staticfiles.finders.AppDirectoriesFinder',
 ]
 
+# Story tree settings:
+    # story_view renders only this many levels of the chapter tree up front; deeper branches are fetched
+    # from the chapter_children JSON endpoint the first time they're expanded. 0 renders the whole tree.
+STORY_TREE_INITIAL_LEVELS = int(os.getenv("STORY_TREE_INITIAL_LEVELS", "2"))
+    # How long browsers and CDNs may reuse a chapter_children response (seconds)
+STORY_TREE_CHILDREN_MAX_AGE = int(os.getenv("STORY_TREE_CHILDREN_MAX_AGE", "60"))
+
+# Stories listing: cursor pagination by default. Set to True for numbered pages backed by an estimated count.
+STORIES_NUMBERED_PAGES = os.getenv("STORIES_NUMBERED_PAGES", "False") == "True"
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -195,9 +282,62 @@ LOGOUT_REDIRECT_URL = 'feathertree:successful_logout'
 # https://testdriven.io/courses/django-celery/getting-started/
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://127.0.0.1:6379/0")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://127.0.0.1:6379/0")
+# Periodic tasks; run a scheduler next to the workers with:
+#   celery -A feathertree_project beat -l info
+CELERY_BEAT_SCHEDULE = {
+    "requeue-stale-reviews": {
+        "task": "feathertree.tasks.requeue_stale_reviews",
+        "schedule": FEATHERJUDGE_REVIEW_SWEEP_INTERVAL,
+    },
+    "evict-judge-verdicts": {
+        "task": "feathertree.tasks.evict_judge_verdicts",
+        "schedule": FEATHERJUDGE_VERDICT_EVICT_INTERVAL,
+    },
+}
 if DEVELOPMENT_MODE == False:
     # Force TLS on both broker and backend
     CELERY_BROKER_USE_SSL = {"ssl_cert_reqs": ssl.CERT_NONE} # or ssl.CERT_REQUIRED if you manage CA certs
     CELERY_REDIS_BACKEND_USE_SSL = {"ssl_cert_reqs": ssl.CERT_NONE}
     # Optional: Celery 5+ sometimes benefits from this at start
-    CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
\ No newline at end of file
+    CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
+# Prometheus metrics (feathertree/metrics.py), served at /metrics. Web and worker processes share their
+# metrics through files when PROMETHEUS_MULTIPROC_DIR is set in the environment of every process (empty the
+# directory before starting them). Scrapers must send "Authorization: Bearer <METRICS_TOKEN>"; staff users
+# can always view it. Without a token the endpoint is refused outside DEVELOPMENT_MODE.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Request performance (feathertree/performance.py). SERVER_TIMING adds a Server-Timing header with database,
+# template and total time to every response. It is off unless DEBUG or DEVELOPMENT_MODE is set, since it
+# shows every visitor how long the server spent; the metrics endpoint has the same numbers privately.
+# QUERY_BUDGETS maps URL names to the most SQL queries a request should run; going over logs a warning
+# (logger feathertree.performance) with the most repeated statements.
+SERVER_TIMING = os.getenv("SERVER_TIMING", str(DEBUG or DEVELOPMENT_MODE)) == "True"
+QUERY_BUDGETS = {
+    "feathertree:index": 4,
+    "feathertree:stories": 6,
+    "feathertree:story_view": 6,
+    "feathertree:chapter_view": 8,
+    "feathertree:chapter_children": 6,
+    "feathertree:user_profile": 8,
+}
+# Cache settings
+# Production caches in the same Redis deployment as Celery (set CACHE_URL to point it at a separate database).
+# Development uses local memory unless CACHE_URL is set. See feathertree/caching.py for what gets cached.
+CACHE_URL = os.getenv("CACHE_URL", None if DEVELOPMENT_MODE else CELERY_BROKER_URL)
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+            "KEY_PREFIX": "feathertree",
+            # Same TLS policy as the Celery broker
+            "OPTIONS": {"ssl_cert_reqs": ssl.CERT_NONE} if CACHE_URL.startswith("rediss://") else {},
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+# How long cached page data may live (seconds). Entries are also invalidated by per-story version bumps.
+FEATHERTREE_CACHE_TIMEOUT = int(os.getenv("FEATHERTREE_CACHE_TIMEOUT", str(60 * 60)))